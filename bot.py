@@ -1,21 +1,41 @@
 import os
 import re
+import mmap
 import logging
 import time
 import asyncio
 import urllib.parse
 import subprocess
-import tempfile
 import base64
 import json
-from http.cookies import SimpleCookie
+import hashlib
+import functools
+import mimetypes
+from pathlib import Path
 import yt_dlp
-import requests
+import httpx
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo, WebAppInfo
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import mp4
+import transcode
+import metrics
+import tracing
+from metrics import InstrumentedRequest, MetricsServer
 from db import Database
-from TeraboxDL import TeraboxDL
+from jobs import JobQueue
+from pipeline import Pipeline, Stage
+from streaming import stream_video_upload
+from downloader import SegmentedDownloader
+from resolver import CandidateStats, hedged_race
+from http_pool import HttpPool
+import terabox
+from cookies import CookiePool, is_throttled
+from progress import ProgressDispatcher
+from broadcast import Broadcaster
+from gateway import Gateway, ChunkCache
+from diskspace import DiskBudget, InsufficientDiskSpace
 
 # Load environment variables
 load_dotenv()
@@ -35,11 +55,41 @@ CLOUD_CHANNEL_ID = os.getenv('CLOUD_CHANNEL_ID')
 LOG_CHANNEL_ID = os.getenv('LOG_CHANNEL_ID')
 ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
 TERABOX_COOKIE = os.getenv('TERABOX_COOKIE')
-BASE_URL = os.getenv('BASE_URL', 'http://localhost:8000')
+BASE_URL = os.getenv('BASE_URL')
+# Streaming gateway for files too large for Telegram (needs a public port). Only with an
+# explicit BASE_URL: its links are useless unless others can reach them there
+ENABLE_WEB_SERVER = bool(BASE_URL) and os.getenv('ENABLE_WEB_SERVER', 'true').lower() == 'true'
+PORT = int(os.getenv('PORT', 8000))
+# Prometheus metrics on a local port (0 disables the endpoint)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Per-job JSON trace spans (TRACE_FILE) and a cProfile of every Nth job (PROFILE_EVERY, 0 disables)
+TRACE_FILE = os.getenv('TRACE_FILE')
+PROFILE_EVERY = int(os.getenv('PROFILE_EVERY', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
 TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL') # Optional: Custom Bot API URL
 HTTP_PROXY = os.getenv('HTTP_PROXY')
 HTTPS_PROXY = os.getenv('HTTPS_PROXY')
 
+# 50MB for normal bot, 2000MB (2GB) for local API server
+UPLOAD_LIMIT = 2000 * 1024 * 1024 if TELEGRAM_API_URL else 50 * 1024 * 1024
+# A Bot API server on this machine (started with --local) can read files by path,
+# which skips the HTTP upload entirely
+TELEGRAM_LOCAL_MODE = bool(TELEGRAM_API_URL) and os.getenv(
+    'TELEGRAM_LOCAL_MODE',
+    str(urllib.parse.urlparse(TELEGRAM_API_URL or '').hostname in ('localhost', '127.0.0.1', '::1'))
+).lower() == 'true'
+# Streaming mode: pipe direct links straight into the upload instead of downloading to disk
+STREAM_UPLOAD = os.getenv('STREAM_UPLOAD', 'false').lower() == 'true'
+STREAM_BUFFER_MB = int(os.getenv('STREAM_BUFFER_MB', 8))
+# Download engine for direct links: 'native' (segmented, built-in) or 'ytdlp' (yt-dlp + aria2c)
+DOWNLOAD_ENGINE = os.getenv('DOWNLOAD_ENGINE', 'native').lower()
+DOWNLOAD_SEGMENTS = int(os.getenv('DOWNLOAD_SEGMENTS', 8))
+# Hedged resolver: delay before the next candidate joins the race, and overall time budget
+RESOLVE_STAGGER = float(os.getenv('RESOLVE_STAGGER', 1.0))
+RESOLVE_DEADLINE = float(os.getenv('RESOLVE_DEADLINE', 45))
+DOWNLOAD_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
 if not CLOUD_CHANNEL_ID:
     logger.warning("⚠️ CLOUD_CHANNEL_ID is not set in .env! Videos will NOT be uploaded to a channel.")
 
@@ -56,8 +106,69 @@ if HTTPS_PROXY:
 db = Database()
 
 # Concurrency Control
-MAX_CONCURRENT_DOWNLOADS = 2
-download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Every pipeline stage has its own limit, plus a bounded handoff queue in front of it
+RESOLVE_WORKERS = int(os.getenv('RESOLVE_WORKERS', 4))
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 2))
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', 1))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))
+STREAM_WORKERS = int(os.getenv('STREAM_WORKERS', 2))
+STAGE_QUEUE_SIZE = int(os.getenv('STAGE_QUEUE_SIZE', 2))
+# Optional re-encode of files between UPLOAD_LIMIT and COMPRESS_CEILING_MB so they fit
+COMPRESS_OVERSIZE = os.getenv('COMPRESS_OVERSIZE', 'false').lower() == 'true'
+COMPRESS_CEILING = int(os.getenv('COMPRESS_CEILING_MB', UPLOAD_LIMIT * 4 // (1024 * 1024))) * 1024 * 1024
+COMPRESS_WORKERS = int(os.getenv('COMPRESS_WORKERS', 1))
+COMPRESS_THREADS = int(os.getenv('COMPRESS_THREADS', 0))  # 0 lets ffmpeg decide
+COMPRESS_PRESET = os.getenv('COMPRESS_PRESET', 'veryfast')
+COMPRESS_ATTEMPTS = int(os.getenv('COMPRESS_ATTEMPTS', 3))
+# Optional stream-copy split of files over UPLOAD_LIMIT (that are not compressed) into parts
+SPLIT_OVERSIZE = os.getenv('SPLIT_OVERSIZE', 'false').lower() == 'true'
+SPLIT_MAX_PARTS = int(os.getenv('SPLIT_MAX_PARTS', 20))
+SPLIT_WORKERS = int(os.getenv('SPLIT_WORKERS', 1))
+# Parts uploaded to the cloud channel at once
+PART_UPLOAD_CONCURRENCY = int(os.getenv('PART_UPLOAD_CONCURRENCY', 3))
+# Jobs admitted from the persistent queue into the pipeline at once
+MAX_ACTIVE_JOBS = int(os.getenv(
+    'MAX_ACTIVE_JOBS',
+    RESOLVE_WORKERS + MAX_CONCURRENT_DOWNLOADS + TRANSCODE_WORKERS + UPLOAD_WORKERS + STREAM_WORKERS
+    + (COMPRESS_WORKERS if COMPRESS_OVERSIZE else 0)
+    + (SPLIT_WORKERS if SPLIT_OVERSIZE else 0)
+))
+job_queue = JobQueue(db, workers=MAX_ACTIVE_JOBS)
+# Disk space admission: jobs reserve their peak use of downloads/ before downloading
+disk_budget = DiskBudget(
+    "downloads",
+    max_bytes=int(os.getenv('DISK_BUDGET_MB', 0)) * 1024 * 1024,
+    margin=int(os.getenv('DISK_RESERVE_MB', 512)) * 1024 * 1024,
+)
+# Reserved for downloads whose size is not known up front (HLS)
+DISK_UNKNOWN_SIZE = int(os.getenv('DISK_UNKNOWN_SIZE_MB', 1024)) * 1024 * 1024
+# Shared keep-alive client for every outbound call: resolver, thumbnails, downloads,
+# streaming uploads and the gateway. Per host, room for all download segments at once
+http_pool = HttpPool(
+    max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', 100)),
+    per_host=int(os.getenv('HTTP_PER_HOST', max(10, DOWNLOAD_SEGMENTS * MAX_CONCURRENT_DOWNLOADS))),
+    timeout=float(os.getenv('HTTP_TIMEOUT', 30)),
+)
+native_downloader = SegmentedDownloader(http_pool, segments=DOWNLOAD_SEGMENTS)
+resolver_stats = CandidateStats()
+# All progress edits go through one coalescing, rate-limited sender
+progress = ProgressDispatcher(
+    global_rate=float(os.getenv('PROGRESS_GLOBAL_RATE', 20)),
+    chat_interval=float(os.getenv('PROGRESS_CHAT_INTERVAL', 1)),
+    message_interval=float(os.getenv('PROGRESS_INTERVAL', 5)),
+)
+broadcaster = Broadcaster(
+    db,
+    rate=float(os.getenv('BROADCAST_RATE', 25)),
+    concurrency=int(os.getenv('BROADCAST_CONCURRENCY', 10)),
+)
+# TeraBox accounts; TERABOX_COOKIE seeds the pool on first start
+cookie_pool = CookiePool(
+    db,
+    strategy=os.getenv('COOKIE_STRATEGY', 'healthiest').lower(),
+    cooldown=float(os.getenv('COOKIE_COOLDOWN', 600)),
+    max_failures=int(os.getenv('COOKIE_MAX_FAILURES', 3)),
+)
 
 # Regex pattern for TeraBox links
 TERABOX_PATTERN = r"https?://(?:www\.)?(?:1024tera|1024terabox|terabox|teraboxapp|teraboxshare|mirrobox|nephobox|freeterabox|4funbox|momerybox|tibibox|terasharelink)\.com/(?:s/|.*?surl=)([a-zA-Z0-9_-]+)"
@@ -74,36 +185,56 @@ def get_progress_bar(percentage, length=15):
         return '⬜️' * length
 
 class ProgressFileReader:
-    """Helper to track file upload progress."""
+    """
+    Upload source that tracks progress without copying the file in Python.
+    python-telegram-bot calls read() once and hands the result to httpx, which streams
+    any file-like object in 64KB pieces. So read() without a size returns a stream over
+    the mmapped file that gives out memoryview slices (no bytes objects), and progress
+    is reported as httpx actually consumes the data.
+    """
     def __init__(self, filename, callback):
+        self.name = filename  # Lets the upload carry the real filename and mimetype
         self._file = open(filename, 'rb')
         self._callback = callback
         self._total_size = os.path.getsize(filename)
-        self._read_so_far = 0
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._total_size else None
+        self._view = memoryview(self._map) if self._map else memoryview(b'')
+        self._position = 0
         self._last_update_time = 0
 
     def read(self, size=-1):
-        # Read larger chunks for better speed
-        if size == -1:
-            data = self._file.read()
-        else:
-            # Buffer size optimization: Read at least 64KB chunks
-            read_size = max(size, 64 * 1024)
-            data = self._file.read(read_size)
-            
-        self._read_so_far += len(data)
-        
+        if size is None or size < 0:
+            return _MappedStream(self)
+        data = self._view[self._position:self._position + size]
+        self._position += len(data)
+
         # Throttle updates to avoid flood wait
         now = time.time()
-        if now - self._last_update_time > 5 or self._read_so_far == self._total_size:
+        if self._callback and (now - self._last_update_time > 5 or self._position == self._total_size):
             self._last_update_time = now
-            self._callback(self._read_so_far, self._total_size)
-            
+            self._callback(self._position, self._total_size)
+
         return data
 
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: self._total_size}[whence]
+        self._position = min(max(base + offset, 0), self._total_size)
+        return self._position
+
+    def tell(self):
+        return self._position
+
     def close(self):
         if self._file:
+            self._view.release()
+            if self._map:
+                try:
+                    self._map.close()
+                except BufferError:
+                    # A slice is still referenced somewhere; the map goes with it
+                    pass
             self._file.close()
+            self._file = None
 
     def __enter__(self):
         return self
@@ -111,8 +242,15 @@ class ProgressFileReader:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+class _MappedStream:
+    """What ProgressFileReader.read() hands to the HTTP client: reads, seeks and tells on the reader."""
+    def __init__(self, reader):
+        self.read = reader.read
+        self.seek = reader.seek
+        self.tell = reader.tell
+
 # Dictionary to store active downloads for cancellation
-# Format: {user_id: {"process": subprocess_object, "cancelled": boolean, "task": asyncio_task}}
+# Format: {job_id: {"cancelled": boolean}}
 active_downloads = {}
 
 async def cancel_download(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -123,74 +261,74 @@ async def cancel_download(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not data.startswith("cancel_"):
         return
         
-    user_id = int(data.split("_")[1])
+    parts = data.split("_")
+    user_id = int(parts[1])
+    job_id = parts[2] if len(parts) > 2 else None
     
     # Verify if the user clicking is the one who initiated
     if update.effective_user.id != user_id:
         await query.answer("❌ You cannot cancel this download.", show_alert=True)
         return
 
-    if user_id in active_downloads:
-        active_downloads[user_id]["cancelled"] = True
+    # Keep a queued progress edit from overwriting the answer
+    progress.discard(query.message.chat_id, query.message.message_id)
+    result = await job_queue.cancel(job_id, user_id) if job_id else None
+    if result == "removed":
+        await query.edit_message_text("🚫 <b>Removed from queue.</b>", parse_mode='HTML')
+    elif result == "handed_over":
+        # Others asked for the same file: only this requester leaves, the job goes on
+        take_over_job(job_queue.active[job_id])
+        await query.edit_message_text("🚫 <b>Download Cancelled by User.</b>", parse_mode='HTML')
+    elif result == "stopping":
+        if job_id in active_downloads:
+            active_downloads[job_id]["cancelled"] = True
         await query.edit_message_text("🚫 <b>Download Cancelled by User.</b>", parse_mode='HTML')
         # The download function checks this flag and stops
     else:
         await query.edit_message_text("⚠️ <b>Download already finished or not found.</b>", parse_mode='HTML')
+
+def take_over_job(job):
+    """Tell the waiter that became the requester of a job; progress now goes to their message."""
+    position = job_queue.position(job["job_id"])
+    if position:
+        job["position"] = position
+        text = queue_position_text(position)
+    else:
+        text = "⏳ <b>Processing your video...</b>\nThe previous requester cancelled, you will receive it as soon as it's ready."
+    progress.update(job["chat_id"], job["status_message_id"], text, cancel_keyboard(job))
+
 class ProgressHook:
-    def __init__(self, bot, chat_id, message_id, user_id):
+    def __init__(self, bot, job):
         self.bot = bot
-        self.chat_id = chat_id
-        self.message_id = message_id
-        self.user_id = user_id
-        self.last_update = 0
-        try:
-            self.loop = asyncio.get_running_loop()
-        except RuntimeError:
-            self.loop = None
+        # Read on every call: a waiter may take the job over while it downloads
+        self.job = job
+        self.job_id = job["job_id"]
 
     def __call__(self, d):
         # Check for cancellation
-        if self.user_id in active_downloads and active_downloads[self.user_id].get("cancelled", False):
+        if self.job_id in active_downloads and active_downloads[self.job_id].get("cancelled", False):
             raise yt_dlp.utils.DownloadError("Download cancelled by user")
 
         if d['status'] == 'downloading':
-            now = time.time()
-            if now - self.last_update > 5:  # Update every 5 seconds (Optimized)
-                self.last_update = now
-                percent = d.get('_percent_str', 'N/A')
-                speed = d.get('_speed_str', 'N/A')
-                eta = d.get('_eta_str', 'N/A')
-                
-                # Create a simple progress bar
-                try:
-                    p = float(percent.replace('%', ''))
-                    bar = get_progress_bar(p)
-                except ValueError:
-                    bar = '⬜️' * 15
-
-                text = (
-                    f"🎬 <b>Downloading Video...</b>\n\n"
-                    f"<b>Progress:</b> {bar} {percent}\n"
-                    f"<b>Speed:</b> {speed} 🚀\n"
-                    f"<b>ETA:</b> {eta} ⏳"
-                )
-                
-                # Cancel Button
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_{self.user_id}")]
-                ])
-
-                if self.loop:
-                    asyncio.run_coroutine_threadsafe(
-                        self.bot.edit_message_text(
-                            chat_id=self.chat_id,
-                            message_id=self.message_id,
-                            text=text,
-                            parse_mode='HTML',
-                            reply_markup=keyboard
-                        ),
-                        self.loop
-                    )
+            percent = d.get('_percent_str', 'N/A')
+            speed = d.get('_speed_str', 'N/A')
+            eta = d.get('_eta_str', 'N/A')
+            
+            # Create a simple progress bar
+            try:
+                p = float(percent.replace('%', ''))
+                bar = get_progress_bar(p)
+            except ValueError:
+                bar = '⬜️' * 15
+
+            text = (
+                f"🎬 <b>Downloading Video...</b>\n\n"
+                f"<b>Progress:</b> {bar} {percent}\n"
+                f"<b>Speed:</b> {speed} 🚀\n"
+                f"<b>ETA:</b> {eta} ⏳"
+            )
+            # Coalesced and throttled by the dispatcher; may be called from yt-dlp's thread
+            progress.update(self.job["chat_id"], self.job["status_message_id"], text, cancel_keyboard(self.job))
 
 def get_progress_bar(percent):
     """Generates a visual progress bar."""
@@ -199,39 +337,6 @@ def get_progress_bar(percent):
     bar = '⬛️' * filled_len + '⬜️' * (bar_len - filled_len)
     return bar
 
-def transcode_to_target_size(input_path, target_mb, duration, width=None, height=None):
-    try:
-        target_bits = int(target_mb * 1024 * 1024 * 8)
-        if not duration or duration <= 0:
-            duration = 600
-        total_bitrate = max(int(target_bits / duration), 300000)
-        audio_bitrate = 96000
-        video_bitrate = max(total_bitrate - audio_bitrate, 200000)
-        output_path = os.path.splitext(input_path)[0] + ".compressed.mp4"
-        vf = None
-        if width and height:
-            vf = "scale='min(1280,iw)':min(720,ih):force_original_aspect_ratio=decrease"
-        cmd = [
-            'ffmpeg', '-y', '-i', input_path,
-            '-c:v', 'libx264', '-preset', 'veryfast',
-            '-b:v', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2),
-            '-c:a', 'aac', '-b:a', str(audio_bitrate),
-            '-movflags', '+faststart'
-        ]
-        if vf:
-            cmd.extend(['-vf', vf])
-        cmd.append(output_path)
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode == 0 and os.path.exists(output_path):
-            return output_path
-        else:
-            try:
-                logger.error(result.stderr.decode())
-            except Exception:
-                pass
-    except Exception as e:
-        logger.error(f"Transcode error: {e}")
-    return None
 def get_proxy_url(file_id):
     """
     Generates the worker URL for the proxy using XOR + Base64 encoding.
@@ -245,7 +350,13 @@ def get_proxy_url(file_id):
     encoded_id = base64.b64encode(xor_bytes).decode('utf-8')
     return f"https://icy-broor12.arjunavai273.workers.dev/?id={encoded_id}"
 
-def get_video_info_from_proxy(file_id):
+PROXY_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Referer": "https://terabox.beer/",
+    "Origin": "https://terabox.beer"
+}
+
+async def get_video_info_from_proxy(file_id):
     """
     Tries to get video info using the proxy.
     Returns dict or None.
@@ -257,26 +368,27 @@ def get_video_info_from_proxy(file_id):
         
     for fid in ids_to_try:
         url = get_proxy_url(fid)
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Referer": "https://terabox.beer/",
-            "Origin": "https://terabox.beer"
-        }
+        headers = PROXY_HEADERS
         try:
-            # Use stream=True to avoid downloading the whole m3u8 if it's huge (unlikely)
-            # but mainly to just check headers first if we wanted.
+            # Stream so only the headers and the first bytes are read.
             # Here we just want the final URL and validity.
-            response = requests.get(url, headers=headers, allow_redirects=True, timeout=10)
-            
-            if response.status_code == 200:
+            async with http_pool.stream("GET", url, headers=headers, follow_redirects=True, timeout=10) as response:
+                if response.status_code != 200:
+                    continue
                 # Check content type or content
                 c_type = response.headers.get('Content-Type', '')
+                head = b''
+                if 'mpegurl' not in c_type.lower():
+                    async for chunk in response.aiter_bytes():
+                        head += chunk
+                        if len(head) >= 50:
+                            break
                 # M3U8 is usually application/vnd.apple.mpegurl or application/x-mpegURL
-                if 'mpegurl' in c_type.lower() or '#EXTM3U' in response.text[:50]:
+                if 'mpegurl' in c_type.lower() or b'#EXTM3U' in head[:50]:
                     return {
                         'title': f'Terabox Video {fid}',
                         'thumbnail': None,
-                        'url': response.url,  # The final redirected URL (likely direct stream)
+                        'url': str(response.url),  # The final redirected URL (likely direct stream)
                         'is_proxy': True,
                         'size': 0 # Unknown size
                     }
@@ -285,31 +397,37 @@ def get_video_info_from_proxy(file_id):
             
     return None
 
-def get_video_info(terabox_url):
+async def get_video_info(terabox_url, cookie):
     """
-    Extracts the video info (url, title, thumbnail) using terabox-downloader.
+    Extracts the video info (url, title, thumbnail) from the share page,
+    using `cookie` from the cookie pool.
     """
-    if not TERABOX_COOKIE:
-        logger.error("TERABOX_COOKIE not set.")
+    if not cookie:
+        logger.error("No TeraBox cookie set (TERABOX_COOKIE or /setcookie).")
         return None
 
     try:
-        terabox = TeraboxDL(TERABOX_COOKIE)
-        file_info = terabox.get_file_info(terabox_url)
+        file_info = await terabox.get_file_info(http_pool, terabox_url, cookie["cookie"])
         
         if "error" in file_info:
-            logger.error(f"TeraboxDL error: {file_info['error']}")
+            logger.error(f"TeraBox error: {file_info['error']}")
+            # A bad link says nothing about the account
+            if "Invalid link" not in file_info["error"]:
+                await cookie_pool.report(cookie, ok=False, throttled=is_throttled(file_info["error"]))
             return None
             
         result = {
             'title': file_info.get('file_name', 'TeraBox Video'),
             'thumbnail': file_info.get('thumbnail', None),
             'url': file_info.get('download_link', None),
-            'size': int(file_info.get('size', 0)),
-            'is_proxy': False
+            'size': int(file_info.get('size_bytes', 0)),
+            'is_proxy': False,
+            # Download links are bound to the account that resolved them
+            'cookie_id': cookie["cookie_id"],
         }
         
         if result['url']:
+            await cookie_pool.report(cookie, ok=True)
             return result
             
     except Exception as e:
@@ -317,30 +435,48 @@ def get_video_info(terabox_url):
     
     return None
 
-async def get_video_info_multi(file_id, original_url, status_msg=None, context=None, chat_id=None):
+async def job_cookie(job):
+    """The pool cookie that resolved the job's link, or the next one from the pool."""
+    return cookie_pool.get(job["video_info"].get("cookie_id")) or await cookie_pool.acquire()
+
+def cookie_headers(cookie):
+    """Request headers for fetching a TeraBox direct link."""
+    headers = {"User-Agent": DOWNLOAD_USER_AGENT}
+    if cookie:
+        headers["Cookie"] = cookie["cookie"]
+    return headers
+
+def resolver_host(url):
+    """Key under which a host variant's success is remembered ('proxy' for the proxy)."""
+    return urllib.parse.urlparse(url).netloc.lower() if url else "proxy"
+
+async def get_video_info_multi(file_id, original_url, bot=None, chat_id=None, message_id=None):
     """
     Resilient resolver: tries multiple host variants and retries on timeouts.
-    Prioritizes original_url, then falls back to standard domains.
+    Results are cached per file_id (in memory and in MongoDB, shared by all replicas),
+    and the host variant that worked last time is tried first.
     """
-    # 1. Try external proxy first (fastest and requested by user)
-    try:
-        if status_msg and context:
-             try:
-                await context.bot.edit_message_text(
-                    chat_id=chat_id, 
-                    message_id=status_msg.message_id, 
-                    text=f"🔍 <b>Analyzing Link...</b>\nChecking proxy server...", 
-                    parse_mode='HTML'
-                )
-             except Exception:
-                pass
-        
-        info = await asyncio.to_thread(get_video_info_from_proxy, file_id)
+    with tracing.span("resolve") as span:
+        started = time.monotonic()
+        info, preferred_host = await db.get_resolved(file_id)
         if info:
+            logger.info(f"Resolver cache hit for {file_id}")
+            metrics.RESOLVE_SECONDS.observe(time.monotonic() - started, result="cached")
+            span["result"] = "cached"
             return info
-    except Exception as e:
-        logger.error(f"Proxy attempt failed: {e}")
 
+        info, host = await resolve_video_info(file_id, original_url, preferred_host, bot, chat_id, message_id)
+        metrics.RESOLVE_SECONDS.observe(time.monotonic() - started, result="resolved" if info else "failed")
+        span.update(result="resolved" if info else "failed", host=host)
+        if info:
+            await db.set_resolved(file_id, info, host)
+        return info
+
+async def resolve_video_info(file_id, original_url, preferred_host=None, bot=None, chat_id=None, message_id=None):
+    """
+    Races the proxy, original_url and the standard domains (hedged, see hedged_race).
+    Returns (info, host) or (None, None).
+    """
     # Prioritize the original URL first
     candidates = [original_url]
     
@@ -355,33 +491,68 @@ async def get_video_info_multi(file_id, original_url, status_msg=None, context=N
         if fb != original_url:
             candidates.append(fb)
 
-    # Limit retries to avoid long waits
-    for idx, url in enumerate(candidates):
-        # Notify user if switching to fallbacks (only if it takes too long)
-        if idx > 0 and status_msg and context:
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=chat_id, 
-                    message_id=status_msg.message_id, 
-                    text=f"🔍 <b>Analyzing Link...</b>\nTrying alternative source {idx}/{len(candidates)-1}...", 
-                    parse_mode='HTML'
-                )
-            except Exception:
-                pass
+    # One account per resolution, so a throttled cookie is not hit by every candidate
+    cookie = await cookie_pool.acquire()
 
-        # Try twice per URL (1s backoff)
-        for attempt in range(1, 3):
-            # Run blocking get_video_info in executor to avoid blocking asyncio loop
-            info = await asyncio.to_thread(get_video_info, url)
-            
-            if info and info.get('url'):
-                return info
-            
-            # Short sleep between attempts
-            if attempt < 2:
-                await asyncio.sleep(1)
+    async def try_host(url):
+        info = await get_video_info(url, cookie)
+        return info if info and info.get('url') else None
 
-    return None
+    sources = {"proxy": functools.partial(get_video_info_from_proxy, file_id)}
+    for url in candidates:
+        sources.setdefault(resolver_host(url), functools.partial(try_host, url))
+    # Every attempt is its own span; losers of the race end as "cancelled"
+    sources = {key: functools.partial(traced_source, key, source) for key, source in sources.items()}
+
+    # Last winner for this share first, then by observed latency / success rate
+    order = resolver_stats.order(sources, preferred_host)
+
+    if bot and message_id:
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id, 
+                message_id=message_id, 
+                text=f"🔍 <b>Analyzing Link...</b>\nChecking {len(order)} sources...", 
+                parse_mode='HTML'
+            )
+        except Exception:
+            pass
+
+    host, info = await hedged_race(
+        [(key, sources[key]) for key in order],
+        stagger=RESOLVE_STAGGER,
+        deadline=RESOLVE_DEADLINE,
+        stats=resolver_stats,
+    )
+    return info, host
+
+async def traced_source(host, source):
+    with tracing.span("resolve.attempt", host=host) as span:
+        info = await source()
+        span["found"] = bool(info)
+        return info
+
+async def gateway_source(file_id, refresh=False):
+    """Upstream (url, headers, is_hls) the streaming gateway serves for a TeraBox file."""
+    if refresh:
+        await db.invalidate_resolved(file_id)
+    info = await get_video_info_multi(file_id, f"https://terabox.com/s/{file_id}")
+    if not info or not info.get('url'):
+        return None, None, False
+    if info.get('is_proxy'):
+        headers = PROXY_HEADERS
+    else:
+        headers = cookie_headers(cookie_pool.get(info.get('cookie_id')) or await cookie_pool.acquire())
+    return info['url'], headers, is_hls(info)
+
+def is_hls(video_info):
+    return bool(video_info.get('is_proxy')) or '.m3u8' in (video_info.get('url') or '').lower()
+
+def stream_link(file_id, video_info):
+    """Link for playing a file outside Telegram: through the gateway if it runs, else upstream."""
+    if ENABLE_WEB_SERVER:
+        return gateway.stream_url(file_id, is_hls(video_info))
+    return video_info.get('url') or get_proxy_url(file_id)
 
 def vps_limit_note():
     if not ENABLE_WEB_SERVER:
@@ -395,7 +566,7 @@ def vps_limit_note():
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     # Save user to DB
-    is_new_user = db.add_user(user.id, user.first_name, user.username)
+    is_new_user = await db.add_user(user.id, user.first_name, user.username)
     
     if is_new_user and LOG_CHANNEL_ID:
         try:
@@ -434,14 +605,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
     await update.message.reply_text(help_text, parse_mode='HTML')
 
-async def download_video(url, output_template, progress_hook):
+async def download_video(url, output_template, progress_hook, cookie=None):
     """Runs yt-dlp in a separate thread to avoid blocking asyncio loop."""
     ydl_opts = {
         'outtmpl': output_template,
         'format': 'best',
         'noplaylist': True,
         'quiet': True,
-        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'user_agent': DOWNLOAD_USER_AGENT,
         'progress_hooks': [progress_hook],
         'socket_timeout': 120,  # Increase timeout
         'retries': 20,        # Retry on 5xx or timeout
@@ -464,69 +635,78 @@ async def download_video(url, output_template, progress_hook):
         },
     }
     
-    # Handle Cookies safely (Fix: Write to Netscape format file)
-    cookie_file_path = None
-    if TERABOX_COOKIE:
+    # Handle Cookies safely (Netscape format file, written once per pool cookie)
+    if cookie:
         try:
-            # Create temp cookie file
-            fd, cookie_file_path = tempfile.mkstemp(suffix='.txt', text=True)
-            with os.fdopen(fd, 'w') as f:
-                f.write("# Netscape HTTP Cookie File\n")
-                f.write("# This file is generated by the bot.\n\n")
-                
-                # Parse the cookie string
-                cookie = SimpleCookie()
-                cookie.load(TERABOX_COOKIE)
-                
-                for key, morsel in cookie.items():
-                    # domain flag path secure expiration name value
-                    f.write(f".terabox.com\tTRUE\t/\tFALSE\t2147483647\t{key}\t{morsel.value}\n")
-            
-            ydl_opts['cookiefile'] = cookie_file_path
+            ydl_opts['cookiefile'] = cookie_pool.cookie_file(cookie)
         except Exception as e:
             logger.error(f"Failed to create cookie file: {e}")
             # Fallback to header (will show warning but work)
-            ydl_opts['http_headers'] = {'Cookie': TERABOX_COOKIE}
+            ydl_opts['http_headers'] = {'Cookie': cookie["cookie"]}
     
     loop = asyncio.get_running_loop()
     
     def run_yt_dlp():
-        try:
+        with tracing.span("download.ytdlp", downloader="aria2c") as span:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 info = ydl.extract_info(url, download=True)
                 filename = ydl.prepare_filename(info)
-                
-                # Manual FastStart (Force moov atom to front)
-                try:
-                    if filename.endswith('.mp4'):
-                        faststart_filename = filename + ".temp.mp4"
-                        logger.info(f"Running FastStart on {filename}...")
-                        
-                        # Run ffmpeg command
-                        result = subprocess.run(
-                            ['ffmpeg', '-y', '-i', filename, '-c', 'copy', '-movflags', '+faststart', faststart_filename],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
-                        )
-                        
-                        if result.returncode == 0 and os.path.exists(faststart_filename):
-                            os.replace(faststart_filename, filename)
-                            logger.info("FastStart complete.")
-                        else:
-                            logger.error(f"FastStart failed: {result.stderr.decode()}")
-                except Exception as e:
-                    logger.error(f"FastStart exception: {e}")
+            if os.path.exists(filename):
+                span["bytes"] = os.path.getsize(filename)
+            return filename, info
 
-                return filename, info
-        finally:
-            # Cleanup cookie file
-            if cookie_file_path and os.path.exists(cookie_file_path):
-                try:
-                    os.remove(cookie_file_path)
-                except:
-                    pass
+    # The executor thread does not inherit the job's trace context by itself
+    return await loop.run_in_executor(None, tracing.in_context(run_yt_dlp))
 
-    return await loop.run_in_executor(None, run_yt_dlp)
+def faststart(filename):
+    """
+    Manual FastStart (Force moov atom to front). Runs in the transcode stage.
+    Skips files that are already FastStart and relocates moov in place when possible;
+    the full ffmpeg remux is only the fallback.
+    """
+    # Runs in a worker thread (asyncio.to_thread), which carries the job's trace context
+    with tracing.span("faststart") as span:
+        started = time.monotonic()
+        span["method"] = method = _faststart(filename)
+        metrics.FASTSTART_SECONDS.observe(time.monotonic() - started, method=method)
+
+def _faststart(filename):
+    """Returns how it went: skipped, in_place, ffmpeg or failed."""
+    try:
+        if filename.endswith('.mp4'):
+            try:
+                if mp4.is_faststart(filename):
+                    logger.info(f"FastStart not needed for {filename}, moov already in front.")
+                    return "skipped"
+                if mp4.relocate_moov(filename):
+                    logger.info(f"FastStart complete (in place) for {filename}.")
+                    return "in_place"
+            except Exception as e:
+                logger.warning(f"In-place FastStart failed, falling back to ffmpeg: {e}")
+
+            faststart_filename = filename + ".temp.mp4"
+            logger.info(f"Running FastStart on {filename}...")
+            
+            # Run ffmpeg command
+            result = subprocess.run(
+                ['ffmpeg', '-y', '-i', filename, '-c', 'copy', '-movflags', '+faststart', faststart_filename],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            
+            if result.returncode == 0 and os.path.exists(faststart_filename):
+                os.replace(faststart_filename, filename)
+                logger.info("FastStart complete.")
+                return "ffmpeg"
+            else:
+                logger.error(f"FastStart failed: {result.stderr.decode()}")
+                if os.path.exists(faststart_filename):
+                    os.remove(faststart_filename)
+                return "failed"
+    except Exception as e:
+        logger.error(f"FastStart exception: {e}")
+        return "failed"
+    return "skipped"
 
 # Admin Commands
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -534,8 +714,35 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if user.id != ADMIN_ID:
         return
 
-    users = db.get_all_users()
-    await update.message.reply_text(f"📊 <b>Total Users:</b> {len(users)}", parse_mode='HTML')
+    stats = await db.get_stats()
+    cache = db.video_cache_info()
+    queue = job_queue.stats()
+    stages = " | ".join(
+        f"{name}: {s['active']}/{s['concurrency']} (+{s['queued']})" for name, s in pipeline.stats().items()
+    )
+    if stats:
+        days = "\n".join(
+            f"<code>{day}</code>: +{stats['new_users'].get(day, 0)} new, {stats['daily_active'].get(day, 0)} active"
+            for day in stats["days"]
+        )
+        users_text = (
+            f"📊 <b>Total Users:</b> {stats['total_users']} ({stats['inactive_users']} inactive)\n"
+            f"🎬 <b>Cached Videos:</b> {stats['cached_videos']}\n\n"
+            f"📈 <b>Last {len(stats['days'])} Days (UTC):</b>\n{days}\n\n"
+        )
+    else:
+        users_text = "📊 <b>User stats unavailable</b> (database error).\n\n"
+    await update.message.reply_text(
+        f"{users_text}"
+        f"📥 <b>Queue:</b> {queue['queued']} waiting ({queue['users']} users) | {queue['running']}/{queue['workers']} running\n"
+        f"⚙️ <b>Stages:</b> {stages}\n"
+        f"💽 <b>Disk:</b> {disk_budget.reserved() / 1024 ** 3:.2f} / {disk_budget.capacity() / 1024 ** 3:.2f} GB reserved"
+        f" | {len(disk_budget.waiting)} jobs waiting\n\n"
+        f"⚡️ <b>Video Cache:</b> {cache['size']} entries\n"
+        f"<b>Hits:</b> {cache['hits']} | <b>Negative Hits:</b> {cache['negative_hits']} | <b>Misses:</b> {cache['misses']}\n"
+        f"<b>Hit Ratio:</b> {cache['hit_ratio'] * 100:.1f}%",
+        parse_mode='HTML'
+    )
 
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -548,25 +755,39 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     broadcast_msg = message[1]
-    users = db.get_all_users()
-    sent_count = 0
-
-    status_msg = await update.message.reply_text(f"📣 <b>Broadcasting to {len(users)} users...</b>", parse_mode='HTML')
-
-    for user_id in users:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=broadcast_msg, parse_mode='HTML')
-            sent_count += 1
-            await asyncio.sleep(0.1) # Avoid flood limits
-        except Exception:
-            pass
-    
-    await context.bot.edit_message_text(
-        chat_id=user.id,
-        message_id=status_msg.message_id,
-        text=f"✅ <b>Broadcast Complete!</b>\n\nSent to {sent_count}/{len(users)} users.",
-        parse_mode='HTML'
+    status_msg = await update.message.reply_text("📣 <b>Starting broadcast...</b>", parse_mode='HTML')
+    # Runs in the background; progress is shown in status_msg
+    await broadcaster.create(broadcast_msg, user.id, status_msg.message_id)
+
+async def broadcast_progress(bot, broadcast, finished):
+    """Show broadcast progress in the admin's status message."""
+    done = broadcast["sent"] + broadcast["blocked"] + broadcast["failed"]
+    counts = (
+        f"✅ Sent: {broadcast['sent']}\n"
+        f"🚫 Blocked: {broadcast['blocked']}\n"
+        f"⚠️ Failed: {broadcast['failed']}"
     )
+    chat_id, message_id = broadcast["admin_chat_id"], broadcast["status_message_id"]
+    if finished:
+        progress.discard(chat_id, message_id)
+        if broadcast["status"] == "failed":
+            title = f"❌ <b>Broadcast Failed</b> after {done} users.\nSee the logs for details."
+        else:
+            title = "✅ <b>Broadcast Complete!</b>"
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=f"{title}\n\n{counts}",
+            parse_mode='HTML'
+        )
+    else:
+        total = max(broadcast["total"], done)
+        percent = done / total * 100 if total else 100
+        progress.update(
+            chat_id, message_id,
+            f"📣 <b>Broadcasting...</b>\n\n"
+            f"<b>Progress:</b> {get_progress_bar(percent)} {done}/{total}\n\n{counts}"
+        )
 
 async def admin_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -583,13 +804,13 @@ async def admin_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     # Check if ID starts with '1', if user forgot it but provided the rest
     # (Though we shouldn't guess too much for deletion to be safe, exact match is better)
     
-    if db.delete_video(terabox_id):
+    if await db.delete_video(terabox_id):
         await update.message.reply_text(f"✅ <b>Deleted:</b> <code>{terabox_id}</code> from database.", parse_mode='HTML')
     else:
         await update.message.reply_text(f"❌ <b>Not Found:</b> <code>{terabox_id}</code> in database.", parse_mode='HTML')
 
 async def admin_set_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Dynamically update the TeraBox cookie."""
+    """Add a TeraBox cookie to the pool (or reset an existing one to full health)."""
     user = update.effective_user
     if user.id != ADMIN_ID:
         return
@@ -600,12 +821,49 @@ async def admin_set_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     new_cookie = message[1].strip()
+    cookie_id = await cookie_pool.add(new_cookie)
     
-    # Update global variable
-    global TERABOX_COOKIE
-    TERABOX_COOKIE = new_cookie
-    
-    await update.message.reply_text("✅ <b>Cookie Updated!</b>\n\nNote: This change is temporary and will reset on restart unless you update .env file.", parse_mode='HTML')
+    await update.message.reply_text(
+        f"✅ <b>Cookie Added!</b>\n\n🆔 <code>{cookie_id}</code>\n"
+        f"The pool now has {len(cookie_pool.cookies)} cookies (saved in the database).",
+        parse_mode='HTML'
+    )
+
+async def admin_cookies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """List the cookie pool with health and cooldown state."""
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        return
+
+    await cookie_pool.refresh()
+    if not cookie_pool.cookies:
+        await update.message.reply_text("🍪 <b>Cookie pool is empty.</b>\nAdd one with /setcookie.", parse_mode='HTML')
+        return
+
+    now = time.time()
+    lines = []
+    for doc in sorted(cookie_pool.cookies.values(), key=cookie_pool.score, reverse=True):
+        state = f"❄️ {int(doc['cooldown_until'] - now)}s" if doc["cooldown_until"] > now else "✅"
+        speed = f"{doc['speed'] / 1024 / 1024:.1f} MB/s" if doc.get("speed") else "-"
+        lines.append(f"<code>{doc['cookie_id']}</code> {state} health {doc['health']:.2f}, {speed}")
+    await update.message.reply_text("🍪 <b>Cookie Pool</b>\n\n" + "\n".join(lines), parse_mode='HTML')
+
+async def admin_delete_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remove a cookie from the pool."""
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        return
+
+    message = update.message.text.split(' ', 1)
+    if len(message) < 2:
+        await update.message.reply_text("⚠️ <b>Usage:</b> /delcookie <cookie_id>", parse_mode='HTML')
+        return
+
+    cookie_id = message[1].strip()
+    if await cookie_pool.remove(cookie_id):
+        await update.message.reply_text(f"✅ <b>Deleted cookie:</b> <code>{cookie_id}</code>", parse_mode='HTML')
+    else:
+        await update.message.reply_text(f"❌ <b>Not Found:</b> <code>{cookie_id}</code> in the pool.", parse_mode='HTML')
 
 async def handle_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
@@ -613,7 +871,7 @@ async def handle_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYPE
     user = update.effective_user
     
     # Save user to DB on interaction
-    db.add_user(user.id, user.first_name, user.username)
+    await db.add_user(user.id, user.first_name, user.username)
 
     # Check for TeraBox link
     match = re.search(TERABOX_PATTERN, text, re.IGNORECASE)
@@ -644,20 +902,28 @@ async def handle_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Many domains (teraboxshare, 1024tera, etc.) share the same ID structure
     # Do not force a single host; try multiple hosts for resilience
     # terabox_url remains the original URL the user sent
-    
+
+    # The trace id is stored with the job, so its spans line up with this request's
+    with tracing.job_context(tracing.new_trace_id(), user_id=user.id, file_id=file_id):
+        with tracing.span("request", chat_id=message.chat_id) as span:
+            await request_video(context.bot, message, user, terabox_url, file_id, span)
+
+async def request_video(bot, message, user, terabox_url, file_id, span):
+    """Answer from the cache, join the active job for the file, or queue a new job."""
     # Check if video exists in DB
-    cached_video = db.get_video(file_id)
+    cached_video = await db.get_video(file_id)
     if cached_video:
-        telegram_file_id, cached_title = cached_video
+        telegram_file_ids, cached_title = cached_video
         logger.info(f"Video found in cache: {file_id}")
         
         try:
-            # Send cached video
-            await message.reply_video(
-                video=telegram_file_id, 
-                caption=f"🎬 <b>{cached_title}</b>\n\n⚡️ <i>Fast delivered from Cloud</i>", 
-                parse_mode='HTML'
+            # Send cached video (every part of a split one)
+            await send_video_parts(
+                bot, message.chat_id, telegram_file_ids,
+                caption=f"🎬 <b>{cached_title}</b>\n\n⚡️ <i>Fast delivered from Cloud</i>",
+                reply_to_message_id=message.message_id
             )
+            span["outcome"] = "cached"
             return
         except Exception as e:
             logger.warning(f"Failed to send cached video (might be deleted): {e}")
@@ -667,8 +933,283 @@ async def handle_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Initial status message
     status_msg = await message.reply_text(f"🔍 <b>Analyzing Link...</b>\nPlease wait a moment.", parse_mode='HTML')
 
+    # Single-flight: if the same file is already queued or processing, wait for that job
+    active_job = job_queue.find_active(file_id)
+    if active_job:
+        waiter = {
+            "user_id": user.id,
+            "user_mention": user.mention_html(),
+            "chat_id": message.chat_id,
+            "message_id": message.message_id,
+            "status_message_id": status_msg.message_id,
+        }
+        if await job_queue.add_waiter(active_job, waiter):
+            logger.info(f"Joined active job {active_job['job_id']} for {file_id}")
+            span.update(outcome="joined", job_id=active_job["job_id"])
+            await bot.edit_message_text(
+                chat_id=message.chat_id,
+                message_id=status_msg.message_id,
+                text="⏳ <b>This video is already being processed.</b>\nYou will receive it as soon as it's ready.",
+                parse_mode='HTML'
+            )
+            return
+
+    job = {
+        "user_id": user.id,
+        "user_mention": user.mention_html(),
+        "chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "status_message_id": status_msg.message_id,
+        "file_id": file_id,
+        "terabox_url": terabox_url,
+        "trace_id": tracing.current().get("trace_id"),
+    }
+    position = await job_queue.enqueue(job)
+    span.update(outcome="queued", job_id=job["job_id"], position=position)
+
+    # Still waiting for a worker: show the position in line
+    if position and job["status"] == "queued":
+        job["position"] = position
+        await bot.edit_message_text(
+            chat_id=message.chat_id,
+            message_id=status_msg.message_id,
+            text=queue_position_text(position),
+            parse_mode='HTML',
+            reply_markup=cancel_keyboard(job)
+        )
+
+def queue_position_text(position):
+    return f"📥 <b>Added to queue.</b>\nYou are <b>#{position}</b> in line. ⏳"
+
+def cancel_keyboard(job):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_{job['user_id']}_{job['job_id']}")]
+    ])
+
+async def update_queue_position(bot, job, position):
+    """Called by the job queue when a waiting job moves up in line."""
+    progress.update(job["chat_id"], job["status_message_id"], queue_position_text(position), cancel_keyboard(job))
+
+def iter_recipients(job):
+    """
+    Yield the requester and everyone waiting on the same file.
+    Waiters that join while we are delivering are picked up as well.
+    """
+    yield job
+    index = 0
+    while index < len(job["waiters"]):
+        yield job["waiters"][index]
+        index += 1
+
+async def notify_recipients(bot, job, text, reply_markup=None):
+    """Show a final message in the status message of every recipient."""
+    for recipient in iter_recipients(job):
+        progress.discard(recipient["chat_id"], recipient["status_message_id"])
+        try:
+            await bot.edit_message_text(
+                chat_id=recipient["chat_id"],
+                message_id=recipient["status_message_id"],
+                text=text,
+                parse_mode='HTML',
+                reply_markup=reply_markup
+            )
+        except Exception as e:
+            logger.error(f"Failed to notify {recipient['chat_id']}: {e}")
+
+async def upload_video_file(bot, chat_id, filename, caption, thumb_path=None, width=None, height=None,
+                            duration=None, progress_callback=None, reply_to_message_id=None):
+    """
+    Uploads a local video file and returns its Telegram file_id.
+    With a local Bot API server the file is passed by path instead of being uploaded.
+    """
+    global TELEGRAM_LOCAL_MODE
+
+    async def send(video, thumbnail):
+        return await bot.send_video(
+            chat_id=chat_id,
+            video=video,
+            caption=caption,
+            parse_mode='HTML',
+            read_timeout=300, 
+            write_timeout=300,
+            width=width,
+            height=height,
+            duration=duration,
+            supports_streaming=True,
+            thumbnail=thumbnail,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=True
+        )
+
+    sent_msg = None
+    size = os.path.getsize(filename)
+    if TELEGRAM_LOCAL_MODE:
+        try:
+            with metrics.UPLOAD_SECONDS.time(mode="local"), tracing.span("upload", mode="local", chat_id=chat_id, bytes=size):
+                sent_msg = await send(Path(filename).resolve(), Path(thumb_path).resolve() if thumb_path else None)
+            metrics.UPLOAD_BYTES.inc(size, mode="local")
+            if progress_callback:
+                progress_callback(size, size)
+        except BadRequest as e:
+            # Typically the server runs without --local or cannot see our downloads directory
+            logger.warning(f"Local Bot API server could not read {filename} ({e}); uploading over HTTP from now on.")
+            TELEGRAM_LOCAL_MODE = False
+
+    if sent_msg is None:
+        # Use ProgressFileReader: the file is streamed from an mmap as it is sent
+        with ProgressFileReader(filename, progress_callback) as video_file:
+            thumb_file = open(thumb_path, 'rb') if thumb_path else None
+            try:
+                with metrics.UPLOAD_SECONDS.time(mode="upload"), tracing.span("upload", mode="upload", chat_id=chat_id, bytes=size):
+                    sent_msg = await send(video_file, thumb_file)
+                metrics.UPLOAD_BYTES.inc(size, mode="upload")
+            finally:
+                if thumb_file:
+                    thumb_file.close()
+
+    if sent_msg.video:
+        return sent_msg.video.file_id
+    return None
+
+def part_caption(caption, index, count):
+    return f"{caption}\n\n🧩 <b>Part {index + 1}/{count}</b>" if count > 1 else caption
+
+async def upload_video_files(bot, chat_id, paths, caption, concurrency=1, progress_callback=None, **kwargs):
+    """
+    Uploads a video or the parts of a split one, up to `concurrency` at a time.
+    Returns the Telegram file_ids in part order; raises if any part fails.
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    sent = [0] * len(paths)
+    limit = asyncio.Semaphore(concurrency)
+    if len(paths) > 1:
+        # The duration is the whole video's; let Telegram read each part's
+        kwargs["duration"] = None
+
+    async def upload(index, path):
+        def part_progress(current, total):
+            sent[index] = current
+            if progress_callback:
+                progress_callback(sum(sent), sum(sizes))
+
+        async with limit:
+            telegram_file_id = await upload_video_file(
+                bot, chat_id, path, part_caption(caption, index, len(paths)),
+                progress_callback=part_progress, **kwargs
+            )
+        if not telegram_file_id:
+            raise RuntimeError(f"No video returned for part {index + 1}")
+        return telegram_file_id
+
+    tasks = [asyncio.create_task(upload(index, path)) for index, path in enumerate(paths)]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def send_video_parts(bot, chat_id, telegram_file_ids, caption, reply_to_message_id=None):
+    """Re-send an uploaded video by file_id; parts go out in order as albums of up to 10."""
+    if len(telegram_file_ids) == 1:
+        await bot.send_video(
+            chat_id=chat_id,
+            video=telegram_file_ids[0],
+            caption=caption,
+            parse_mode='HTML',
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=True
+        )
+        return
+
+    count = len(telegram_file_ids)
+    # Albums take 2-10 items: spread the parts evenly instead of leaving a single one at the end
+    albums = -(-count // 10)
+    start = 0
+    for album in range(albums):
+        size = count // albums + (album < count % albums)
+        media = [
+            InputMediaVideo(
+                media=telegram_file_id,
+                caption=part_caption(caption, start + offset, count),
+                parse_mode='HTML'
+            )
+            for offset, telegram_file_id in enumerate(telegram_file_ids[start:start + size])
+        ]
+        start += size
+        await bot.send_media_group(
+            chat_id=chat_id,
+            media=media,
+            reply_to_message_id=reply_to_message_id,
+            allow_sending_without_reply=True
+        )
+
+async def process_job(bot, job):
+    """
+    Runs a queued job through the resolve -> download -> transcode -> upload stages,
+    then cleans up its files. Every step is traced as a span of the job; every
+    PROFILE_EVERY-th job is also profiled.
+    """
+    # Jobs queued before tracing existed have no trace id of their own
+    trace_id = job.get("trace_id") or job["job_id"]
+    with tracing.job_context(trace_id, job_id=job["job_id"], user_id=job["user_id"], file_id=job["file_id"]):
+        with job_profiler.profile(job["job_id"]) as profile_path:
+            with tracing.span("job", attempt=job.get("attempts"), profile=profile_path) as span:
+                await run_job(bot, job, span)
+
+async def run_job(bot, job, span):
+    """process_job within its trace context; failures are recorded on `span`."""
+    # Register download for cancellation
+    active_downloads[job["job_id"]] = {"cancelled": job.get("cancelled", False)}
+    keep_files = False
+
+    try:
+        await pipeline.run(job)
+    except asyncio.CancelledError:
+        # Shutting down: keep the partial file and its journal so the recovered job resumes
+        keep_files = True
+        raise
+    except Exception as e:
+        logger.error(f"Error processing video: {e}")
+        span.update(status="error", error=str(e))
+        # The cached link may be the reason; resolve it again next time
+        await db.invalidate_resolved(job["file_id"])
+        await notify_recipients(bot, job, f"❌ <b>Error processing video:</b> {str(e)}")
+    finally:
+        active_downloads.pop(job["job_id"], None)
+        disk_budget.release(job["job_id"])
+        progress.discard(job["chat_id"], job["status_message_id"])
+
+        # Cleanup
+        filename = job.get("filename")
+        if not keep_files and filename:
+            for path in (filename, f"{filename}.journal", *job.get("parts", ())):
+                if not os.path.exists(path):
+                    continue
+                try:
+                    os.remove(path)
+                    logger.info(f"Deleted file: {path}")
+                except Exception as e:
+                    logger.error(f"Failed to delete file {path}: {e}")
+        
+        # Cleanup thumbnail
+        thumb_path = job.get("thumb_path")
+        if thumb_path and os.path.exists(thumb_path):
+            try:
+                os.remove(thumb_path)
+            except Exception:
+                pass
+
+async def resolve_stage(bot, job):
+    """Resolve the share into a direct link, or answer with a stream link / error."""
+    # Out of the queue: no more position updates for this message
+    progress.discard(job["chat_id"], job["status_message_id"])
+    file_id = job["file_id"]
+    terabox_url = job["terabox_url"]
+
     # Get video info
-    video_info = await get_video_info_multi(file_id, terabox_url, status_msg, context, message.chat_id)
+    video_info = await get_video_info_multi(file_id, terabox_url, bot, job["chat_id"], job["status_message_id"])
     
     if not video_info or not video_info['url']:
         # If the original URL looks like a folder/multi-file share, inform the user
@@ -681,305 +1222,730 @@ async def handle_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYPE
                 "• Copy its share link (it should end with <code>/s/...</code>)\n\n"
                 "Then paste that file link here."
             )
-            await context.bot.edit_message_text(
-                chat_id=message.chat_id,
-                message_id=status_msg.message_id,
-                text=folder_text + vps_limit_note(),
-                parse_mode='HTML'
-            )
+            await notify_recipients(bot, job, folder_text + vps_limit_note())
         else:
-            await context.bot.edit_message_text(
-                chat_id=message.chat_id,
-                message_id=status_msg.message_id,
-                text="❌ <b>Error:</b> Failed to extract video.\nThe link might be invalid or expired." + vps_limit_note(),
-                parse_mode='HTML'
+            await notify_recipients(
+                bot, job,
+                "❌ <b>Error:</b> Failed to extract video.\nThe link might be invalid or expired." + vps_limit_note()
             )
-        return
+        return None
 
-    direct_url = video_info['url']
+    job["video_info"] = video_info
+    if not video_info.get('size'):
+        # The share listing did not say; ask the file server
+        video_info['size'] = await probe_download_size(job)
     # Escape title to prevent HTML parse errors
-    video_title = video_info['title'].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    thumbnail_url = video_info['thumbnail']
+    job["video_title"] = video_info['title'].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
     # Update status with video details
     info_text = (
         f"🎬 <b>Found Video!</b>\n"
-        f"<b>Title:</b> {video_title}\n"
+        f"<b>Title:</b> {job['video_title']}\n"
     )
 
     # Check for Large File / Proxy Stream
-    # 50MB limit for streaming logic
-    STREAM_THRESHOLD = 50 * 1024 * 1024
-    
-    # If using proxy (assumed large/streamable) OR size > 50MB
-    if video_info.get('is_proxy') or video_info.get('size', 0) > STREAM_THRESHOLD:
-        
-        # Get stream URL
-        stream_url = video_info.get('url')
-        if not stream_url and video_info.get('is_proxy'):
-             stream_url = get_proxy_url(file_id)
-             
-        # Use a public HLS player for WebApp
-        # We encode the stream URL to pass it as a parameter
-        encoded_stream_url = urllib.parse.quote(stream_url)
-        # Using hlsjs.video-dev.org demo player which is reliable and public
-        player_url = f"https://hlsjs.video-dev.org/demo/?src={encoded_stream_url}"
+    # If using proxy (assumed large/streamable) OR too large to upload, compress or split
+    if video_info.get('is_proxy') or not can_deliver(video_info.get('size', 0)):
         
-        # Create Play Button
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔗 Direct Link", url=stream_url)]
-        ])
+        # Served through our own gateway (signed, expiring links) when it runs
+        stream_url = stream_link(file_id, video_info)
+        if ENABLE_WEB_SERVER:
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("▶️ Watch Online", url=gateway.watch_url(file_id))],
+                [InlineKeyboardButton("🔗 Stream Link", url=stream_url)]
+            ])
+        else:
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔗 Direct Link", url=stream_url)]
+            ])
         
         # Update text to indicate streaming
         stream_text = f"{info_text}\n⚠️ <b>File is large or stream-only.</b>\nTap the button below to play instantly!"
         
-        await context.bot.edit_message_text(
-            chat_id=message.chat_id, 
-            message_id=status_msg.message_id, 
-            text=stream_text, 
-            parse_mode='HTML',
-            reply_markup=keyboard
+        await notify_recipients(bot, job, stream_text, reply_markup=keyboard)
+        return None
+
+    # Known-size direct files can be piped straight into the upload
+    if STREAM_UPLOAD and 0 < video_info.get('size', 0) <= UPLOAD_LIMIT:
+        await bot.edit_message_text(
+            chat_id=job["chat_id"],
+            message_id=job["status_message_id"],
+            text=f"{info_text}\n📤 <b>Streaming to Telegram...</b>",
+            parse_mode='HTML'
         )
-        return
+        return "stream"
 
     # Proceed to download for smaller files
-    info_text += f"⬇️ Starting download..."
-    
     # If thumbnail exists, we might want to delete text message and send photo, 
     # but editing text is smoother for progress. We'll stick to text edit for progress.
-    await context.bot.edit_message_text(chat_id=message.chat_id, message_id=status_msg.message_id, 
-                                        text=info_text, parse_mode='HTML')
+    await bot.edit_message_text(
+        chat_id=job["chat_id"],
+        message_id=job["status_message_id"],
+        text=f"{info_text}\n⬇️ <b>Starting download...</b>",
+        parse_mode='HTML'
+    )
+    return "download"
 
-    # Check for concurrency limit
-    if download_semaphore.locked():
-        await context.bot.edit_message_text(
-            chat_id=message.chat_id, 
-            message_id=status_msg.message_id,
-            text=f"{info_text}\n\n⏳ <b>Queue is full.</b> Waiting for a slot...",
-            parse_mode='HTML'
+async def fetch_thumbnail(url):
+    """Thumbnail bytes, or None if there is none or it cannot be fetched."""
+    if not url:
+        return None
+    try:
+        response = await http_pool.get(url, follow_redirects=True)
+        if response.status_code == 200:
+            return response.content
+    except Exception as e:
+        logger.error(f"Failed to download thumbnail: {e}")
+    return None
+
+def pick_download_engine(video_info):
+    """HLS/proxy streams need yt-dlp; plain direct links can use the native downloader."""
+    url = (video_info.get('url') or '').lower()
+    if video_info.get('is_proxy') or '.m3u8' in url:
+        return 'ytdlp'
+    return DOWNLOAD_ENGINE
+
+def source_extension(video_info):
+    """The file extension from the TeraBox title, 'mp4' if it has none usable."""
+    ext = os.path.splitext(video_info.get('title') or '')[1].lstrip('.').lower()
+    if not ext.isalnum() or len(ext) > 4:
+        ext = 'mp4'
+    return ext
+
+async def download_native(job, progress_hook):
+    """Download a direct link with the built-in segmented downloader."""
+    video_info = job["video_info"]
+    filename = f"downloads/{job['file_id']}.{source_extension(video_info)}"
+    job["filename"] = filename
+
+    cookie = await job_cookie(job)
+    started = time.time()
+    try:
+        with tracing.span("download.native", segments=DOWNLOAD_SEGMENTS) as span:
+            size = await native_downloader.download(
+                video_info['url'], filename, headers=cookie_headers(cookie), progress_hook=progress_hook
+            )
+            span["bytes"] = size
+    except httpx.HTTPStatusError as e:
+        await cookie_pool.report(cookie, ok=False, throttled=e.response.status_code in (403, 429))
+        raise
+    await cookie_pool.report(cookie, ok=True)
+    await cookie_pool.report_speed(cookie, size / max(time.time() - started, 0.001))
+    return filename, {"thumbnail": video_info.get('thumbnail')}
+
+async def probe_download_size(job):
+    """Size of a direct link as the file server reports it (one-byte range request), or 0."""
+    video_info = job["video_info"]
+    if video_info.get('is_proxy') or '.m3u8' in (video_info.get('url') or '').lower():
+        return 0
+    try:
+        size, _, _, _ = await native_downloader.probe(video_info['url'], headers=cookie_headers(await job_cookie(job)))
+        return size
+    except Exception as e:
+        logger.warning(f"Could not probe the size of {job['file_id']}: {e}")
+        return 0
+
+async def expected_download_size(job):
+    """Size of the file to download, or 0 if it cannot be known before downloading."""
+    return job["video_info"].get('size') or await probe_download_size(job)
+
+async def reserve_disk_space(bot, job):
+    """
+    Hold the job until the disk budget has room for its peak use: the download plus one
+    more copy for the FastStart remux, compression output or split parts.
+    Returns False (after telling the users) if the file can never fit.
+    """
+    size = await expected_download_size(job)
+    need = 2 * size if size else DISK_UNKNOWN_SIZE
+
+    async def on_wait():
+        progress.update(
+            job["chat_id"], job["status_message_id"],
+            "⏳ <b>Waiting for disk space...</b>\nYour download starts as soon as other jobs finish.",
+            cancel_keyboard(job)
         )
 
-    async with download_semaphore:
-        # Update status once slot is acquired
-        await context.bot.edit_message_text(
-            chat_id=message.chat_id,
-            message_id=status_msg.message_id,
-            text=f"{info_text}\n\n⬇️ <b>Starting download...</b>",
-            parse_mode='HTML'
+    def check():
+        if active_downloads.get(job["job_id"], {}).get("cancelled"):
+            raise yt_dlp.utils.DownloadError("Download cancelled by user")
+
+    try:
+        await disk_budget.reserve(job["job_id"], need, on_wait=on_wait, check=check)
+    except InsufficientDiskSpace as e:
+        logger.warning(f"Not enough disk space for {job['file_id']}: {e}")
+        await notify_recipients(
+            bot, job,
+            f"⚠️ <b>Not enough disk space to process this file.</b>\n\n"
+            f"🔗 <b>Direct Download Link:</b>\n{stream_link(job['file_id'], job['video_info'])}\n\n"
         )
+        return False
+    return True
+
+async def download_stage(bot, job):
+    """Reserve disk space, then download the file."""
+    if not await reserve_disk_space(bot, job):
+        return None
+
+    # Initialize Progress Hook
+    progress_hook = ProgressHook(bot, job)
 
+    engine = job.setdefault("engine", pick_download_engine(job["video_info"]))
+    started = time.monotonic()
+    if engine == "native":
+        try:
+            filename, info = await download_native(job, progress_hook)
+        except yt_dlp.utils.DownloadError:
+            # Cancelled by user
+            raise
+        except Exception as e:
+            logger.warning(f"Native download failed for {job['file_id']}, falling back to yt-dlp: {e}")
+            # yt-dlp would treat a leftover partial file as already downloaded
+            for leftover in (job.get("filename"), f"{job.get('filename')}.journal"):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+            job["engine"] = engine = "ytdlp"
+            started = time.monotonic()
+
+    if engine == "ytdlp":
         # Download with yt-dlp
-        output_template = f"downloads/{file_id}.%(ext)s"
+        output_template = f"downloads/{job['file_id']}.%(ext)s"
+
+        # Run download in executor
+        filename, info = await download_video(
+            job["video_info"]['url'], output_template, progress_hook, cookie=await job_cookie(job)
+        )
+    job["filename"] = filename
+    metrics.DOWNLOAD_SECONDS.observe(time.monotonic() - started, engine=engine)
+    metrics.DOWNLOAD_BYTES.inc(os.path.getsize(filename), engine=engine)
+    
+    # Metadata hints; the transcode stage probes the file itself
+    job["width"] = info.get('width')
+    job["height"] = info.get('height')
+    job["duration"] = info.get('duration')
+    job["thumbnail_url"] = info.get('thumbnail')
         
-        # Initialize Progress Hook
-        progress_hook = ProgressHook(context.bot, message.chat_id, status_msg.message_id, user.id)
+    progress.discard(job["chat_id"], job["status_message_id"])
+    await bot.edit_message_text(chat_id=job["chat_id"], message_id=job["status_message_id"], 
+                                text="✅ <b>Download Complete!</b>\n\n⚙️ Optimizing for streaming...", parse_mode='HTML')
+    return "transcode"
+
+async def transcode_stage(bot, job):
+    """Make the file stream-friendly and check it fits Telegram's upload limit."""
+    filename = job["filename"]
+    await asyncio.to_thread(faststart, filename)
+    await load_media_info(job)
+
+    file_size = os.path.getsize(filename)
+    
+    if file_size > UPLOAD_LIMIT:
+        if COMPRESS_OVERSIZE and file_size <= COMPRESS_CEILING:
+            return "compress"
+        if can_split(file_size):
+            return "split"
+        await notify_too_large(bot, job, file_size)
+        return None
 
-        filename = None
-        thumb_path = None
-        should_delete_immediately = True # Flag to control deletion
+    # Remux temp files are gone; only the file itself stays until the upload
+    disk_budget.shrink(job["job_id"], file_size)
 
-        # Register download for cancellation
-        active_downloads[user.id] = {"cancelled": False}
+    progress.discard(job["chat_id"], job["status_message_id"])
+    await bot.edit_message_text(chat_id=job["chat_id"], message_id=job["status_message_id"], 
+                                text="✅ <b>Download Complete!</b>\n\n📤 Uploading to Telegram...", parse_mode='HTML')
+    return "upload"
 
+async def load_media_info(job):
+    """
+    Width, height, duration and thumbnail for the upload, from one ffprobe pass and a
+    single-frame grab of the downloaded file (off the event loop), or from the videos
+    document when the same video was processed before. Falls back to the remote thumbnail.
+    """
+    filename = job["filename"]
+    thumb_path = f"{filename}.jpg"
+    media = await db.get_video_media(job["file_id"])
+    if media:
+        logger.info(f"Using stored metadata for {job['file_id']}")
+        thumbnail = media.get("thumbnail")
+    else:
         try:
-            # Run download in executor
-            filename, info = await download_video(direct_url, output_template, progress_hook)
-            
-            # Extract metadata
-            width = info.get('width')
-            height = info.get('height')
-            duration = info.get('duration')
-            thumbnail_url = info.get('thumbnail')
-            
-            # Download thumbnail
-            if thumbnail_url:
-                try:
-                    thumb_resp = requests.get(thumbnail_url)
-                    if thumb_resp.status_code == 200:
-                        thumb_path = f"{filename}.jpg"
-                        with open(thumb_path, 'wb') as f:
-                            f.write(thumb_resp.content)
-                except Exception as e:
-                    logger.error(f"Failed to download thumbnail: {e}")
-                
-            await context.bot.edit_message_text(chat_id=message.chat_id, message_id=status_msg.message_id, 
-                                                text="✅ <b>Download Complete!</b>\n\n📤 Uploading to Telegram...", parse_mode='HTML')
-            
-            file_size = os.path.getsize(filename)
-            # 50MB for normal bot, 2000MB (2GB) for local API server
-            upload_limit = 2000 * 1024 * 1024 if TELEGRAM_API_URL else 50 * 1024 * 1024
-            
-            if file_size > upload_limit:
-                await message.reply_text(
-                    f"⚠️ <b>File too large for Telegram!</b> ({file_size/1024/1024:.2f} MB)\n\n"
-                    f"🔗 <b>Direct Download Link:</b>\n{direct_url}\n\n",
-                    parse_mode='HTML'
-                )
-                    
-            else:
-                caption = f"🎬 <b>{video_title}</b>"
-                
-                # Helper to update upload progress
-                def upload_progress_callback(current, total):
-                    try:
-                        percent = (current / total) * 100
-                        bar = get_progress_bar(percent)
-                        text = (
-                            f"📤 <b>Uploading Video...</b>\n\n"
-                            f"<b>Progress:</b> {bar} {percent:.1f}%\n"
-                        )
-                        # We need to run this in the event loop
-                        asyncio.run_coroutine_threadsafe(
-                            context.bot.edit_message_text(
-                                chat_id=message.chat_id,
-                                message_id=status_msg.message_id,
-                                text=text,
-                                parse_mode='HTML'
-                            ),
-                            asyncio.get_running_loop()
-                        )
-                    except Exception:
-                        pass # Ignore errors during UI update
-
-                # 1. Send to Cloud Channel (if configured)
-                sent_to_cloud = False
-                telegram_file_id = None
-                
-                if CLOUD_CHANNEL_ID:
-                    try:
-                        logger.info(f"Uploading to Cloud Channel: {CLOUD_CHANNEL_ID}")
-                        
-                        # Use ProgressFileReader
-                        with ProgressFileReader(filename, upload_progress_callback) as video_file:
-                            # Note: We pass the wrapper object as the video
-                            # python-telegram-bot's input_file accepts read() method
-                            
-                            thumb_file = open(thumb_path, 'rb') if thumb_path else None
-                            try:
-                                cloud_msg = await context.bot.send_video(
-                                    chat_id=CLOUD_CHANNEL_ID,
-                                    video=video_file, # This works because it has read()
-                                    caption=(
-                                        f"🆔 <code>{file_id}</code>\n"
-                                        f"🎬: {video_title}\n\n"
-                                        f"👤 <b>Requested by:</b> {user.mention_html()}\n"
-                                        f"🆔 <b>User ID:</b> <code>{user.id}</code>"
-                                    ),
-                                    parse_mode='HTML',
-                                    read_timeout=300, 
-                                    write_timeout=300,
-                                    width=width,
-                                    height=height,
-                                    duration=duration,
-                                    supports_streaming=True,
-                                    thumbnail=thumb_file
-                                )
-                            finally:
-                                if thumb_file:
-                                    thumb_file.close()
-
-                            if cloud_msg.video:
-                                telegram_file_id = cloud_msg.video.file_id
-                                sent_to_cloud = True
-                                
-                                # Save to DB
-                                db.add_video(file_id, telegram_file_id, video_title)
-                    except Exception as e:
-                        logger.error(f"Failed to upload to Cloud Channel: {e}")
-
-                # Send log to LOG_CHANNEL_ID
-                if LOG_CHANNEL_ID and telegram_file_id:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=LOG_CHANNEL_ID,
-                            text=(
-                                f"📝 <b>New Video Processed!</b>\n\n"
-                                f"🎬 <b>Title:</b> {video_title}\n"
-                                f"🆔 <b>TeraBox ID:</b> <code>{file_id}</code>\n"
-                                f"👤 <b>User:</b> {user.mention_html()} (<code>{user.id}</code>)\n"
-                                f"💾 <b>File ID:</b> <code>{telegram_file_id}</code>"
-                            ),
-                            parse_mode='HTML'
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to send log to LOG_CHANNEL: {e}")
-
-                # 2. Send to User
-                if sent_to_cloud and telegram_file_id:
-                    # Forward/Send using file_id (Fast!)
-                    await message.reply_video(
-                        video=telegram_file_id,
-                        caption=caption,
-                        parse_mode='HTML'
-                    )
-                else:
-                    # Upload directly to user (if cloud failed or not configured)
-                    # We reuse the ProgressFileReader if we haven't uploaded yet, 
-                    # but if we failed above, we need a fresh reader.
-                    try:
-                        with ProgressFileReader(filename, upload_progress_callback) as video_file:
-                            thumb_file = open(thumb_path, 'rb') if thumb_path else None
-                            try:
-                                user_msg = await message.reply_video(
-                                    video=video_file, 
-                                    caption=caption, 
-                                    parse_mode='HTML',
-                                    read_timeout=300,
-                                    write_timeout=300,
-                                    width=width,
-                                    height=height,
-                                    duration=duration,
-                                    supports_streaming=True,
-                                    thumbnail=thumb_file
-                                )
-                            finally:
-                                if thumb_file:
-                                    thumb_file.close()
-                            
-                            # Opportunistic: If we uploaded to user, try to save that file_id to DB too?
-                            if not sent_to_cloud and user_msg.video:
-                                db.add_video(file_id, user_msg.video.file_id, video_title)
-                    except Exception as e:
-                        logger.error(f"Failed to upload to user: {e}")
-                        await message.reply_text("❌ Failed to upload video.")
+            media = await asyncio.to_thread(transcode.probe_media, filename)
+            grabbed = await asyncio.to_thread(transcode.grab_thumbnail, filename, thumb_path, media["duration"])
+        except Exception as e:
+            logger.warning(f"Probing {filename} failed: {e}")
+            media, grabbed = {}, False
+        if grabbed:
+            with open(thumb_path, 'rb') as f:
+                thumbnail = f.read()
+        else:
+            thumbnail = await fetch_thumbnail(job.get("thumbnail_url"))
+        media = dict(media, thumbnail=thumbnail)
+
+    # Kept with the video once it is uploaded
+    job["media"] = {key: media.get(key) for key in ("width", "height", "duration")}
+    for key in ("width", "height", "duration"):
+        job[key] = media.get(key) or job.get(key)
+    if thumbnail:
+        if not os.path.exists(thumb_path):
+            with open(thumb_path, 'wb') as f:
+                f.write(thumbnail)
+        job["thumb_path"] = thumb_path
+
+def can_split(file_size):
+    return SPLIT_OVERSIZE and file_size <= UPLOAD_LIMIT * SPLIT_MAX_PARTS
+
+def can_deliver(file_size):
+    """Whether a file of this size can end up in Telegram: as is, compressed or split."""
+    return (
+        file_size <= UPLOAD_LIMIT
+        or (COMPRESS_OVERSIZE and file_size <= COMPRESS_CEILING)
+        or can_split(file_size)
+    )
 
-            
-            # Cleanup is handled in finally block
+async def notify_too_large(bot, job, file_size):
+    await notify_recipients(
+        bot, job,
+        f"⚠️ <b>File too large for Telegram!</b> ({file_size/1024/1024:.2f} MB)\n\n"
+        f"🔗 <b>Direct Download Link:</b>\n{stream_link(job['file_id'], job['video_info'])}\n\n"
+    )
+
+async def compress_stage(bot, job):
+    """Re-encode a file that is over the upload limit so it fits (two-pass, size-verified)."""
+    filename = job["filename"]
+    file_size = os.path.getsize(filename)
+    if active_downloads.get(job["job_id"], {}).get("cancelled"):
+        raise yt_dlp.utils.DownloadError("Download cancelled by user")
+
+    await bot.edit_message_text(
+        chat_id=job["chat_id"],
+        message_id=job["status_message_id"],
+        text=(
+            f"🗜 <b>Compressing Video...</b>\n\n"
+            f"{file_size/1024/1024:.2f} MB → under {UPLOAD_LIMIT/1024/1024:.0f} MB\n"
+            f"<i>This can take a while.</i>"
+        ),
+        parse_mode='HTML'
+    )
 
+    # ffmpeg is killed if the user cancels or the bot shuts down
+    compress = asyncio.ensure_future(transcode.transcode_to_target_size(
+        filename, UPLOAD_LIMIT, job.get("duration"),
+        threads=COMPRESS_THREADS, preset=COMPRESS_PRESET, attempts=COMPRESS_ATTEMPTS
+    ))
+    try:
+        while not (await asyncio.wait({compress}, timeout=1))[0]:
+            if active_downloads.get(job["job_id"], {}).get("cancelled"):
+                compress.cancel()
+                await asyncio.wait({compress})
+                raise yt_dlp.utils.DownloadError("Download cancelled by user")
+        output, size, tries = compress.result()
+    except yt_dlp.utils.DownloadError:
+        raise
+    except asyncio.CancelledError:
+        compress.cancel()
+        await asyncio.wait({compress})
+        raise
+    except Exception as e:
+        logger.warning(f"Compression failed for {job['file_id']}: {e}")
+        if can_split(file_size):
+            return "split"
+        await notify_too_large(bot, job, file_size)
+        return None
+
+    logger.info(f"Compressed {job['file_id']}: {file_size} -> {size} bytes in {tries} tries")
+    os.remove(filename)
+    job["filename"] = output
+    disk_budget.shrink(job["job_id"], size)
+    # May have been scaled down; let Telegram read the dimensions from the file
+    job["width"] = job["height"] = None
+
+    await bot.edit_message_text(chat_id=job["chat_id"], message_id=job["status_message_id"], 
+                                text=f"✅ <b>Compressed to {size/1024/1024:.2f} MB!</b>\n\n📤 Uploading to Telegram...", parse_mode='HTML')
+    return "upload"
+
+async def split_stage(bot, job):
+    """Cut a file that is over the upload limit into parts that fit, without re-encoding."""
+    filename = job["filename"]
+    file_size = os.path.getsize(filename)
+    if active_downloads.get(job["job_id"], {}).get("cancelled"):
+        raise yt_dlp.utils.DownloadError("Download cancelled by user")
+
+    await bot.edit_message_text(
+        chat_id=job["chat_id"],
+        message_id=job["status_message_id"],
+        text=(
+            f"✂️ <b>Splitting Video...</b>\n\n"
+            f"{file_size/1024/1024:.2f} MB → parts under {UPLOAD_LIMIT/1024/1024:.0f} MB"
+        ),
+        parse_mode='HTML'
+    )
+
+    try:
+        parts = await asyncio.to_thread(transcode.split_to_size, filename, UPLOAD_LIMIT, job.get("duration"))
+    except Exception as e:
+        logger.warning(f"Splitting failed for {job['file_id']}: {e}")
+        await notify_too_large(bot, job, file_size)
+        return None
+
+    logger.info(f"Split {job['file_id']} ({file_size} bytes) into {len(parts)} parts")
+    # The parts hold everything now; free the disk space early
+    os.remove(filename)
+    job["parts"] = parts
+    disk_budget.shrink(job["job_id"], file_size)
+
+    await bot.edit_message_text(chat_id=job["chat_id"], message_id=job["status_message_id"], 
+                                text=f"✅ <b>Split into {len(parts)} parts!</b>\n\n📤 Uploading to Telegram...", parse_mode='HTML')
+    return "upload"
+
+async def upload_stage(bot, job):
+    """Upload the file (or its parts) once and deliver it to the requester and every waiter."""
+    file_id = job["file_id"]
+    video_title = job["video_title"]
+    caption = f"🎬 <b>{video_title}</b>"
+    
+    # Helper to update upload progress (the reader may call it from a worker thread)
+    def upload_progress_callback(current, total):
+        percent = (current / total) * 100
+        text = (
+            f"📤 <b>Uploading Video...</b>\n\n"
+            f"<b>Progress:</b> {get_progress_bar(percent)} {percent:.1f}%\n"
+        )
+        progress.update(job["chat_id"], job["status_message_id"], text)
+
+    upload_kwargs = {
+        "thumb_path": job.get("thumb_path"),
+        "width": job.get("width"),
+        "height": job.get("height"),
+        "duration": job.get("duration"),
+        "progress_callback": upload_progress_callback,
+    }
+
+    paths = job.get("parts") or [job["filename"]]
+
+    # 1. Send to Cloud Channel (if configured)
+    telegram_file_ids = None
+    sent_to_cloud = False
+    uploaded_to = None
+    
+    if CLOUD_CHANNEL_ID:
+        try:
+            logger.info(f"Uploading to Cloud Channel: {CLOUD_CHANNEL_ID}")
+            telegram_file_ids = await upload_video_files(
+                bot, CLOUD_CHANNEL_ID, paths,
+                caption=(
+                    f"🆔 <code>{file_id}</code>\n"
+                    f"🎬: {video_title}\n\n"
+                    f"👤 <b>Requested by:</b> {job['user_mention']}\n"
+                    f"🆔 <b>User ID:</b> <code>{job['user_id']}</code>"
+                ),
+                concurrency=PART_UPLOAD_CONCURRENCY,
+                **upload_kwargs
+            )
+            sent_to_cloud = True
         except Exception as e:
-            logger.error(f"Error processing video: {e}")
-            await message.reply_text(f"❌ <b>Error processing video:</b> {str(e)}", parse_mode='HTML')
-        finally:
-            # Cleanup
-            if should_delete_immediately and filename and os.path.exists(filename):
-                try:
-                    os.remove(filename)
-                    logger.info(f"Deleted file: {filename}")
-                except Exception as e:
-                    logger.error(f"Failed to delete file {filename}: {e}")
-            
-            # Cleanup thumbnail
-            if thumb_path and os.path.exists(thumb_path):
-                try:
-                    os.remove(thumb_path)
-                except Exception:
-                    pass
+            logger.error(f"Failed to upload to Cloud Channel: {e}")
+
+    if not sent_to_cloud:
+        # Upload directly to requester (if cloud failed or not configured), one part
+        # at a time so they arrive in order
+        uploaded_to = (job["chat_id"], job["message_id"])
+        try:
+            telegram_file_ids = await upload_video_files(
+                bot, uploaded_to[0], paths, caption=caption,
+                reply_to_message_id=uploaded_to[1], **upload_kwargs
+            )
+        except Exception as e:
+            logger.error(f"Failed to upload to user: {e}")
+
+    if not telegram_file_ids:
+        await notify_recipients(bot, job, "❌ Failed to upload video.")
+        return None
+
+    await deliver_video(bot, job, telegram_file_ids, uploaded_to)
+    return None
+
+async def deliver_video(bot, job, telegram_file_ids, uploaded_to=None):
+    """
+    Save the uploaded video (all parts, in order) and send it to the requester and every
+    waiter, except the request it was uploaded to directly (`uploaded_to`, a
+    (chat_id, message_id) pair, if any).
+    """
+    file_id = job["file_id"]
+    video_title = job["video_title"]
+    caption = f"🎬 <b>{video_title}</b>"
+
+    # Save to DB, with the metadata and thumbnail so reprocessing does not probe again
+    media = job.get("media")
+    thumb_path = job.get("thumb_path")
+    if media and thumb_path and os.path.exists(thumb_path):
+        with open(thumb_path, 'rb') as f:
+            media = dict(media, thumbnail=f.read())
+    await db.add_video(file_id, telegram_file_ids, video_title, media=media)
+
+    # Send log to LOG_CHANNEL_ID
+    if LOG_CHANNEL_ID:
+        try:
+            await bot.send_message(
+                chat_id=LOG_CHANNEL_ID,
+                text=(
+                    f"📝 <b>New Video Processed!</b>\n\n"
+                    f"🎬 <b>Title:</b> {video_title}\n"
+                    f"🆔 <b>TeraBox ID:</b> <code>{file_id}</code>\n"
+                    f"👤 <b>User:</b> {job['user_mention']} (<code>{job['user_id']}</code>)\n"
+                    f"💾 <b>File ID:</b> <code>{telegram_file_ids[0]}</code>"
+                    + (f" (+{len(telegram_file_ids) - 1} parts)" if len(telegram_file_ids) > 1 else "")
+                ),
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.error(f"Failed to send log to LOG_CHANNEL: {e}")
 
+    # 2. Send to requester and waiters using file_id (Fast!)
+    for recipient in iter_recipients(job):
+        # Without the cloud copy, the requester already got the uploaded video
+        if (recipient["chat_id"], recipient["message_id"]) != uploaded_to:
             try:
-                await context.bot.delete_message(chat_id=message.chat_id, message_id=status_msg.message_id)
-            except:
-                pass
+                await send_video_parts(
+                    bot, recipient["chat_id"], telegram_file_ids, caption,
+                    reply_to_message_id=recipient["message_id"]
+                )
+            except Exception as e:
+                logger.error(f"Failed to send video to {recipient['chat_id']}: {e}")
+        try:
+            await bot.delete_message(chat_id=recipient["chat_id"], message_id=recipient["status_message_id"])
+        except Exception:
+            pass
 
-def clean_downloads():
-    """Clean the downloads directory on startup."""
-    if os.path.exists("downloads"):
+async def stream_stage(bot, job):
+    """
+    Pipe the direct link through a bounded ring buffer into the Telegram upload,
+    so the file never lands on disk. Falls back to the download stage on failure.
+    """
+    file_id = job["file_id"]
+    video_info = job["video_info"]
+
+    media = await db.get_video_media(file_id)
+    thumbnail = (media or {}).get("thumbnail") or await fetch_thumbnail(video_info.get('thumbnail'))
+
+    async def stream_progress_callback(current, total):
+        if active_downloads.get(job["job_id"], {}).get("cancelled"):
+            raise yt_dlp.utils.DownloadError("Download cancelled by user")
+        percent = (current / total) * 100
+        progress.update(
+            job["chat_id"], job["status_message_id"],
+            f"📤 <b>Streaming to Telegram...</b>\n\n"
+            f"<b>Progress:</b> {get_progress_bar(percent)} {percent:.1f}%\n"
+        )
+
+    uploaded_to = None
+    if CLOUD_CHANNEL_ID:
+        upload_chat_id = CLOUD_CHANNEL_ID
+        caption = (
+            f"🆔 <code>{file_id}</code>\n"
+            f"🎬: {job['video_title']}\n\n"
+            f"👤 <b>Requested by:</b> {job['user_mention']}\n"
+            f"🆔 <b>User ID:</b> <code>{job['user_id']}</code>"
+        )
+    else:
+        uploaded_to = (job["chat_id"], job["message_id"])
+        upload_chat_id = uploaded_to[0]
+        caption = f"🎬 <b>{job['video_title']}</b>"
+
+    source_headers = cookie_headers(await job_cookie(job))
+
+    # Upload under the original name and type; Telegram decides from them whether it is a video
+    ext = source_extension(video_info)
+    filename = re.sub(r'["\\\r\n]', '_', video_info.get('title') or '') or file_id
+    if not filename.lower().endswith(f".{ext}"):
+        filename += f".{ext}"
+    content_type = mimetypes.guess_type(filename)[0]
+    if not (content_type or '').startswith('video/'):
+        content_type = 'video/mp4'
+
+    started = time.monotonic()
+    try:
+        sent = await stream_video_upload(
+            http_pool,
+            f"{TELEGRAM_API_URL or 'https://api.telegram.org/bot'}{TOKEN}/sendVideo",
+            video_info['url'],
+            video_info['size'],
+            chat_id=upload_chat_id,
+            caption=caption,
+            filename=filename,
+            content_type=content_type,
+            thumbnail=thumbnail,
+            reply_to_message_id=uploaded_to and uploaded_to[1],
+            source_headers=source_headers,
+            buffer_size=STREAM_BUFFER_MB * 1024 * 1024,
+            progress_callback=stream_progress_callback,
+            **{key: (media or {}).get(key) for key in ("width", "height", "duration")}
+        )
+    except Exception as e:
+        if active_downloads.get(job["job_id"], {}).get("cancelled"):
+            raise
+        logger.warning(f"Streaming upload failed for {file_id}, falling back to download: {e}")
+        return "download"
+    metrics.UPLOAD_SECONDS.observe(time.monotonic() - started, mode="stream")
+    metrics.UPLOAD_BYTES.inc(video_info['size'], mode="stream")
+
+    telegram_file_id = (sent.get("video") or {}).get("file_id")
+    if not telegram_file_id:
+        # Stored as a document: it is already sent, so pass that message on instead of downloading again
+        logger.warning(f"Streaming upload of {file_id} was stored as a document, not caching it.")
+        await deliver_copies(bot, job, upload_chat_id, sent["message_id"], uploaded_to)
+        return None
+
+    await deliver_video(bot, job, [telegram_file_id], uploaded_to)
+    return None
+
+async def deliver_copies(bot, job, from_chat_id, message_id, uploaded_to=None):
+    """
+    Copy an uploaded message of any type to the requester and every waiter, except
+    `uploaded_to`. Used when Telegram kept the upload as a document, which
+    send_video_parts cannot re-send, so nothing is cached.
+    """
+    for recipient in iter_recipients(job):
+        if (recipient["chat_id"], recipient["message_id"]) != uploaded_to:
+            try:
+                await bot.copy_message(
+                    chat_id=recipient["chat_id"],
+                    from_chat_id=from_chat_id,
+                    message_id=message_id,
+                    reply_to_message_id=recipient["message_id"],
+                    allow_sending_without_reply=True
+                )
+            except Exception as e:
+                logger.error(f"Failed to send video to {recipient['chat_id']}: {e}")
         try:
-            import shutil
-            shutil.rmtree("downloads")
-            os.makedirs("downloads")
-            logger.info("Cleaned downloads directory.")
+            await bot.delete_message(chat_id=recipient["chat_id"], message_id=recipient["status_message_id"])
+        except Exception:
+            pass
+
+# Processing pipeline: each stage has its own pool so downloads, ffmpeg and uploads overlap
+pipeline = Pipeline([
+    Stage("resolve", resolve_stage, RESOLVE_WORKERS, STAGE_QUEUE_SIZE),
+    Stage("download", download_stage, MAX_CONCURRENT_DOWNLOADS, STAGE_QUEUE_SIZE),
+    Stage("transcode", transcode_stage, TRANSCODE_WORKERS, STAGE_QUEUE_SIZE),
+    Stage("compress", compress_stage, COMPRESS_WORKERS, STAGE_QUEUE_SIZE),
+    Stage("split", split_stage, SPLIT_WORKERS, STAGE_QUEUE_SIZE),
+    Stage("upload", upload_stage, UPLOAD_WORKERS, STAGE_QUEUE_SIZE),
+    Stage("stream", stream_stage, STREAM_WORKERS, STAGE_QUEUE_SIZE),
+])
+
+tracing.configure(TRACE_FILE)
+job_profiler = tracing.JobProfiler(PROFILE_DIR, every=PROFILE_EVERY)
+
+# Streaming gateway at BASE_URL; links are signed with GATEWAY_SECRET (or a key derived
+# from the bot token) so every replica accepts them
+gateway = Gateway(
+    http_pool,
+    gateway_source,
+    secret=os.getenv('GATEWAY_SECRET') or hashlib.sha256(f"gateway:{TOKEN}".encode()).hexdigest(),
+    base_url=BASE_URL or f"http://localhost:{PORT}",
+    cache=ChunkCache(
+        os.getenv('GATEWAY_CACHE_DIR', 'gateway-cache'),
+        int(os.getenv('GATEWAY_CACHE_MB', 1024)) * 1024 * 1024,
+    ),
+    chunk_size=int(float(os.getenv('GATEWAY_CHUNK_MB', 2)) * 1024 * 1024),
+    link_ttl=int(os.getenv('GATEWAY_LINK_TTL', 6 * 3600)),
+    port=PORT,
+)
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+def collect_metrics():
+    """Copy queue depths and cache counters into the metrics before every scrape."""
+    for name, stage in pipeline.stats().items():
+        metrics.STAGE_QUEUED.set(stage["queued"], stage=name)
+        metrics.STAGE_ACTIVE.set(stage["active"], stage=name)
+        metrics.STAGE_CONCURRENCY.set(stage["concurrency"], stage=name)
+
+    queue = job_queue.stats()
+    metrics.JOBS_QUEUED.set(queue["queued"])
+    metrics.JOBS_RUNNING.set(queue["running"])
+    metrics.JOB_WORKERS.set(queue["workers"])
+
+    cache = db.video_cache_info()
+    for result, key in (("hit", "hits"), ("negative_hit", "negative_hits"), ("miss", "misses")):
+        metrics.VIDEO_CACHE_LOOKUPS.set(cache[key], result=result)
+    metrics.VIDEO_CACHE_HIT_RATIO.set(cache["hit_ratio"])
+    metrics.VIDEO_CACHE_SIZE.set(cache["size"])
+
+    chunks = gateway.cache.stats
+    for result, key in (("hit", "hits"), ("miss", "misses"), ("shared", "shared"), ("evicted", "evicted")):
+        metrics.GATEWAY_CHUNKS.set(chunks[key], result=result)
+
+    metrics.DISK_RESERVED.set(disk_budget.reserved())
+    metrics.DISK_CAPACITY.set(disk_budget.capacity())
+    metrics.DISK_WAITING.set(len(disk_budget.waiting))
+    metrics.PROGRESS_PENDING.set(len(progress.pending))
+
+metrics.registry.add_collector(collect_metrics)
+
+def clean_downloads(keep_file_ids=()):
+    """
+    Clean the downloads directory on startup.
+    Files of live (recovered) jobs are kept so their downloads can resume.
+    """
+    if not os.path.exists("downloads"):
+        os.makedirs("downloads")
+        return
+
+    removed = 0
+    for name in os.listdir("downloads"):
+        # Files are named {file_id}.{ext}[.part|.journal|.jpg...]
+        if name.split(".", 1)[0] in keep_file_ids:
+            continue
+        path = os.path.join("downloads", name)
+        try:
+            if os.path.isdir(path):
+                import shutil
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed += 1
         except Exception as e:
-            logger.error(f"Failed to clean downloads directory: {e}")
+            logger.error(f"Failed to remove {path}: {e}")
+    logger.info(f"Cleaned downloads directory ({removed} orphaned files removed).")
+
+async def on_startup(application: Application) -> None:
+    """Start background tasks once the event loop is running."""
+    global ENABLE_WEB_SERVER
+    # Before any job runs, so no gateway link goes out if the gateway cannot listen
+    if ENABLE_WEB_SERVER:
+        try:
+            await gateway.start()
+        except OSError as e:
+            logger.error(f"Streaming gateway could not listen on port {PORT}: {e}. Sending upstream links instead; set ENABLE_WEB_SERVER=false if there is no public port.")
+            ENABLE_WEB_SERVER = False
+    db.start_user_flusher()
+    progress.start(application.bot)
+    broadcaster.start(application.bot, on_progress=functools.partial(broadcast_progress, application.bot))
+    await broadcaster.resume()
+    await cookie_pool.load(seed=TERABOX_COOKIE)
+    pipeline.start(application.bot)
+    await job_queue.start(
+        functools.partial(process_job, application.bot),
+        on_position=functools.partial(update_queue_position, application.bot)
+    )
+    # Only now do we know which partial downloads still belong to a job
+    clean_downloads({job["file_id"] for job in job_queue.active.values()})
+    if METRICS_PORT:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logger.error(f"Metrics endpoint could not listen on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+async def on_shutdown(application: Application) -> None:
+    """Release shared resources when the bot stops."""
+    await metrics_server.stop()
+    await gateway.stop()
+    await broadcaster.stop()
+    await job_queue.stop()
+    await pipeline.stop()
+    await progress.stop()
+    await http_pool.close()
+    cookie_pool.close()
+    await db.stop_user_flusher()
+    db.close()
 
 def main() -> None:
     """Start the bot."""
@@ -987,9 +1953,6 @@ def main() -> None:
         print("Error: BOT_TOKEN not set.")
         return
 
-    # Clean downloads on startup
-    clean_downloads()
-
     # Create the Application and pass it your bot's token.
     # Increase timeouts for large file uploads
     builder = Application.builder().token(TOKEN)
@@ -998,13 +1961,24 @@ def main() -> None:
         logger.info(f"Using Custom Bot API Server: {TELEGRAM_API_URL}")
         builder.base_url(TELEGRAM_API_URL)
         builder.base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        if TELEGRAM_LOCAL_MODE:
+            logger.info("Local mode: videos are passed to the Bot API server by file path.")
+            builder.local_mode(True)
 
+    # Requests are timed and their errors counted for the metrics endpoint
     application = (
         builder
-        .read_timeout(300)   # 5 minutes
-        .write_timeout(300)  # 5 minutes
-        .connect_timeout(60) # 1 minute
-        .pool_timeout(300)   # 5 minutes
+        .request(InstrumentedRequest(
+            connection_pool_size=256,
+            read_timeout=300,    # 5 minutes
+            write_timeout=300,   # 5 minutes
+            connect_timeout=60,  # 1 minute
+            pool_timeout=300,    # 5 minutes
+        ))
+        .get_updates_request(InstrumentedRequest())
+        .concurrent_updates(True) # Let duplicate requests join an in-flight job
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
         .build()
     )
 
@@ -1015,6 +1989,8 @@ def main() -> None:
     application.add_handler(CommandHandler("broadcast", admin_broadcast))
     application.add_handler(CommandHandler("del", admin_delete))
     application.add_handler(CommandHandler("setcookie", admin_set_cookie))
+    application.add_handler(CommandHandler("cookies", admin_cookies))
+    application.add_handler(CommandHandler("delcookie", admin_delete_cookie))
     application.add_handler(CallbackQueryHandler(cancel_download, pattern="^cancel_"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_terabox_link))
 
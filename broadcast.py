@@ -0,0 +1,179 @@
+import time
+import uuid
+import asyncio
+import logging
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Async token bucket; pause() stops handing out tokens for a while (flood control)."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class Broadcaster:
+    """
+    Sends a message to every active user.
+    Users are read from MongoDB in user_id order (Database.iter_user_ids); each batch is sent
+    with bounded concurrency under a global token bucket, and the last user_id of every
+    finished batch is checkpointed so an interrupted broadcast resumes where it stopped.
+    Users that blocked the bot are marked inactive.
+    """
+    def __init__(self, db, rate=25, concurrency=10, batch_size=200, max_retries=3):
+        self.db = db
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.bot = None
+        self.on_progress = None
+        self._tasks = {}  # broadcast_id -> task
+
+    def start(self, bot, on_progress=None):
+        """`on_progress(broadcast, finished)` is awaited after every batch and at the end."""
+        self.bot = bot
+        self.on_progress = on_progress
+
+    async def create(self, text, admin_chat_id, status_message_id):
+        """Store a new broadcast and start sending it. Returns the broadcast document."""
+        # New users are written in batches; make sure they are included
+        await self.db.flush_users()
+        broadcast = {
+            "broadcast_id": uuid.uuid4().hex,
+            "text": text,
+            "status": "running",
+            "admin_chat_id": admin_chat_id,
+            "status_message_id": status_message_id,
+            "last_user_id": None,
+            "total": await self.db.count_users(active_only=True),
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "created_at": int(time.time()),
+        }
+        await self.db.add_broadcast(broadcast)
+        self._launch(broadcast)
+        return broadcast
+
+    async def resume(self):
+        """Continue broadcasts interrupted by a restart."""
+        for broadcast in await self.db.get_running_broadcasts():
+            logger.info(f"Resuming broadcast {broadcast['broadcast_id']} after user {broadcast['last_user_id']}")
+            self._launch(broadcast)
+
+    async def stop(self):
+        """Stop sending; running broadcasts stay 'running' in the DB and resume on next start."""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+
+    def _launch(self, broadcast):
+        task = asyncio.get_running_loop().create_task(self._run(broadcast))
+        self._tasks[broadcast["broadcast_id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast["broadcast_id"], None))
+
+    async def _run(self, broadcast):
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with limit:
+                return user_id, await self._send(user_id, broadcast["text"])
+
+        async def send_batch(user_ids):
+            results = await asyncio.gather(*(send(user_id) for user_id in user_ids))
+            blocked = [user_id for user_id, result in results if result == "blocked"]
+            if blocked:
+                await self.db.deactivate_users(blocked)
+            for _, result in results:
+                broadcast[result] += 1
+
+            # The last user of a finished batch is the checkpoint to resume from
+            broadcast["last_user_id"] = user_ids[-1]
+            await self.db.update_broadcast(broadcast["broadcast_id"], {
+                key: broadcast[key] for key in ("last_user_id", "sent", "blocked", "failed")
+            })
+            await self._report(broadcast, finished=False)
+
+        try:
+            user_ids = []
+            async for user_id in self.db.iter_user_ids(broadcast["last_user_id"], self.batch_size, active_only=True):
+                user_ids.append(user_id)
+                if len(user_ids) == self.batch_size:
+                    await send_batch(user_ids)
+                    user_ids = []
+            if user_ids:
+                await send_batch(user_ids)
+
+            broadcast["status"] = "done"
+            broadcast["finished_at"] = int(time.time())
+            await self.db.update_broadcast(broadcast["broadcast_id"], {
+                "status": "done", "finished_at": broadcast["finished_at"]
+            })
+            await self._report(broadcast, finished=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast['broadcast_id']} failed: {e}")
+            # Not resumed on restart; the admin sees how far it got and can send it again
+            broadcast["status"] = "failed"
+            broadcast["error"] = str(e)
+            broadcast["finished_at"] = int(time.time())
+            await self.db.update_broadcast(broadcast["broadcast_id"], {
+                key: broadcast[key] for key in ("status", "error", "finished_at")
+            })
+            await self._report(broadcast, finished=True)
+
+    async def _send(self, user_id, text):
+        """Returns 'sent', 'blocked' or 'failed'."""
+        for _ in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML')
+                return "sent"
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                # Flood control applies to the whole bot: everyone waits
+                logger.warning(f"Broadcast throttled, pausing for {retry_after}s")
+                self.bucket.pause(retry_after)
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logger.error(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+            except Exception as e:
+                logger.error(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+        return "failed"
+
+    async def _report(self, broadcast, finished):
+        if self.on_progress:
+            try:
+                await self.on_progress(broadcast, finished)
+            except Exception as e:
+                logger.error(f"Broadcast progress update failed: {e}")
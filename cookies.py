@@ -0,0 +1,167 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from http.cookies import SimpleCookie
+
+logger = logging.getLogger(__name__)
+
+# Error texts that mean the account is being rate-limited or challenged
+THROTTLE_MARKERS = ("429", "403", "limit", "frequent", "verify", "captcha")
+
+def is_throttled(error):
+    error = str(error).lower()
+    return any(marker in error for marker in THROTTLE_MARKERS)
+
+class CookiePool:
+    """
+    TeraBox account cookies stored in MongoDB, shared by resolves and downloads.
+    Every cookie has a health score (EWMA of recent successes) and an average download
+    speed; acquire() hands out the healthiest (or least recently used) cookie that is not
+    cooling down. Throttled or repeatedly failing cookies are cooled down with backoff.
+    """
+    def __init__(self, db, strategy="healthiest", cooldown=600, max_failures=3,
+                 refresh_interval=60, alpha=0.3):
+        self.db = db
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.max_failures = max_failures
+        self.refresh_interval = refresh_interval
+        self.alpha = alpha
+        self.cookies = {}  # cookie_id -> document
+        self._loaded_at = 0
+        self._cookie_dir = None
+        self._cookie_files = {}  # cookie_id -> Netscape cookie file
+
+    @staticmethod
+    def cookie_id(cookie):
+        return hashlib.sha1(cookie.encode()).hexdigest()[:12]
+
+    async def load(self, seed=None):
+        """Load the pool from MongoDB, adding `seed` (e.g. TERABOX_COOKIE) if it is new."""
+        if seed and self.cookie_id(seed) not in {doc["cookie_id"] for doc in await self.db.get_cookies()}:
+            await self.add(seed)
+        await self.refresh()
+        logger.info(f"Cookie pool loaded with {len(self.cookies)} cookies.")
+
+    async def refresh(self):
+        """Pick up changes made by other replicas (new cookies, cooldowns)."""
+        docs = await self.db.get_cookies()
+        self._loaded_at = time.time()
+        # An empty answer is more likely a database problem than an emptied pool
+        if docs:
+            self.cookies = {doc["cookie_id"]: doc for doc in docs}
+
+    async def add(self, cookie):
+        """Add a cookie (or reset an existing one to full health). Returns its id."""
+        cookie_id = self.cookie_id(cookie)
+        doc = {
+            "cookie_id": cookie_id,
+            "cookie": cookie,
+            "health": 1.0,
+            "speed": None,
+            "failures": 0,
+            "cooldown_until": 0,
+            "last_used": 0,
+            "added_at": int(time.time()),
+        }
+        self.cookies[cookie_id] = doc
+        await self.db.save_cookie(doc)
+        return cookie_id
+
+    async def remove(self, cookie_id):
+        self.cookies.pop(cookie_id, None)
+        path = self._cookie_files.pop(cookie_id, None)
+        if path and os.path.exists(path):
+            os.remove(path)
+        return await self.db.delete_cookie(cookie_id)
+
+    def get(self, cookie_id):
+        return self.cookies.get(cookie_id)
+
+    def score(self, doc):
+        """Health weighted by speed relative to the fastest cookie in the pool."""
+        speeds = [d["speed"] for d in self.cookies.values() if d.get("speed")]
+        if not doc.get("speed") or not speeds:
+            return doc["health"]
+        return doc["health"] * (0.5 + 0.5 * doc["speed"] / max(speeds))
+
+    async def acquire(self):
+        """The cookie to use next, or None if the pool is empty."""
+        if time.time() - self._loaded_at > self.refresh_interval:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh cookie pool: {e}")
+        if not self.cookies:
+            return None
+
+        now = time.time()
+        ready = [doc for doc in self.cookies.values() if doc["cooldown_until"] <= now]
+        if not ready:
+            # Everything is cooling down: the one that recovers first is the best bet
+            doc = min(self.cookies.values(), key=lambda d: d["cooldown_until"])
+        elif self.strategy == "lru":
+            doc = min(ready, key=lambda d: d["last_used"])
+        else:
+            doc = max(ready, key=lambda d: (round(self.score(d), 2), -d["last_used"]))
+        doc["last_used"] = now
+        return doc
+
+    async def report(self, doc, ok, throttled=False):
+        """Record the outcome of a request made with `doc`."""
+        if doc is None:
+            return
+        doc["health"] += self.alpha * ((1.0 if ok else 0.0) - doc["health"])
+        fields = {"health": doc["health"], "last_used": doc["last_used"]}
+        if ok:
+            doc["failures"] = 0
+        else:
+            doc["failures"] += 1
+            if throttled or doc["failures"] >= self.max_failures:
+                # Back off harder every time the cookie keeps failing
+                backoff = self.cooldown * 2 ** max(doc["failures"] - self.max_failures, 0)
+                doc["cooldown_until"] = time.time() + min(backoff, 24 * 3600)
+                fields["cooldown_until"] = doc["cooldown_until"]
+                logger.warning(f"Cookie {doc['cookie_id']} cooling down for {backoff:.0f}s")
+        fields["failures"] = doc["failures"]
+        await self.db.update_cookie(doc["cookie_id"], fields)
+
+    async def report_speed(self, doc, bytes_per_second):
+        """Fold a finished download's average speed into the cookie's score."""
+        if doc is None or not bytes_per_second:
+            return
+        if doc.get("speed"):
+            doc["speed"] += self.alpha * (bytes_per_second - doc["speed"])
+        else:
+            doc["speed"] = bytes_per_second
+        await self.db.update_cookie(doc["cookie_id"], {"speed": doc["speed"]})
+
+    def cookie_file(self, doc):
+        """Netscape cookie file for yt-dlp, written once per cookie and reused."""
+        path = self._cookie_files.get(doc["cookie_id"])
+        if path and os.path.exists(path):
+            return path
+        if self._cookie_dir is None:
+            self._cookie_dir = tempfile.mkdtemp(prefix="terabox-cookies-")
+
+        path = os.path.join(self._cookie_dir, f"{doc['cookie_id']}.txt")
+        cookie = SimpleCookie()
+        cookie.load(doc["cookie"])
+        with open(path, "w") as f:
+            f.write("# Netscape HTTP Cookie File\n")
+            f.write("# This file is generated by the bot.\n\n")
+            for key, morsel in cookie.items():
+                # domain flag path secure expiration name value
+                f.write(f".terabox.com\tTRUE\t/\tFALSE\t2147483647\t{key}\t{morsel.value}\n")
+        self._cookie_files[doc["cookie_id"]] = path
+        return path
+
+    def close(self):
+        """Remove the cookie files."""
+        if self._cookie_dir:
+            shutil.rmtree(self._cookie_dir, ignore_errors=True)
+            self._cookie_dir = None
+            self._cookie_files = {}
@@ -1,29 +1,85 @@
 import os
 import logging
 import time
+import asyncio
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
+from pymongo import UpdateOne
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 class Database:
-    def __init__(self):
+    """
+    Async MongoDB access layer.
+    pymongo calls run on a dedicated, bounded thread pool so handlers can await them
+    without blocking the event loop. Pass `client` (e.g. mongomock.MongoClient()) for tests.
+    """
+    def __init__(self, client=None):
         self.mongo_url = os.getenv("MONGO_URL")
         self.collection_name = os.getenv("COLLECTION_NAME", "TERABOX")
-        self.client = None
+        self.pool_size = int(os.getenv("MONGO_POOL_SIZE", 10))
+        self.timeout_ms = int(os.getenv("MONGO_TIMEOUT_MS", 5000))
+        self.client = client
         self.db = None
+        # One executor thread per pooled connection, so no call waits on the pool twice
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="mongo")
+
+        # Write-behind user upserts
+        # known_users: LRU of user_ids already stored (or queued), pending_users: {user_id: user_data}
+        self.known_users = OrderedDict()
+        self.known_users_max = int(os.getenv("KNOWN_USERS_CACHE_SIZE", 100000))
+        self.pending_users = {}
+        self.user_flush_interval = float(os.getenv("USER_FLUSH_INTERVAL", 5))
+        self._flush_task = None
+
+        # Daily activity, written behind like users: one (user_id, day) record per UTC day
+        self.activity_day = None
+        self.seen_today = set()
+        self.pending_activity = set()  # {(user_id, day)}
+        self.activity_retention_days = int(os.getenv("ACTIVITY_RETENTION_DAYS", 30))
+
+        # In-process video cache in front of the videos collection
+        # Format: {terabox_id: (expires_at, (file_id, title) or None for a cached miss)}
+        self.video_cache = OrderedDict()
+        self.video_cache_size = int(os.getenv("VIDEO_CACHE_SIZE", 5000))
+        self.video_cache_ttl = float(os.getenv("VIDEO_CACHE_TTL", 3600))
+        self.video_negative_ttl = float(os.getenv("VIDEO_NEGATIVE_TTL", 30))
+        self.video_cache_stats = {"hits": 0, "negative_hits": 0, "misses": 0}
+
+        # Resolved download links: {file_id: (info_expires_at, info or None, host)}
+        # Wall-clock expiry, since the same entries are shared with other replicas through MongoDB
+        self.resolve_cache = OrderedDict()
+        self.resolve_cache_size = int(os.getenv("RESOLVER_CACHE_SIZE", 5000))
+        self.resolve_cache_ttl = float(os.getenv("RESOLVER_CACHE_TTL", 1800))
+        # The winning host variant is remembered much longer than the link itself
+        self.resolve_host_ttl = float(os.getenv("RESOLVER_HOST_TTL", 7 * 24 * 3600))
+
+        # Finished jobs are kept this long before the TTL index removes them
+        self.job_retention_hours = float(os.getenv("JOB_RETENTION_HOURS", 24))
+
         self.init_db()
 
     def init_db(self):
         """Initialize the MongoDB connection."""
         try:
-            if not self.mongo_url:
-                logger.error("MONGO_URL not found in environment variables.")
-                return
+            if self.client is None:
+                if not self.mongo_url:
+                    logger.error("MONGO_URL not found in environment variables.")
+                    return
 
-            self.client = pymongo.MongoClient(self.mongo_url)
+                self.client = pymongo.MongoClient(
+                    self.mongo_url,
+                    maxPoolSize=self.pool_size,
+                    serverSelectionTimeoutMS=self.timeout_ms,
+                    connectTimeoutMS=self.timeout_ms,
+                    socketTimeoutMS=self.timeout_ms * 6,
+                )
             self.db = self.client[self.collection_name]
             
             # Test connection
@@ -35,77 +91,552 @@ class Database:
             self.db.videos.create_index("terabox_id", unique=True)
             # Users collection
             self.db.users.create_index("user_id", unique=True)
+            self.db.users.create_index("joined_at")
+            # Only users marked by a broadcast carry the field
+            self.db.users.create_index("active", sparse=True)
+            # Activity collection (daily actives)
+            self.db.activity.create_index([("day", 1), ("user_id", 1)], unique=True)
+            self.db.activity.create_index("expire_at", expireAfterSeconds=0)
+            # Jobs collection
+            self.db.jobs.create_index("job_id", unique=True)
+            self.db.jobs.create_index([("status", 1), ("created_at", 1)])
+            self.db.jobs.create_index("expire_at", expireAfterSeconds=0)
+            # Resolver cache collection
+            self.db.resolved.create_index("file_id", unique=True)
+            self.db.resolved.create_index("expire_at", expireAfterSeconds=0)
+            # Cookie pool collection
+            self.db.cookies.create_index("cookie_id", unique=True)
+            # Broadcasts collection
+            self.db.broadcasts.create_index("broadcast_id", unique=True)
+            self.db.broadcasts.create_index("status")
             
         except Exception as e:
             logger.error(f"MongoDB initialization failed: {e}")
 
-    def add_user(self, user_id, first_name, username):
-        """Add a new user to the database."""
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking pymongo call on the database executor, timing the call itself."""
+        # "users.find_one" for collection methods, the enclosing method for local fetch() helpers
+        collection = getattr(getattr(func, "__self__", None), "name", None)
+        op = f"{collection}.{func.__name__}" if isinstance(collection, str) else func.__qualname__.split(".<locals>")[0]
+
+        def call():
+            with metrics.MONGO_SECONDS.time(op=op):
+                return func(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, call)
+
+    def close(self):
+        """Release the executor and the MongoDB connection pool."""
+        self.executor.shutdown(wait=False)
+        if self.client:
+            self.client.close()
+
+    def _remember_user(self, user_id):
+        """Mark a user as known, evicting the least recently seen one when full."""
+        self.known_users[user_id] = True
+        self.known_users.move_to_end(user_id)
+        while len(self.known_users) > self.known_users_max:
+            self.known_users.popitem(last=False)
+
+    async def add_user(self, user_id, first_name, username):
+        """
+        Add a new user to the database.
+        Returns True only for users that were not stored before. Repeat users are
+        answered from memory; new users are queued and written in batches by flush_users().
+        """
+        self._record_activity(user_id)
+        if user_id in self.known_users:
+            self.known_users.move_to_end(user_id)
+            return False
+
+        user_data = {
+            "user_id": user_id,
+            "first_name": first_name,
+            "username": username,
+            "joined_at": int(time.time())
+        }
+        self._remember_user(user_id)
+
         try:
-            user_data = {
-                "user_id": user_id,
-                "first_name": first_name,
-                "username": username,
-                "joined_at": int(time.time())
-            }
-            # Use update_one with upsert=True to mimic INSERT OR IGNORE / REPLACE
-            # If user exists, we might not want to overwrite joined_at, so let's use $setOnInsert
-            self.db.users.update_one(
-                {"user_id": user_id},
-                {"$setOnInsert": user_data},
+            existing = await self._run(self.db.users.find_one, {"user_id": user_id}, {"active": 1})
+        except Exception as e:
+            logger.error(f"Error checking user in DB: {e}")
+            # Upsert is idempotent, queue it anyway
+            self.pending_users[user_id] = user_data
+            return False
+
+        if existing:
+            if existing.get("active") is False:
+                # Marked inactive by a broadcast, but talking to the bot again
+                try:
+                    await self._run(self.db.users.update_one, {"user_id": user_id}, {"$set": {"active": True}})
+                except Exception as e:
+                    logger.error(f"Error reactivating user in DB: {e}")
+            return False
+
+        self.pending_users[user_id] = user_data
+        return True
+
+    async def flush_users(self):
+        """Write all queued users with a single bulk_write."""
+        if not self.pending_users:
+            return 0
+
+        batch, self.pending_users = self.pending_users, {}
+        # $setOnInsert keeps joined_at of users that already exist
+        operations = [
+            UpdateOne({"user_id": user_id}, {"$setOnInsert": user_data}, upsert=True)
+            for user_id, user_data in batch.items()
+        ]
+        try:
+            await self._run(self.db.users.bulk_write, operations, ordered=False)
+            logger.info(f"Flushed {len(operations)} new users to DB.")
+            return len(operations)
+        except Exception as e:
+            logger.error(f"Error flushing users to DB: {e}")
+            # Put the batch back so the next flush retries it
+            for user_id, user_data in batch.items():
+                self.pending_users.setdefault(user_id, user_data)
+            return 0
+
+    def _record_activity(self, user_id):
+        """Remember that a user was active today (written by flush_activity())."""
+        now = datetime.datetime.utcnow()
+        day = datetime.datetime(now.year, now.month, now.day)
+        if day != self.activity_day:
+            self.activity_day = day
+            self.seen_today = set()
+        if user_id not in self.seen_today:
+            self.seen_today.add(user_id)
+            self.pending_activity.add((user_id, day))
+
+    async def flush_activity(self):
+        """Write the queued daily activity records with a single bulk_write."""
+        if not self.pending_activity:
+            return 0
+
+        batch, self.pending_activity = self.pending_activity, set()
+        retention = datetime.timedelta(days=self.activity_retention_days)
+        operations = [
+            UpdateOne(
+                {"user_id": user_id, "day": day},
+                {"$setOnInsert": {"expire_at": day + retention}},
                 upsert=True
             )
-            return True
+            for user_id, day in batch
+        ]
+        try:
+            await self._run(self.db.activity.bulk_write, operations, ordered=False)
+            return len(operations)
         except Exception as e:
-            logger.error(f"Error adding user to DB: {e}")
-            return False
+            logger.error(f"Error flushing activity to DB: {e}")
+            self.pending_activity |= batch
+            return 0
+
+    async def _flush_users_loop(self):
+        while True:
+            await asyncio.sleep(self.user_flush_interval)
+            await self.flush_users()
+            await self.flush_activity()
+
+    def start_user_flusher(self):
+        """Start the periodic user flush task on the running loop."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_users_loop())
+
+    async def stop_user_flusher(self):
+        """Stop the periodic flush task and write whatever is still queued."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush_users()
+        await self.flush_activity()
+
+    async def iter_user_ids(self, after_user_id=None, batch_size=1000, active_only=False, retries=5):
+        """
+        Yield user IDs in user_id order, fetched batch by batch instead of loaded into one
+        list. Pass the last ID seen as `after_user_id` to continue where a previous run stopped.
+        A batch that cannot be read is retried with backoff; after `retries` failures in a
+        row it raises RuntimeError.
+        """
+        await self.flush_users()
+        failures = 0
+        while True:
+            batch = await self.get_user_ids_after(after_user_id, batch_size, active_only)
+            if batch is None:
+                failures += 1
+                if failures > retries:
+                    raise RuntimeError(f"Could not read users after {after_user_id} from the database")
+                await asyncio.sleep(min(2 ** failures, 60))
+                continue
+            failures = 0
+            if not batch:
+                return
+            for user_id in batch:
+                yield user_id
+            after_user_id = batch[-1]
+
+    async def get_stats(self, days=7):
+        """
+        User and cache statistics, computed in MongoDB:
+        totals from (estimated) counts, new users and daily actives per day for the last `days`.
+        """
+        await self.flush_users()
+        await self.flush_activity()
+        now = datetime.datetime.utcnow()
+        since = datetime.datetime(now.year, now.month, now.day) - datetime.timedelta(days=days - 1)
+
+        def fetch():
+            new_users = self.db.users.aggregate([
+                {"$match": {"joined_at": {"$gte": int(since.replace(tzinfo=datetime.timezone.utc).timestamp())}}},
+                {"$group": {
+                    "_id": {"$dateToString": {
+                        "format": "%Y-%m-%d",
+                        # joined_at is epoch seconds; epoch date + milliseconds gives a date
+                        "date": {"$add": [datetime.datetime(1970, 1, 1), {"$multiply": ["$joined_at", 1000]}]},
+                    }},
+                    "count": {"$sum": 1},
+                }},
+            ])
+            daily_active = self.db.activity.aggregate([
+                {"$match": {"day": {"$gte": since}}},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$day"}},
+                    "count": {"$sum": 1},
+                }},
+            ])
+            return {
+                # Metadata count: instant, no collection scan
+                "total_users": self.db.users.estimated_document_count(),
+                "inactive_users": self.db.users.count_documents({"active": False}),
+                "cached_videos": self.db.videos.estimated_document_count(),
+                "new_users": {doc["_id"]: doc["count"] for doc in new_users},
+                "daily_active": {doc["_id"]: doc["count"] for doc in daily_active},
+                "days": [(since + datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)],
+            }
 
-    def get_all_users(self):
-        """Get all user IDs."""
         try:
-            users = self.db.users.find({}, {"user_id": 1})
-            return [user["user_id"] for user in users]
+            return await self._run(fetch)
         except Exception as e:
-            logger.error(f"Error fetching users from DB: {e}")
-            return []
+            logger.error(f"Error computing stats: {e}")
+            return None
 
-    def get_video(self, terabox_id):
-        """Retrieve video file_id by terabox_id."""
+    async def count_users(self, active_only=False):
+        """Number of stored users (optionally only those not marked inactive)."""
+        query = {"active": {"$ne": False}} if active_only else {}
         try:
-            video = self.db.videos.find_one({"terabox_id": terabox_id})
-            if video:
-                return (video["file_id"], video.get("title"))
+            return await self._run(self.db.users.count_documents, query)
+        except Exception as e:
+            logger.error(f"Error counting users: {e}")
+            return 0
+
+    async def get_user_ids_after(self, after_user_id, limit, active_only=True):
+        """
+        Next `limit` user IDs in user_id order after `after_user_id` (keyset pagination).
+        Returns None if the database could not be read, so callers can tell it from the end.
+        """
+        query = {"active": {"$ne": False}} if active_only else {}
+        if after_user_id is not None:
+            query["user_id"] = {"$gt": after_user_id}
+        try:
+            def fetch():
+                cursor = self.db.users.find(query, {"_id": 0, "user_id": 1}).sort("user_id", 1).limit(limit)
+                return [user["user_id"] for user in cursor]
+            return await self._run(fetch)
+        except Exception as e:
+            logger.error(f"Error fetching user IDs after {after_user_id}: {e}")
             return None
+
+    async def deactivate_users(self, user_ids):
+        """Mark users that blocked the bot as inactive."""
+        for user_id in user_ids:
+            # Re-check them in add_user() if they come back
+            self.known_users.pop(user_id, None)
+        try:
+            await self._run(
+                self.db.users.update_many, {"user_id": {"$in": list(user_ids)}}, {"$set": {"active": False}}
+            )
+        except Exception as e:
+            logger.error(f"Error deactivating users: {e}")
+
+    async def add_broadcast(self, broadcast):
+        """Store a new broadcast."""
+        await self._run(self.db.broadcasts.insert_one, dict(broadcast))
+
+    async def update_broadcast(self, broadcast_id, fields):
+        """Checkpoint a broadcast."""
+        try:
+            await self._run(self.db.broadcasts.update_one, {"broadcast_id": broadcast_id}, {"$set": fields})
+        except Exception as e:
+            logger.error(f"Error updating broadcast {broadcast_id}: {e}")
+
+    async def get_running_broadcasts(self):
+        """Broadcasts that were interrupted before they finished."""
+        try:
+            def fetch():
+                return list(self.db.broadcasts.find({"status": "running"}, {"_id": 0}))
+            return await self._run(fetch)
+        except Exception as e:
+            logger.error(f"Error fetching broadcasts: {e}")
+            return []
+
+    def _cache_video(self, terabox_id, value):
+        """Store a lookup result (None for a miss) in the in-process cache."""
+        ttl = self.video_cache_ttl if value else self.video_negative_ttl
+        self.video_cache[terabox_id] = (time.monotonic() + ttl, value)
+        self.video_cache.move_to_end(terabox_id)
+        while len(self.video_cache) > self.video_cache_size:
+            self.video_cache.popitem(last=False)
+
+    def invalidate_video(self, terabox_id):
+        """Drop a video from the in-process cache."""
+        self.video_cache.pop(terabox_id, None)
+
+    def video_cache_info(self):
+        """Return cache size, counters and hit ratio."""
+        stats = dict(self.video_cache_stats)
+        lookups = stats["hits"] + stats["negative_hits"] + stats["misses"]
+        stats["size"] = len(self.video_cache)
+        stats["hit_ratio"] = (stats["hits"] + stats["negative_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    async def get_video(self, terabox_id):
+        """
+        Retrieve (file_ids, title) by terabox_id.
+        file_ids lists the Telegram file_ids of the parts in order (one for unsplit videos).
+        """
+        cached = self.video_cache.get(terabox_id)
+        if cached:
+            expires_at, value = cached
+            if expires_at > time.monotonic():
+                self.video_cache.move_to_end(terabox_id)
+                self.video_cache_stats["hits" if value else "negative_hits"] += 1
+                return value
+            self.invalidate_video(terabox_id)
+
+        self.video_cache_stats["misses"] += 1
+        try:
+            video = await self._run(self.db.videos.find_one, {"terabox_id": terabox_id})
+            value = (video.get("parts") or [video["file_id"]], video.get("title")) if video else None
+            self._cache_video(terabox_id, value)
+            return value
         except Exception as e:
             logger.error(f"Error fetching video from DB: {e}")
             return None
 
-    def add_video(self, terabox_id, file_id, title):
-        """Add a new video mapping to the database."""
+    async def get_video_media(self, terabox_id):
+        """Probed width/height/duration and thumbnail bytes stored with a video, or None."""
+        try:
+            video = await self._run(self.db.videos.find_one, {"terabox_id": terabox_id}, {"media": 1})
+            return video.get("media") if video else None
+        except Exception as e:
+            logger.error(f"Error fetching video metadata from DB: {e}")
+            return None
+
+    async def add_video(self, terabox_id, file_ids, title, media=None):
+        """
+        Add a new video mapping to the database. `file_ids` are the parts in order,
+        `media` the probed metadata and thumbnail (kept so reprocessing can skip them).
+        """
+        self.invalidate_video(terabox_id)
         try:
             video_data = {
                 "terabox_id": terabox_id,
-                "file_id": file_id,
+                # First part, for readers that only know single-file videos
+                "file_id": file_ids[0],
+                "parts": file_ids,
                 "title": title,
                 "timestamp": int(time.time())
             }
-            self.db.videos.update_one(
+            if media:
+                video_data["media"] = media
+            await self._run(
+                self.db.videos.update_one,
                 {"terabox_id": terabox_id},
                 {"$set": video_data},
                 upsert=True
             )
+            self._cache_video(terabox_id, (file_ids, title))
             logger.info(f"Added video to DB: {terabox_id}")
             return True
         except Exception as e:
             logger.error(f"Error adding video to DB: {e}")
             return False
 
-    def delete_video(self, terabox_id):
+    async def delete_video(self, terabox_id):
         """Delete a video mapping from the database."""
         try:
-            result = self.db.videos.delete_one({"terabox_id": terabox_id})
+            result = await self._run(self.db.videos.delete_one, {"terabox_id": terabox_id})
             logger.info(f"Deleted video from DB: {terabox_id} (Count: {result.deleted_count})")
             return result.deleted_count > 0
         except Exception as e:
             logger.error(f"Error deleting video from DB: {e}")
             return False
+        finally:
+            # Only once the row is gone: a get_video running meanwhile may have cached it again
+            self.invalidate_video(terabox_id)
+
+    def _cache_resolved(self, file_id, expires_at, info, host):
+        self.resolve_cache[file_id] = (expires_at, info, host)
+        self.resolve_cache.move_to_end(file_id)
+        while len(self.resolve_cache) > self.resolve_cache_size:
+            self.resolve_cache.popitem(last=False)
+
+    async def get_resolved(self, file_id):
+        """
+        Look up a resolver result.
+        Returns (info, host): the cached video info if it is still valid (else None) and the
+        host variant that resolved this share last time (or None).
+        """
+        host = None
+        cached = self.resolve_cache.get(file_id)
+        if cached:
+            expires_at, info, host = cached
+            if info and expires_at > time.time():
+                self.resolve_cache.move_to_end(file_id)
+                return dict(info), host
+
+        # Expired or unknown here; another replica may have a fresh result
+        try:
+            doc = await self._run(self.db.resolved.find_one, {"file_id": file_id}, {"_id": 0})
+        except Exception as e:
+            logger.error(f"Error fetching resolver cache from DB: {e}")
+            return None, host
+        if not doc:
+            return None, host
+
+        expires_at = doc.get("info_expires_at", 0)
+        info = doc.get("info") if expires_at > time.time() else None
+        self._cache_resolved(file_id, expires_at, info, doc.get("host"))
+        return (dict(info) if info else None), doc.get("host")
+
+    async def set_resolved(self, file_id, info, host):
+        """Store a resolver result and the host variant that produced it."""
+        expires_at = time.time() + self.resolve_cache_ttl
+        self._cache_resolved(file_id, expires_at, dict(info), host)
+        try:
+            await self._run(
+                self.db.resolved.update_one,
+                {"file_id": file_id},
+                {"$set": {
+                    "info": dict(info),
+                    "host": host,
+                    "info_expires_at": expires_at,
+                    "expire_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=self.resolve_host_ttl),
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error storing resolver cache in DB: {e}")
+
+    async def invalidate_resolved(self, file_id):
+        """Forget a resolved link (e.g. it stopped working) but keep the winning host."""
+        cached = self.resolve_cache.get(file_id)
+        if cached:
+            self._cache_resolved(file_id, 0, None, cached[2])
+        try:
+            await self._run(
+                self.db.resolved.update_one,
+                {"file_id": file_id},
+                {"$set": {"info": None, "info_expires_at": 0}}
+            )
+        except Exception as e:
+            logger.error(f"Error invalidating resolver cache: {e}")
+
+    async def get_cookies(self):
+        """Get every TeraBox cookie of the pool."""
+        try:
+            def fetch():
+                return list(self.db.cookies.find({}, {"_id": 0}))
+            return await self._run(fetch)
+        except Exception as e:
+            logger.error(f"Error fetching cookies from DB: {e}")
+            return []
+
+    async def save_cookie(self, cookie):
+        """Insert or replace a cookie document."""
+        try:
+            await self._run(
+                self.db.cookies.update_one,
+                {"cookie_id": cookie["cookie_id"]},
+                {"$set": cookie},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error saving cookie to DB: {e}")
+
+    async def update_cookie(self, cookie_id, fields):
+        """Update health/usage fields of a cookie."""
+        try:
+            await self._run(self.db.cookies.update_one, {"cookie_id": cookie_id}, {"$set": fields})
+        except Exception as e:
+            logger.error(f"Error updating cookie {cookie_id}: {e}")
+
+    async def delete_cookie(self, cookie_id):
+        """Remove a cookie from the pool."""
+        try:
+            result = await self._run(self.db.cookies.delete_one, {"cookie_id": cookie_id})
+            return result.deleted_count > 0
+        except Exception as e:
+            logger.error(f"Error deleting cookie {cookie_id}: {e}")
+            return False
+
+    async def add_job(self, job):
+        """Store a new download job. Returns False if it could not be stored."""
+        try:
+            await self._run(self.db.jobs.insert_one, dict(job))
+            return True
+        except Exception as e:
+            logger.error(f"Error storing job {job.get('job_id')}: {e}")
+            return False
+
+    async def update_job(self, job_id, fields):
+        """Update fields of a job."""
+        try:
+            await self._run(self.db.jobs.update_one, {"job_id": job_id}, {"$set": fields})
+        except Exception as e:
+            logger.error(f"Error updating job {job_id}: {e}")
+
+    async def add_job_waiter(self, job_id, waiter):
+        """Attach another requester to a job."""
+        try:
+            await self._run(self.db.jobs.update_one, {"job_id": job_id}, {"$push": {"waiters": waiter}})
+        except Exception as e:
+            logger.error(f"Error adding waiter to job {job_id}: {e}")
+
+    async def finish_job(self, job_id, status, error=None):
+        """Mark a job as finished and schedule it for expiry."""
+        expire_at = datetime.datetime.utcnow() + datetime.timedelta(hours=self.job_retention_hours)
+        await self.update_job(job_id, {
+            "status": status,
+            "error": error,
+            "finished_at": int(time.time()),
+            "expire_at": expire_at,
+        })
+
+    async def get_unfinished_jobs(self):
+        """Get queued and running jobs, oldest first."""
+        try:
+            def fetch():
+                cursor = self.db.jobs.find(
+                    {"status": {"$in": ["queued", "running"]}}, {"_id": 0}
+                ).sort("created_at", 1)
+                return list(cursor)
+            return await self._run(fetch)
+        except Exception as e:
+            logger.error(f"Error fetching unfinished jobs: {e}")
+            return []
+
+    async def requeue_jobs(self):
+        """Reset jobs left running by a previous process back to queued."""
+        try:
+            await self._run(
+                self.db.jobs.update_many, {"status": "running"}, {"$set": {"status": "queued"}}
+            )
+        except Exception as e:
+            logger.error(f"Error requeueing jobs: {e}")
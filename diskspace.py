@@ -0,0 +1,117 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class InsufficientDiskSpace(Exception):
+    """The job needs more space than the budget could ever give it."""
+
+class DiskBudget:
+    """
+    Admission control for disk space in the downloads directory.
+    Every job reserves its peak need before it writes anything. The budget is what the
+    bot could use with all of its own files gone: free space (shutil.disk_usage) plus
+    the space taken by files in `directory`, minus a safety margin, optionally capped
+    by `max_bytes`. Reservations are granted in FIFO order; a job that does not fit
+    waits until others release space (or free space grows) instead of failing.
+    """
+    def __init__(self, directory, max_bytes=0, margin=512 * 1024 * 1024, poll_interval=5):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.margin = margin
+        self.poll_interval = poll_interval
+        self.reservations = {}  # key -> bytes
+        self.waiting = deque()  # (key, bytes) in arrival order
+        self.stats = {"granted": 0, "delayed": 0, "rejected": 0, "wait_time": 0.0}
+        self._changed = asyncio.Event()
+
+    def _own_bytes(self):
+        """Space allocated to files in the directory (sparse preallocations count as written)."""
+        total = 0
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except FileNotFoundError:
+            pass
+        return total
+
+    def capacity(self):
+        """Bytes the bot may keep in the directory at once."""
+        usage = shutil.disk_usage(self.directory if os.path.exists(self.directory) else ".")
+        capacity = usage.free + self._own_bytes() - self.margin
+        if self.max_bytes:
+            capacity = min(capacity, self.max_bytes)
+        return max(capacity, 0)
+
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    def available(self):
+        return self.capacity() - self.reserved()
+
+    async def reserve(self, key, nbytes, on_wait=None, check=None):
+        """
+        Reserve `nbytes` for `key`, waiting for room if needed. `on_wait()` is awaited once
+        if the job has to wait; `check()` is called on every wake-up and may raise to give
+        up (e.g. when the user cancels). Raises InsufficientDiskSpace if it can never fit.
+        """
+        if nbytes > self.capacity():
+            self.stats["rejected"] += 1
+            raise InsufficientDiskSpace(f"Needs {nbytes / 1024 ** 3:.2f} GB, budget is {self.capacity() / 1024 ** 3:.2f} GB")
+
+        ticket = (key, nbytes)
+        self.waiting.append(ticket)
+        started = time.monotonic()
+        delayed = False
+        try:
+            while True:
+                if check:
+                    check()
+                if self.waiting[0] is ticket and nbytes <= self.available():
+                    self.waiting.popleft()
+                    self.reservations[key] = nbytes
+                    self.stats["granted"] += 1
+                    if delayed:
+                        self.stats["wait_time"] += time.monotonic() - started
+                        logger.info(f"Disk space for {key} granted after {time.monotonic() - started:.0f}s")
+                    # The next in line may fit as well
+                    self._notify()
+                    return
+
+                if not delayed:
+                    delayed = True
+                    self.stats["delayed"] += 1
+                    logger.info(f"Job {key} waits for {nbytes / 1024 ** 2:.0f} MB of disk space")
+                    if on_wait:
+                        await on_wait()
+
+                # Woken by a release, or re-check free space now and then (other processes)
+                changed = self._changed
+                try:
+                    await asyncio.wait_for(changed.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self._notify()
+
+    def shrink(self, key, nbytes):
+        """Lower a reservation once the job's peak is behind it (e.g. temp files are gone)."""
+        if key in self.reservations and nbytes < self.reservations[key]:
+            self.reservations[key] = nbytes
+            self._notify()
+
+    def release(self, key):
+        if self.reservations.pop(key, None) is not None:
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+class SegmentJournal:
+    """
+    Completed byte ranges of a partial download, stored as JSON next to it.
+    Together with the size and ETag/Last-Modified of the source, this lets a restarted
+    or retried job fetch only the ranges that are still missing.
+    """
+    def __init__(self, path, save_interval=2):
+        self.path = path + ".journal"
+        self.save_interval = save_interval
+        self.size = 0
+        self.validator = None
+        self.done = []  # sorted, merged [start, end] pairs (inclusive)
+        self._last_save = 0
+        self._lock = asyncio.Lock()
+
+    def load(self, size, validator):
+        """Loads the journal if it describes the same source. Returns True on resume."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("size") != size:
+            return False
+        if validator and data.get("validator") and data["validator"] != validator:
+            return False
+        self.size = size
+        self.validator = validator or data.get("validator")
+        self.done = [list(r) for r in data.get("done", [])]
+        return True
+
+    def reset(self, size, validator):
+        self.size = size
+        self.validator = validator
+        self.done = []
+
+    def add(self, start, end):
+        """Marks start..end (inclusive) as written."""
+        merged = []
+        for r in sorted(self.done + [[start, end]]):
+            if merged and r[0] <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], r[1])
+            else:
+                merged.append(r)
+        self.done = merged
+
+    def completed(self):
+        return sum(end - start + 1 for start, end in self.done)
+
+    def missing(self):
+        """Byte ranges (inclusive) that still have to be fetched."""
+        gaps = []
+        position = 0
+        for start, end in self.done:
+            if start > position:
+                gaps.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.size:
+            gaps.append((position, self.size - 1))
+        return gaps
+
+    async def save(self, fd=None, force=False):
+        """
+        Persists the journal in a worker thread, so a slow disk does not stall the event loop.
+        Data is flushed first so it never claims bytes still in flight; saves are written
+        one at a time, in the order they were taken.
+        """
+        now = time.time()
+        if not force and now - self._last_save < self.save_interval:
+            return
+        self._last_save = now
+        # Only ranges written so far are claimed, whatever lands while the sync runs
+        state = {"size": self.size, "validator": self.validator, "done": [list(r) for r in self.done]}
+        async with self._lock:
+            write = asyncio.ensure_future(asyncio.to_thread(self._write, fd, state))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # Let the thread finish before the caller closes fd or saves again
+                await asyncio.wait({write})
+                raise
+
+    def _write(self, fd, state):
+        if fd is not None:
+            os.fdatasync(fd)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class SegmentedDownloader:
+    """
+    Multi-connection HTTP downloader.
+    The file is preallocated, split into byte ranges and every range is fetched on its own
+    request and written in place with pwrite. A failed range is retried from the last
+    byte written instead of from its start. Requests go through the shared HttpPool
+    `http`, so they count against its per-host limit.
+    """
+    def __init__(self, http, segments=8, retries=5, chunk_size=1024 * 1024, timeout=60, min_segment_size=4 * 1024 * 1024):
+        self.http = http
+        self.segments = segments
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.timeout = httpx.Timeout(timeout, connect=30)
+        self.min_segment_size = min_segment_size
+
+    def _stream(self, url, headers):
+        return self.http.stream("GET", url, headers=headers, timeout=self.timeout, follow_redirects=True)
+
+    async def probe(self, url, headers=None):
+        """Returns (size, supports_ranges, final_url, validator) using a one-byte range request."""
+        probe_headers = dict(headers or {}, Range="bytes=0-0")
+        async with self._stream(url, probe_headers) as response:
+            response.raise_for_status()
+            final_url = str(response.url)
+            validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+            content_range = response.headers.get("Content-Range", "")
+            match = re.match(r"bytes 0-0/(\d+)", content_range)
+            if response.status_code == 206 and match:
+                return int(match.group(1)), True, final_url, validator
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else 0), False, final_url, validator
+
+    def split(self, gaps):
+        """Splits the missing ranges into up to `segments` pieces, largest first."""
+        ranges = list(gaps)
+        while len(ranges) < self.segments:
+            largest = max(ranges, key=lambda r: r[1] - r[0], default=None)
+            if largest is None or largest[1] - largest[0] + 1 < 2 * self.min_segment_size:
+                break
+            ranges.remove(largest)
+            middle = (largest[0] + largest[1]) // 2
+            ranges += [(largest[0], middle), (middle + 1, largest[1])]
+        return sorted(ranges)
+
+    async def download(self, url, path, headers=None, progress_hook=None):
+        """
+        Downloads `url` to `path`. `progress_hook` gets yt-dlp style status dicts, so the
+        bot's ProgressHook works unchanged (and can abort by raising). Returns the size.
+        """
+        size, ranged, url, validator = await self.probe(url, headers)
+        journal = SegmentJournal(path)
+        if not size or not ranged:
+            logger.info("Server does not support ranges, using a single connection.")
+            journal.remove()
+            return await self._download_single(url, path, headers, progress_hook)
+
+        resumed = (
+            os.path.exists(path) and os.path.getsize(path) == size
+            and journal.load(size, validator)
+        )
+        if resumed:
+            logger.info(f"Resuming {path}: {journal.completed()}/{size} bytes already on disk.")
+        else:
+            journal.reset(size, validator)
+
+        ranges = self.split(journal.missing())
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not resumed:
+                os.ftruncate(fd, 0)
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    # Filesystem without fallocate support
+                    os.ftruncate(fd, size)
+                await journal.save(force=True)
+
+            progress = {"downloaded": journal.completed(), "started": time.time(), "last": 0, "resumed": journal.completed()}
+            tasks = [
+                asyncio.create_task(self._fetch_range(url, fd, start, end, headers, progress, size, progress_hook, journal))
+                for start, end in ranges
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # Keep what we have for the next attempt
+                await journal.save(fd, force=True)
+                raise
+        finally:
+            os.close(fd)
+
+        journal.remove()
+        self._report(progress_hook, size, size, progress, finished=True)
+        return size
+
+    async def _fetch_range(self, url, fd, start, end, headers, progress, size, progress_hook, journal):
+        position = start
+        attempt = 0
+        while position <= end:
+            before = position
+            try:
+                range_headers = dict(headers or {}, Range=f"bytes={position}-{end}")
+                async with self._stream(url, range_headers) as response:
+                    if response.status_code != 206:
+                        raise httpx.HTTPStatusError(
+                            f"Expected 206, got {response.status_code}", request=response.request, response=response
+                        )
+                    async for chunk in response.aiter_raw(self.chunk_size):
+                        chunk = chunk[:end - position + 1]
+                        # Lands in the page cache; cheap enough to do on the loop
+                        os.pwrite(fd, chunk, position)
+                        journal.add(position, position + len(chunk) - 1)
+                        await journal.save(fd)
+                        position += len(chunk)
+                        progress["downloaded"] += len(chunk)
+                        self._report(progress_hook, progress["downloaded"], size, progress)
+                        if position > end:
+                            break
+                if position == before:
+                    raise httpx.RemoteProtocolError(f"Range {position}-{end} came back empty")
+                # Only progress earns a fresh set of retries
+                attempt = 0
+            except (httpx.HTTPError, OSError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                logger.warning(f"Range {start}-{end} failed at {position} ({e!r}), retry {attempt}/{self.retries}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def _download_single(self, url, path, headers, progress_hook):
+        progress = {"downloaded": 0, "started": time.time(), "last": 0, "resumed": 0}
+        async with self._stream(url, headers) as response:
+            response.raise_for_status()
+            total = int(response.headers.get("Content-Length") or 0)
+            with open(path, "wb") as f:
+                async for chunk in response.aiter_raw(self.chunk_size):
+                    f.write(chunk)
+                    progress["downloaded"] += len(chunk)
+                    self._report(progress_hook, progress["downloaded"], total, progress)
+        self._report(progress_hook, progress["downloaded"], progress["downloaded"], progress, finished=True)
+        return progress["downloaded"]
+
+    def _report(self, progress_hook, downloaded, total, progress, finished=False):
+        if not progress_hook:
+            return
+        now = time.time()
+        # The hook throttles its own message edits; only limit the call rate here
+        if not finished and now - progress["last"] < 1:
+            return
+        progress["last"] = now
+
+        elapsed = max(now - progress["started"], 0.001)
+        speed = (downloaded - progress["resumed"]) / elapsed
+        percent = downloaded / total * 100 if total else 0
+        eta = (total - downloaded) / speed if speed and total else 0
+        progress_hook({
+            "status": "finished" if finished else "downloading",
+            "downloaded_bytes": downloaded,
+            "total_bytes": total,
+            "speed": speed,
+            "_percent_str": f"{percent:.1f}%",
+            "_speed_str": f"{speed / 1024 / 1024:.2f}MiB/s",
+            "_eta_str": time.strftime("%H:%M:%S", time.gmtime(eta)),
+        })
@@ -0,0 +1,480 @@
+import os
+import re
+import json
+import time
+import hmac
+import shutil
+import base64
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import urllib.parse
+from collections import OrderedDict
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK", 206: "Partial Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 416: "Range Not Satisfiable", 502: "Bad Gateway",
+}
+# Upstream answers that mean the resolved link has expired
+EXPIRED_STATUSES = (401, 403, 404, 410)
+URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+KEEPALIVE_TIMEOUT = 30
+
+PLAYER_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Stream</title><style>html,body{{margin:0;height:100%;background:#000}}video{{width:100%;height:100%}}</style></head>
+<body><video id="v" controls autoplay playsinline></video>{script}</body></html>"""
+HLS_SCRIPT = """<script src="https://cdn.jsdelivr.net/npm/hls.js@1"></script><script>
+var v=document.getElementById('v'),src={src};
+if(!v.canPlayType('application/vnd.apple.mpegurl')&&window.Hls&&Hls.isSupported()){{var h=new Hls();h.loadSource(src);h.attachMedia(v);}}else{{v.src=src;}}
+</script>"""
+FILE_SCRIPT = "<script>document.getElementById('v').src={src};</script>"
+
+class GatewayError(Exception):
+    def __init__(self, status, message=None, size=None):
+        super().__init__(message or REASONS.get(status, "Error"))
+        self.status = status
+        self.size = size  # Full length, reported with a 416
+
+class LinkExpired(Exception):
+    """The resolved upstream link no longer works; resolve it again."""
+
+def parse_range(header, size):
+    """(start, end) of a single 'bytes=' range, None without one; raises GatewayError(416)."""
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None  # Not a range we serve: send everything
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise GatewayError(416)
+    return start, end
+
+class ChunkCache:
+    """
+    Bounded on-disk cache of upstream bytes, evicting the least recently used entries.
+    Concurrent misses for one key share a single fetch, which runs on its own so a
+    viewer disconnecting does not fail the others. Starts empty on every run.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> size, least recently used first
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "shared": 0, "evicted": 0}
+        self._inflight = {}  # key -> fetch task
+
+    def open(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    async def get(self, key, fetch):
+        """Bytes for `key`: from disk, from a fetch already running, or from `await fetch()`."""
+        if key in self.entries:
+            try:
+                data = await asyncio.to_thread(_read_file, self._path(key))
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return data
+            except OSError:
+                self._forget(key)
+
+        task = self._inflight.get(key)
+        if task:
+            self.stats["shared"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = self._start(key, fetch)
+        return await asyncio.shield(task)
+
+    def prefetch(self, key, fetch):
+        """Start fetching `key` in the background unless it is cached or already coming."""
+        if key not in self.entries and key not in self._inflight:
+            self._start(key, fetch)
+
+    def _start(self, key, fetch):
+        task = asyncio.get_running_loop().create_task(self._fill(key, fetch))
+        self._inflight[key] = task
+        # Nobody may be waiting for a failed prefetch; don't warn about it
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _fill(self, key, fetch):
+        try:
+            data = await fetch()
+            if len(data) <= self.max_bytes:
+                await asyncio.to_thread(_write_file, self._path(key), data)
+                self._add(key, len(data))
+            return data
+        finally:
+            self._inflight.pop(key, None)
+
+    def _add(self, key, size):
+        self._forget(key)
+        self.entries[key] = size
+        self.size += size
+        while self.size > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            self._forget(oldest)
+            self.stats["evicted"] += 1
+
+    def _forget(self, key):
+        size = self.entries.pop(key, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _write_file(path, data):
+    with open(path + ".tmp", 'wb') as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+class Gateway:
+    """
+    HTTP gateway that streams TeraBox files to browsers and players.
+    Direct files are served with byte ranges, read upstream in fixed-size chunks;
+    HLS manifests are rewritten so segments (and nested playlists) come through the
+    gateway as well. Chunks and segments go through the ChunkCache, so any number of
+    viewers of one file cost one upstream fetch per chunk. All links are signed with
+    HMAC and expire.
+
+    `source(file_id, refresh)` returns the upstream (url, headers, is_hls) for a file,
+    re-resolving it when `refresh` is set; (None, None, False) if it cannot be resolved.
+    """
+    def __init__(self, http, source, secret, base_url, cache, chunk_size=2 * 1024 * 1024,
+                 link_ttl=6 * 3600, host="0.0.0.0", port=8000):
+        self.http = http
+        self.source = source
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.link_ttl = link_ttl
+        self.host = host
+        self.port = port
+        self.files = OrderedDict()  # file_id -> (size, content_type) of direct files
+        self._server = None
+        self._connections = set()  # handler tasks
+
+    async def start(self):
+        self.cache.open()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Streaming gateway listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    # Links
+
+    def _signature(self, file_id, upstream, expires):
+        message = f"{file_id}\n{upstream}\n{expires}".encode()
+        digest = hmac.new(self.secret, message, hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def _path(self, kind, file_id, expires, upstream=""):
+        query = {"e": expires, "s": self._signature(file_id, upstream, expires)}
+        if upstream:
+            query["u"] = upstream
+        return f"/{kind}/{urllib.parse.quote(file_id)}?{urllib.parse.urlencode(query)}"
+
+    def watch_url(self, file_id):
+        """Signed link to the player page."""
+        return self.base_url + self._path("w", file_id, int(time.time() + self.link_ttl))
+
+    def stream_url(self, file_id, hls):
+        """Signed link to the file itself (or its HLS manifest), for external players."""
+        return self.base_url + self._path("m" if hls else "f", file_id, int(time.time() + self.link_ttl))
+
+    def _verify(self, file_id, query):
+        try:
+            expires = int(query.get("e", ""))
+        except ValueError:
+            raise GatewayError(403)
+        if expires < time.time():
+            raise GatewayError(403, "Link expired")
+        expected = self._signature(file_id, query.get("u", ""), expires)
+        if not hmac.compare_digest(expected, query.get("s", "")):
+            raise GatewayError(403)
+        return expires
+
+    # HTTP
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if method not in ("GET", "HEAD"):
+                    # Bodies are not read, so the connection cannot be reused
+                    await self._send_error(writer, GatewayError(405), keep_alive=False)
+                    break
+                await self._dispatch(writer, method, target, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError, ValueError):
+            # Idle, stopped, dropped or malformed: just close (cancellation ends here,
+            # asyncio's stream callback does not expect a cancelled handler)
+            pass
+        except Exception as e:
+            logger.error(f"Gateway connection failed: {e}")
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _dispatch(self, writer, method, target, headers, keep_alive):
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        kind, _, file_id = url.path.strip("/").partition("/")
+        file_id = urllib.parse.unquote(file_id)
+        head = method == "HEAD"
+        try:
+            if kind in ("", "health"):
+                await self._send(writer, 200, {"Content-Type": "text/plain"}, b"OK", head, keep_alive)
+                return
+            if kind not in ("w", "f", "m", "s") or not file_id:
+                raise GatewayError(404)
+            expires = self._verify(file_id, query)
+            if kind == "w":
+                await self._serve_player(writer, file_id, expires, head, keep_alive)
+            elif kind == "f":
+                await self._serve_file(writer, file_id, headers.get("range"), head, keep_alive)
+            elif kind == "m":
+                await self._serve_manifest(writer, file_id, query.get("u"), expires, head, keep_alive)
+            elif query.get("u"):
+                await self._serve_segment(writer, file_id, query["u"], headers.get("range"), head, keep_alive)
+            else:
+                raise GatewayError(400)
+        except GatewayError as e:
+            await self._send_error(writer, e, keep_alive)
+
+    async def _send(self, writer, status, headers, body=b"", head=False, keep_alive=True):
+        headers = dict(headers)
+        headers.setdefault("Content-Length", str(len(body)))
+        headers["Access-Control-Allow-Origin"] = "*"
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        if body and not head:
+            writer.write(body)
+        await writer.drain()
+
+    async def _send_error(self, writer, error, keep_alive):
+        headers = {"Content-Type": "text/plain"}
+        if error.size is not None:
+            headers["Content-Range"] = f"bytes */{error.size}"
+        await self._send(writer, error.status, headers, str(error).encode(), keep_alive=keep_alive)
+
+    # Upstream
+
+    async def _upstream(self, file_id, fetch):
+        """Run `fetch(url, headers)` against the file's link, resolving it again once if it expired."""
+        for refresh in (False, True):
+            url, headers, _ = await self.source(file_id, refresh)
+            if not url:
+                raise GatewayError(404, "Video not found")
+            try:
+                return await fetch(url, headers)
+            except LinkExpired:
+                logger.info(f"Gateway link for {file_id} expired, resolving again")
+            except GatewayError:
+                raise
+            except Exception as e:
+                logger.warning(f"Gateway upstream request for {file_id} failed: {e}")
+                raise GatewayError(502)
+        raise GatewayError(502, "Upstream link keeps failing")
+
+    async def _fetch_range(self, file_id, start, end):
+        """Bytes start..end (inclusive) of a direct file; records its size and type."""
+        async def fetch(url, headers):
+            headers = dict(headers, Range=f"bytes={start}-{end}")
+            async with self.http.stream("GET", url, headers=headers, follow_redirects=True) as response:
+                if response.status_code in EXPIRED_STATUSES:
+                    raise LinkExpired()
+                if response.status_code == 416:
+                    raise GatewayError(416)
+                if response.status_code == 206:
+                    size = int(response.headers.get("Content-Range", "").rpartition("/")[2])
+                elif response.status_code == 200 and start == 0:
+                    # Range ignored; only acceptable when that is the whole file anyway
+                    size = int(response.headers.get("Content-Length") or -1)
+                    if not 0 <= size <= end + 1:
+                        raise GatewayError(502, "Upstream does not support ranges")
+                else:
+                    raise GatewayError(502)
+                self._remember(file_id, size, response.headers.get("Content-Type"))
+                return await response.aread()
+        return await self._upstream(file_id, fetch)
+
+    def _remember(self, file_id, size, content_type):
+        if not content_type or not content_type.startswith(("video/", "audio/")):
+            content_type = "video/mp4"
+        self.files[file_id] = (size, content_type)
+        self.files.move_to_end(file_id)
+        while len(self.files) > 10000:
+            self.files.popitem(last=False)
+
+    def _chunk(self, file_id, index, prefetch=False):
+        start = index * self.chunk_size
+        end = start + self.chunk_size - 1
+        size = self.files[file_id][0]
+        key = f"f:{file_id}:{index}"
+        fetch = partial(self._fetch_range, file_id, start, min(end, size - 1))
+        if prefetch:
+            if start < size:
+                self.cache.prefetch(key, fetch)
+            return None
+        return self.cache.get(key, fetch)
+
+    # Handlers
+
+    async def _serve_player(self, writer, file_id, expires, head, keep_alive):
+        _, _, hls = await self.source(file_id, False)
+        src = json.dumps(self._path("m" if hls else "f", file_id, expires))
+        script = (HLS_SCRIPT if hls else FILE_SCRIPT).format(src=src)
+        body = PLAYER_PAGE.format(script=script).encode()
+        await self._send(writer, 200, {"Content-Type": "text/html; charset=utf-8"}, body, head, keep_alive)
+
+    async def _serve_file(self, writer, file_id, range_header, head, keep_alive):
+        if file_id not in self.files:
+            # Learn the size (and warm the cache) with the first chunk
+            await self.cache.get(f"f:{file_id}:0", partial(self._fetch_range, file_id, 0, self.chunk_size - 1))
+            if file_id not in self.files:
+                # Chunk came from the cache of an earlier request; ask for the size alone
+                await self._fetch_range(file_id, 0, 0)
+        size, content_type = self.files[file_id]
+
+        try:
+            byte_range = parse_range(range_header, size)
+        except GatewayError:
+            raise GatewayError(416, size=size)
+        start, end = byte_range or (0, size - 1)
+        headers = {
+            "Content-Type": content_type,
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "private, max-age=3600",
+        }
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await self._send(writer, 206 if byte_range else 200, headers, head=True, keep_alive=keep_alive)
+        if head:
+            return
+
+        # Headers are out: from here on, a failure can only drop the connection
+        try:
+            for index in range(start // self.chunk_size, end // self.chunk_size + 1):
+                # Read ahead so the next chunk is on its way while this one is sent
+                self._chunk(file_id, index + 1, prefetch=True)
+                data = await self._chunk(file_id, index)
+                offset = index * self.chunk_size
+                writer.write(data[max(start - offset, 0):end - offset + 1])
+                await writer.drain()
+        except GatewayError as e:
+            raise ConnectionError(f"Upstream failed mid-response: {e}")
+
+    async def _serve_manifest(self, writer, file_id, upstream, expires, head, keep_alive):
+        async def fetch(url, headers):
+            response = await self.http.get(upstream or url, headers=headers, follow_redirects=True)
+            if response.status_code in EXPIRED_STATUSES and not upstream:
+                raise LinkExpired()
+            if response.status_code != 200 or "#EXTM3U" not in response.text[:1024]:
+                raise GatewayError(502, "Upstream is not an HLS playlist")
+            return str(response.url), response.text
+
+        base, text = await self._upstream(file_id, fetch)
+        body = self._rewrite(file_id, base, text, expires).encode()
+        headers = {"Content-Type": "application/vnd.apple.mpegurl", "Cache-Control": "no-cache"}
+        await self._send(writer, 200, headers, body, head, keep_alive)
+
+    def _rewrite(self, file_id, base, text, expires):
+        """Point every URI in an HLS playlist at the gateway."""
+        def link(uri, playlist):
+            absolute = urllib.parse.urljoin(base, uri)
+            if ".m3u8" in urllib.parse.urlsplit(absolute).path.lower():
+                playlist = True
+            return self._path("m" if playlist else "s", file_id, expires, absolute)
+
+        lines = []
+        variant = False
+        for line in text.splitlines():
+            stripped = line.strip()
+            if not stripped:
+                lines.append(line)
+            elif stripped.startswith("#"):
+                # Alternate renditions are playlists; keys and init segments are plain files
+                playlist = stripped.startswith(("#EXT-X-MEDIA", "#EXT-X-I-FRAME-STREAM-INF"))
+                lines.append(URI_ATTRIBUTE.sub(lambda m: f'URI="{link(m.group(1), playlist)}"', line))
+                variant = stripped.startswith("#EXT-X-STREAM-INF")
+            else:
+                lines.append(link(stripped, variant))
+                variant = False
+        return "\n".join(lines) + "\n"
+
+    async def _serve_segment(self, writer, file_id, upstream, range_header, head, keep_alive):
+        async def fetch(url, headers):
+            response = await self.http.get(upstream, headers=headers, follow_redirects=True)
+            if response.status_code != 200:
+                raise GatewayError(502)
+            return response.content
+
+        key = "s:" + hashlib.sha1(f"{file_id}\n{upstream}".encode()).hexdigest()
+        data = await self.cache.get(key, partial(self._upstream, file_id, fetch))
+        content_type = mimetypes.guess_type(urllib.parse.urlsplit(upstream).path)[0]
+        if not content_type or upstream.lower().split("?")[0].endswith(".ts"):
+            content_type = "video/mp2t"
+
+        try:
+            byte_range = parse_range(range_header, len(data))
+        except GatewayError:
+            raise GatewayError(416, size=len(data))
+        headers = {"Content-Type": content_type, "Accept-Ranges": "bytes", "Cache-Control": "private, max-age=3600"}
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            data = data[start:end + 1]
+        await self._send(writer, 206 if byte_range else 200, headers, data, head, keep_alive)
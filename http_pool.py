@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import urllib.parse
+from contextlib import asynccontextmanager
+import httpx
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class HttpPool:
+    """
+    One pooled httpx.AsyncClient shared by the bot's outbound calls.
+    Connections are kept alive (HTTP/2 when the `h2` package is installed), every
+    request has a timeout, and each host gets at most `per_host` requests in flight.
+    The client is created on first use, after HTTP_PROXY/HTTPS_PROXY have been applied
+    to the environment, which httpx picks up itself.
+    """
+    def __init__(self, max_connections=100, per_host=10, timeout=30, connect_timeout=10):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._client = None
+        self._host_limits = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60,
+                ),
+                trust_env=True,
+            )
+        return self._client
+
+    def _limit(self, url):
+        host = urllib.parse.urlsplit(str(url)).netloc.lower()
+        limit = self._host_limits.get(host)
+        if limit is None:
+            limit = self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return limit
+
+    def _check_timeout(self, kwargs):
+        if "timeout" in kwargs and kwargs["timeout"] is None:
+            raise ValueError("Outbound requests must have a timeout")
+
+    async def request(self, method, url, **kwargs):
+        """Like httpx.AsyncClient.request, bounded per host. The body is read before returning."""
+        self._check_timeout(kwargs)
+        async with self._limit(url):
+            return await self.client.request(method, url, **kwargs)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        """Streaming request; the host slot is held until the response is closed."""
+        self._check_timeout(kwargs)
+        async with self._limit(url):
+            async with self.client.stream(method, url, **kwargs) as response:
+                yield response
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Who a job is delivered to first; waiters carry the same fields
+REQUESTER_FIELDS = ("user_id", "user_mention", "chat_id", "message_id", "status_message_id")
+
+class JobQueue:
+    """
+    Persistent download job queue.
+    Jobs are stored in the `jobs` collection so queued and in-flight work survives a restart.
+    Queued jobs are served round-robin across users, so one user posting many links
+    cannot starve everyone else. Only one job per TeraBox file is active at a time;
+    later requests for the same file are attached to it as waiters.
+    """
+    def __init__(self, db, workers=2, max_attempts=3, position_interval=15):
+        self.db = db
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.position_interval = position_interval
+
+        self.queues = OrderedDict()  # user_id -> deque of queued jobs, in round-robin order
+        self.active = {}             # job_id -> job (queued or running)
+        self.by_file = {}            # terabox file_id -> active job
+        self.running = 0
+        self._storing = {}           # job_id -> task inserting a new job
+
+        self._ready = asyncio.Semaphore(0)
+        self._tasks = []
+        self._handler = None
+        self._on_position = None
+
+    async def start(self, handler, on_position=None):
+        """
+        Recover unfinished jobs and start the workers.
+        `handler(job)` processes one job; `on_position(job, position)` is called when a
+        queued job moves up in line.
+        """
+        self._handler = handler
+        self._on_position = on_position
+
+        # Jobs that were running when we stopped are queued again
+        for job in await self.db.get_unfinished_jobs():
+            if job.get("attempts", 0) >= self.max_attempts:
+                logger.warning(f"Dropping job {job['job_id']} after {job['attempts']} attempts.")
+                await self.db.finish_job(job["job_id"], "failed", "Too many attempts")
+                continue
+            job["status"] = "queued"
+            job.setdefault("waiters", [])
+            self._push(job)
+        await self.db.requeue_jobs()
+
+        if self.active:
+            logger.info(f"Recovered {len(self.active)} unfinished jobs.")
+
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(i)) for i in range(self.workers)]
+        if on_position:
+            self._tasks.append(loop.create_task(self._position_loop()))
+
+    async def stop(self):
+        """Stop the workers. Running jobs stay 'running' in the DB and are recovered on start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, job):
+        """
+        Persist and queue a new job. Returns its position in line.
+        Without the database the job still runs; it is just not recovered after a restart.
+        """
+        job.update({
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "attempts": 0,
+            "waiters": [],
+            "created_at": int(time.time()),
+        })
+        # Claim the file before the insert yields, so a second request for it joins this job
+        self._register(job)
+        storing = self._storing[job["job_id"]] = asyncio.ensure_future(self.db.add_job(job))
+        try:
+            stored = await storing
+        except BaseException:
+            self._release(job)
+            raise
+        finally:
+            del self._storing[job["job_id"]]
+        if not stored:
+            logger.warning(f"Job {job['job_id']} was not stored, it is kept in memory only.")
+        self._queue(job)
+        return self.position(job["job_id"])
+
+    def find_active(self, file_id):
+        """Return the queued or running job for a TeraBox file, if any."""
+        return self.by_file.get(file_id)
+
+    async def add_waiter(self, job, waiter):
+        """
+        Attach another requester to an active job.
+        Returns False if the job has already delivered its result or is being stopped.
+        """
+        storing = self._storing.get(job["job_id"])
+        if storing:
+            # The waiter is pushed onto the stored document, so it has to exist first
+            await asyncio.wait({storing})
+        if job.get("closed") or job.get("cancelled"):
+            return False
+        job["waiters"].append(waiter)
+        await self.db.add_job_waiter(job["job_id"], waiter)
+        return True
+
+    async def cancel(self, job_id, user_id):
+        """
+        Detach the requester `user_id` from a job. Returns what happened:
+        "handed_over" if someone else waits for the same file (the first waiter becomes
+        the requester and the job keeps going), "removed" if it was still queued,
+        "stopping" if it is running and the caller has to stop it, or None if there is
+        no such job of this user.
+        """
+        job = self.active.get(job_id)
+        if not job or job["user_id"] != user_id or job.get("cancelled") or job_id in self._storing:
+            return None
+
+        if job["waiters"]:
+            waiter = job["waiters"].pop(0)
+            queued = self._unqueue(job)
+            # Waiters stored before they carried a user_id keep the requester's
+            job.update({field: waiter[field] for field in REQUESTER_FIELDS if field in waiter})
+            job.pop("position", None)
+            if queued:
+                # Served in the new requester's turn, ahead of their other jobs
+                self.queues.setdefault(job["user_id"], deque()).appendleft(job)
+            await self.db.update_job(job_id, {
+                **{field: job.get(field) for field in REQUESTER_FIELDS},
+                "waiters": job["waiters"],
+            })
+            return "handed_over"
+
+        if job["status"] != "queued":
+            job["cancelled"] = True
+            return "stopping"
+
+        self._unqueue(job)
+        self._release(job)
+        job["status"] = "cancelled"
+        await self.db.finish_job(job_id, "cancelled")
+        return "removed"
+
+    def ordered(self):
+        """Yield queued jobs in the order the workers will pick them."""
+        user_queues = list(self.queues.values())
+        depth = 0
+        while True:
+            found = False
+            for user_queue in user_queues:
+                if len(user_queue) > depth:
+                    found = True
+                    yield user_queue[depth]
+            if not found:
+                return
+            depth += 1
+
+    def position(self, job_id):
+        """1-based position of a queued job, or None if it is not waiting."""
+        for index, job in enumerate(self.ordered(), start=1):
+            if job["job_id"] == job_id:
+                return index
+        return None
+
+    def stats(self):
+        """Queue depth for admin commands."""
+        return {
+            "queued": sum(len(q) for q in self.queues.values()),
+            "running": self.running,
+            "users": len(self.queues),
+            "workers": self.workers,
+        }
+
+    def _push(self, job):
+        self._register(job)
+        self._queue(job)
+
+    def _register(self, job):
+        self.active[job["job_id"]] = job
+        current = self.by_file.get(job["file_id"])
+        if current is None or current.get("cancelled"):
+            self.by_file[job["file_id"]] = job
+
+    def _queue(self, job):
+        self.queues.setdefault(job["user_id"], deque()).append(job)
+        self._ready.release()
+
+    def _unqueue(self, job):
+        """Take a job out of its user's queue. Returns False if it was not queued."""
+        user_queue = self.queues.get(job["user_id"])
+        if user_queue is None or job not in user_queue:
+            return False
+        user_queue.remove(job)
+        if not user_queue:
+            del self.queues[job["user_id"]]
+        return True
+
+    def _pop_next(self):
+        if not self.queues:
+            return None
+        # Take the head of the user that was served longest ago, then move that user to the back
+        user_id, user_queue = self.queues.popitem(last=False)
+        job = user_queue.popleft()
+        if user_queue:
+            self.queues[user_id] = user_queue
+        return job
+
+    def _release(self, job):
+        job["closed"] = True
+        self.active.pop(job["job_id"], None)
+        if self.by_file.get(job["file_id"]) is job:
+            del self.by_file[job["file_id"]]
+
+    async def _worker(self, index):
+        while True:
+            await self._ready.acquire()
+            job = self._pop_next()
+            if job is None:
+                # Job was cancelled while queued
+                continue
+
+            job["status"] = "running"
+            job["attempts"] = job.get("attempts", 0) + 1
+            self.running += 1
+            try:
+                await self.db.update_job(job["job_id"], {
+                    "status": "running",
+                    "attempts": job["attempts"],
+                    "started_at": int(time.time()),
+                })
+                await self._handler(job)
+                status, error = "done", None
+            except asyncio.CancelledError:
+                # Shutting down: leave the job as 'running' so it is recovered
+                self.running -= 1
+                raise
+            except Exception as e:
+                logger.error(f"Worker {index} failed job {job['job_id']}: {e}")
+                status, error = ("cancelled" if job.get("cancelled") else "failed"), str(e)
+
+            self.running -= 1
+            self._release(job)
+            job["status"] = status
+            await self.db.finish_job(job["job_id"], status, error)
+
+    async def _position_loop(self):
+        while True:
+            await asyncio.sleep(self.position_interval)
+            for position, job in enumerate(list(self.ordered()), start=1):
+                if job.get("position") == position:
+                    continue
+                job["position"] = position
+                try:
+                    await self._on_position(job, position)
+                except Exception as e:
+                    logger.debug(f"Position update failed for {job['job_id']}: {e}")
@@ -0,0 +1,258 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets (seconds) for single calls and for whole downloads/uploads
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """
+    Base for labelled metrics. Values are keyed by the label values in `labelnames`
+    order; updates are safe from worker threads (ffmpeg, uploads, pymongo executor).
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """For totals that are counted elsewhere (the stats dicts), copied in at scrape time."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=FAST_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [count per bucket..., sum]
+                state = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, also when it raises."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _samples(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Registry:
+    """
+    All metrics of the process, rendered in the Prometheus text format.
+    Collectors are called before every render to copy in values that live elsewhere
+    (queue depths, cache counters), so nothing has to be updated on the hot path.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# Pipeline
+STAGE_SECONDS = Histogram(
+    "terabot_stage_seconds", "Time a job spends in a pipeline stage handler.",
+    ["stage", "outcome"], buckets=SLOW_BUCKETS)
+STAGE_QUEUED = Gauge("terabot_stage_queued", "Jobs waiting in a stage's handoff queue.", ["stage"])
+STAGE_ACTIVE = Gauge("terabot_stage_active", "Jobs a stage is working on.", ["stage"])
+STAGE_CONCURRENCY = Gauge("terabot_stage_concurrency", "Workers of a stage.", ["stage"])
+JOBS_QUEUED = Gauge("terabot_jobs_queued", "Jobs waiting for a job queue worker.")
+JOBS_RUNNING = Gauge("terabot_jobs_running", "Jobs being processed.")
+JOB_WORKERS = Gauge("terabot_job_workers", "Job queue workers (the active job limit).")
+
+# Job steps
+RESOLVE_SECONDS = Histogram(
+    "terabot_resolve_seconds", "get_video_info_multi duration by result (cached, resolved, failed).",
+    ["result"], buckets=FAST_BUCKETS + (45, 60))
+DOWNLOAD_SECONDS = Histogram(
+    "terabot_download_seconds", "Download duration by engine.", ["engine"], buckets=SLOW_BUCKETS)
+DOWNLOAD_BYTES = Counter("terabot_download_bytes_total", "Bytes downloaded, by engine.", ["engine"])
+FASTSTART_SECONDS = Histogram(
+    "terabot_faststart_seconds", "FastStart duration by method (skipped, in_place, ffmpeg, failed).",
+    ["method"], buckets=SLOW_BUCKETS)
+UPLOAD_SECONDS = Histogram(
+    "terabot_upload_seconds", "send_video duration of one file by mode (upload, local, stream).",
+    ["mode"], buckets=SLOW_BUCKETS)
+UPLOAD_BYTES = Counter("terabot_upload_bytes_total", "Video bytes sent to Telegram, by mode.", ["mode"])
+
+# Telegram Bot API
+TELEGRAM_SECONDS = Histogram(
+    "terabot_telegram_request_seconds", "Bot API request duration by method.", ["method"],
+    buckets=FAST_BUCKETS + (60, 120, 300))
+TELEGRAM_ERRORS = Counter(
+    "terabot_telegram_errors_total", "Failed Bot API requests by method and HTTP status ('network' if none).",
+    ["method", "code"])
+TELEGRAM_RETRY_AFTER = Counter(
+    "terabot_telegram_retry_after_total", "Bot API requests answered with RetryAfter (flood control).", ["method"])
+
+# MongoDB
+MONGO_SECONDS = Histogram(
+    "terabot_mongo_op_seconds", "pymongo call duration by operation, excluding the wait for an executor thread.",
+    ["op"])
+
+# Caches and disk
+VIDEO_CACHE_LOOKUPS = Counter(
+    "terabot_video_cache_lookups_total", "Video cache lookups by result (hit, negative_hit, miss).", ["result"])
+VIDEO_CACHE_HIT_RATIO = Gauge("terabot_video_cache_hit_ratio", "Share of video cache lookups answered from memory.")
+VIDEO_CACHE_SIZE = Gauge("terabot_video_cache_entries", "Entries in the in-process video cache.")
+GATEWAY_CHUNKS = Counter(
+    "terabot_gateway_chunks_total", "Streaming gateway chunks by result (hit, miss, shared, evicted).",
+    ["result"])
+DISK_RESERVED = Gauge("terabot_disk_reserved_bytes", "Disk space reserved by running jobs.")
+DISK_CAPACITY = Gauge("terabot_disk_capacity_bytes", "Disk space jobs may use in the downloads directory.")
+DISK_WAITING = Gauge("terabot_disk_waiting_jobs", "Jobs waiting for disk space.")
+PROGRESS_PENDING = Gauge("terabot_progress_pending_edits", "Progress message edits waiting to be sent.")
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call and counts errors and flood control answers."""
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        # .../bot<token>/sendVideo -> sendVideo; file downloads would carry a path instead
+        api_method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.monotonic()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            TELEGRAM_ERRORS.inc(method=api_method, code="network")
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.monotonic() - started, method=api_method)
+        if code == 429:
+            TELEGRAM_RETRY_AFTER.inc(method=api_method)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(method=api_method, code=code)
+        return code, payload
+
+class MetricsServer:
+    """Serves GET /metrics for a Prometheus scraper. Meant for a local port, not the public one."""
+    def __init__(self, host="127.0.0.1", port=9464):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics served on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            parts = request.split(b"\r\n", 1)[0].split()
+            path = parts[1].split(b"?", 1)[0] if len(parts) > 1 else b""
+            if parts and parts[0] == b"GET" and path == b"/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", registry.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
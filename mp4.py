@@ -0,0 +1,160 @@
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Boxes on the path from moov down to the chunk offset tables
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+FREE_BOXES = {b'free', b'skip'}
+
+# fallocate(2) mode that shifts the rest of the file to open a hole (ext4, xfs)
+FALLOC_FL_INSERT_RANGE = 0x20
+
+_libc = None
+
+def read_boxes(f, start, end):
+    """
+    Parses the box headers between start and end.
+    Returns a list of (type, offset, size, header_size).
+    """
+    boxes = []
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # Box extends to the end of the file
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ValueError(f"Corrupt box {box_type!r} at {offset}")
+        boxes.append((box_type, offset, size, header_size))
+        offset += size
+    return boxes
+
+def inspect(path):
+    """Returns the top-level box layout of an MP4 file."""
+    with open(path, 'rb') as f:
+        return read_boxes(f, 0, os.fstat(f.fileno()).st_size)
+
+def is_faststart(path):
+    """True if moov already precedes mdat (or the file is not a plain MP4)."""
+    boxes = inspect(path)
+    types = [box[0] for box in boxes]
+    if b'moov' not in types or b'mdat' not in types:
+        return True
+    return types.index(b'moov') < types.index(b'mdat')
+
+def _shift_chunk_offsets(moov, delta):
+    """Adds delta to every stco/co64 entry of an in-memory moov box."""
+    def walk(start, end):
+        offset = start
+        while offset + 8 <= end:
+            size, box_type = struct.unpack_from('>I4s', moov, offset)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', moov, offset + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - offset
+            if size < header_size:
+                raise ValueError(f"Corrupt box {box_type!r} in moov")
+
+            if box_type in CONTAINER_BOXES:
+                walk(offset + header_size, offset + size)
+            elif box_type in (b'stco', b'co64'):
+                # version/flags (4) + entry_count (4), then the offsets
+                table = offset + header_size + 4
+                count = struct.unpack_from('>I', moov, table)[0]
+                fmt = f'>{count}I' if box_type == b'stco' else f'>{count}Q'
+                entries = struct.unpack_from(fmt, moov, table + 4)
+                shifted = [entry + delta for entry in entries]
+                if box_type == b'stco' and shifted and max(shifted) > 0xFFFFFFFF:
+                    raise OverflowError("stco offsets overflow after relocation")
+                struct.pack_into(fmt, moov, table + 4, *shifted)
+            offset += size
+
+    walk(0, len(moov))
+
+def _free_box(size):
+    return struct.pack('>I4s', size, b'free') + b'\0' * (size - 8)
+
+def _insert_range(fd, offset, length):
+    """Opens a zero-filled hole of `length` bytes at `offset` without copying the rest of the file."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    if _libc.fallocate(fd, FALLOC_FL_INSERT_RANGE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def _drop_old_moov(f, offset, size, file_size):
+    """Removes the trailing moov, or turns it into a free box if something follows it."""
+    if offset + size == file_size:
+        f.truncate(offset)
+    else:
+        f.seek(offset + 4)
+        f.write(b'free')
+
+def relocate_moov(path):
+    """
+    Moves moov in front of mdat in place.
+    Only the head of the file and the stco/co64 tables are rewritten; the media data
+    stays where it is (reused free space) or is shifted by the filesystem
+    (FALLOC_FL_INSERT_RANGE). Returns False if neither is possible.
+    """
+    boxes = inspect(path)
+    # moov has to precede the first mdat (see is_faststart), not just the last one
+    _, moov_offset, moov_size, _ = next(box for box in boxes if box[0] == b'moov')
+    _, mdat_offset, _, _ = next(box for box in boxes if box[0] == b'mdat')
+
+    with open(path, 'r+b') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+
+        # 1. A free box before mdat is big enough: media does not move at all
+        for box_type, offset, size, _ in boxes:
+            if offset >= mdat_offset:
+                break
+            if box_type in FREE_BOXES and (size == moov_size or size - moov_size >= 8):
+                f.seek(offset)
+                f.write(moov)
+                if size > moov_size:
+                    f.write(_free_box(size - moov_size))
+                _drop_old_moov(f, moov_offset, moov_size, file_size)
+                return True
+
+        # 2. Open a block-aligned hole in front of mdat and shift the chunk offsets
+        block_size = os.statvfs(path).f_bsize
+        insert_at = mdat_offset - (mdat_offset % block_size)
+        hole = -(-(moov_size + 8) // block_size) * block_size
+        try:
+            _shift_chunk_offsets(moov, hole)
+        except (OverflowError, ValueError) as e:
+            logger.warning(f"Cannot relocate moov in place: {e}")
+            return False
+
+        f.seek(insert_at)
+        head = f.read(mdat_offset - insert_at)
+        try:
+            _insert_range(f.fileno(), insert_at, hole)
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                logger.info(f"In-place insert not supported here: {e}")
+                return False
+            raise
+
+        # [boxes before mdat][moov][free padding][mdat header + untouched media]
+        f.seek(insert_at)
+        f.write(head + moov + _free_box(hole - moov_size))
+        _drop_old_moov(f, moov_offset + hole, moov_size, file_size + hole)
+        return True
@@ -0,0 +1,109 @@
+import time
+import asyncio
+import logging
+import contextvars
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+class Stage:
+    """A named pool of workers draining a bounded queue of jobs."""
+    def __init__(self, name, handler, concurrency, queue_size):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.active = 0
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "active": self.active,
+            "concurrency": self.concurrency,
+        }
+
+class Pipeline:
+    """
+    Runs jobs through a chain of stages.
+    Each stage handler is called as `handler(context, job)` and returns the name of the
+    next stage, or None when the job is finished. Handoff queues are bounded, so a slow
+    stage pushes back on the one before it instead of piling up work (and files on disk).
+    Handlers run in the contextvars context of the run() call, so a job's trace context
+    follows it from worker to worker.
+    """
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+        self.first = stages[0].name
+        self.context = None
+        self._tasks = []
+
+    def start(self, context):
+        """Start the stage workers. `context` is passed to every handler."""
+        self.context = context
+        loop = asyncio.get_running_loop()
+        for stage in self.stages.values():
+            for index in range(stage.concurrency):
+                self._tasks.append(loop.create_task(self._worker(stage, index)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run(self, job, stage=None):
+        """Feed a job into the pipeline (first stage by default) and wait until it finishes."""
+        done = asyncio.get_running_loop().create_future()
+        job["_done"] = done
+        job["_context"] = contextvars.copy_context()
+        job["stage"] = stage or self.first
+        await self.stages[job["stage"]].queue.put(job)
+        try:
+            return await done
+        finally:
+            job.pop("_done", None)
+            job.pop("_context", None)
+
+    def stats(self):
+        """Depth of every stage, in pipeline order."""
+        return {name: stage.stats() for name, stage in self.stages.items()}
+
+    async def _handle(self, stage, job):
+        with tracing.span(f"stage.{stage.name}") as span:
+            next_stage = await stage.handler(self.context, job)
+            span["next"] = next_stage
+            return next_stage
+
+    async def _worker(self, stage, index):
+        while True:
+            job = await stage.queue.get()
+            done = job["_done"]
+            stage.active += 1
+            started = time.monotonic()
+            try:
+                next_stage = await asyncio.create_task(self._handle(stage, job), context=job["_context"])
+            except asyncio.CancelledError:
+                stage.active -= 1
+                if not done.done():
+                    done.cancel()
+                raise
+            except Exception as e:
+                stage.active -= 1
+                metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage=stage.name, outcome="error")
+                logger.error(f"Stage {stage.name} worker {index} failed: {e}")
+                if not done.done():
+                    done.set_exception(e)
+                continue
+            stage.active -= 1
+            # Outcome is where the job went next: another stage, or "done"
+            metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage=stage.name, outcome=next_stage or "done")
+
+            if next_stage is None:
+                if not done.done():
+                    done.set_result(None)
+                continue
+
+            # Blocks while the next stage is full (backpressure)
+            job["stage"] = next_stage
+            await self.stages[next_stage].queue.put(job)
@@ -0,0 +1,178 @@
+import time
+import asyncio
+import logging
+import threading
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+class ProgressDispatcher:
+    """
+    Single sender for all progress message edits.
+    Callers only post the latest state of a message (update() is safe from any thread);
+    the dispatcher keeps one pending state per message, skips edits that would not change
+    the text, and sends within a global rate (token bucket), a minimum gap per chat and
+    per message. A RetryAfter pauses edits to that chat for as long as Telegram asks.
+    Per-message state is dropped on discard() or after `idle_timeout` seconds without edits.
+    """
+    def __init__(self, global_rate=20, chat_interval=1.0, message_interval=5.0, idle_timeout=600):
+        self.bot = None
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.message_interval = message_interval
+        self.idle_timeout = idle_timeout
+
+        self.pending = {}  # (chat_id, message_id) -> (text, reply_markup), oldest first
+        self.sent = {}  # (chat_id, message_id) -> (text, reply_markup) last delivered
+        self.message_next = {}  # (chat_id, message_id) -> earliest next edit
+        self.chat_next = {}  # chat_id -> earliest next edit in that chat
+        self.in_flight = set()
+        self.stats = {"sent": 0, "coalesced": 0, "unchanged": 0, "retry_after": 0, "failed": 0}
+
+        self._tokens = float(global_rate)
+        self._refilled = time.monotonic()
+        self._pruned = self._refilled
+        self._wake = None
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+
+    def start(self, bot):
+        self.bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wake = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def update(self, chat_id, message_id, text, reply_markup=None):
+        """Post the newest state of a progress message. Safe to call from worker threads."""
+        if self._loop is None:
+            return
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.update, chat_id, message_id, text, reply_markup)
+            return
+
+        key = (chat_id, message_id)
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[key] = (text, reply_markup)
+        self._wake.set()
+
+    def discard(self, chat_id, message_id):
+        """
+        Forget a message (call before replacing it with a final status or deleting it),
+        so a queued progress edit cannot overwrite the new text.
+        """
+        key = (chat_id, message_id)
+        self.pending.pop(key, None)
+        self.sent.pop(key, None)
+        self.message_next.pop(key, None)
+        tracked = (*self.message_next, *self.pending, *self.in_flight)
+        if not any(other[0] == chat_id and other != key for other in tracked):
+            self.chat_next.pop(chat_id, None)
+
+    def _prune(self, now):
+        """Drop expired chat gaps and the state of messages idle for `idle_timeout`."""
+        for chat_id, ready_at in list(self.chat_next.items()):
+            if ready_at <= now:
+                del self.chat_next[chat_id]
+        for key, ready_at in list(self.message_next.items()):
+            if ready_at + self.idle_timeout <= now and key not in self.pending and key not in self.in_flight:
+                del self.message_next[key]
+                self.sent.pop(key, None)
+        self._pruned = now
+
+    def _take_token(self, now):
+        self._tokens = min(self.global_rate, self._tokens + (now - self._refilled) * self.global_rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.global_rate
+
+    async def _run(self):
+        while True:
+            delay = self._send_due()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def _send_due(self):
+        """Start every edit that is allowed now; returns seconds until the next one could be."""
+        now = time.monotonic()
+        if now - self._pruned >= self.idle_timeout / 10:
+            self._prune(now)
+        delay = None
+        for key, state in list(self.pending.items()):
+            if key in self.in_flight:
+                continue
+            if self.sent.get(key) == state:
+                del self.pending[key]
+                self.stats["unchanged"] += 1
+                continue
+
+            ready_at = max(self.message_next.get(key, 0), self.chat_next.get(key[0], 0))
+            if ready_at > now:
+                delay = ready_at - now if delay is None else min(delay, ready_at - now)
+                continue
+
+            wait = self._take_token(now)
+            if wait:
+                # Global budget spent; everything else waits for the next token
+                return wait if delay is None else min(delay, wait)
+
+            del self.pending[key]
+            self.in_flight.add(key)
+            self.message_next[key] = now + self.message_interval
+            self.chat_next[key[0]] = now + self.chat_interval
+            self._loop.create_task(self._send(key, state))
+        return delay
+
+    async def _send(self, key, state):
+        chat_id, message_id = key
+        text, reply_markup = state
+        try:
+            await self.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode='HTML',
+                reply_markup=reply_markup
+            )
+            # A discard() while the edit was in flight must not bring the message back
+            if key in self.message_next:
+                self.sent[key] = state
+            self.stats["sent"] += 1
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning(f"Progress edits to chat {chat_id} throttled for {retry_after}s")
+            self.chat_next[chat_id] = time.monotonic() + retry_after
+            # Retry with whatever is newest by then
+            if key in self.message_next:
+                self.pending.setdefault(key, state)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                if key in self.message_next:
+                    self.sent[key] = state
+            else:
+                # Message deleted or no longer editable
+                self.stats["failed"] += 1
+                self.discard(chat_id, message_id)
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"Progress edit failed: {e}")
+        finally:
+            self.in_flight.discard(key)
+            self._wake.set()
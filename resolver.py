@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CandidateStats:
+    """
+    Latency and success rate per resolver candidate (proxy or host variant).
+    Candidates are ordered by expected time to a result: average latency of successful
+    attempts divided by the (smoothed) success rate, so a fast but flaky host can still
+    lose to a steady one.
+    """
+    def __init__(self, alpha=0.3, default_latency=5.0):
+        self.alpha = alpha
+        self.default_latency = default_latency
+        self.stats = {}  # key -> {"attempts", "successes", "latency"}
+
+    def record(self, key, latency, success):
+        stats = self.stats.setdefault(key, {"attempts": 0, "successes": 0, "latency": None})
+        stats["attempts"] += 1
+        if not success:
+            return
+        stats["successes"] += 1
+        # Exponentially weighted, recent behaviour matters most
+        if stats["latency"] is None:
+            stats["latency"] = latency
+        else:
+            stats["latency"] += self.alpha * (latency - stats["latency"])
+
+    def expected_cost(self, key):
+        stats = self.stats.get(key) or {"attempts": 0, "successes": 0, "latency": None}
+        latency = stats["latency"] if stats["latency"] is not None else self.default_latency
+        success_rate = (stats["successes"] + 1) / (stats["attempts"] + 2)
+        return latency / success_rate
+
+    def order(self, keys, preferred=None):
+        """Sorts keys best first; `preferred` (e.g. the last winner) always leads."""
+        return sorted(keys, key=lambda key: (key != preferred, self.expected_cost(key)))
+
+    def snapshot(self):
+        return {key: dict(stats) for key, stats in self.stats.items()}
+
+async def hedged_race(candidates, stagger=1.0, deadline=30.0, stats=None):
+    """
+    Races `candidates`, a list of (key, factory) where factory() returns an awaitable
+    yielding a result or None.
+    Candidate n starts `stagger` seconds after candidate n-1, or right away when an
+    earlier one fails. The first non-None result wins and everything still running is
+    cancelled. Returns (key, result), or (None, None) if all failed or the deadline passed.
+    """
+    loop = asyncio.get_running_loop()
+    waiting = list(candidates)
+    pending = {}  # task -> (key, started)
+    end = loop.time() + deadline
+    next_launch = loop.time()
+
+    def launch():
+        nonlocal next_launch
+        key, factory = waiting.pop(0)
+        pending[asyncio.ensure_future(factory())] = (key, loop.time())
+        next_launch = loop.time() + stagger
+
+    try:
+        while waiting or pending:
+            now = loop.time()
+            if now >= end:
+                logger.warning(f"Resolver deadline of {deadline}s reached")
+                return None, None
+            if waiting and (now >= next_launch or not pending):
+                launch()
+                continue
+
+            timeout = end - now
+            if waiting:
+                timeout = min(timeout, next_launch - now)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                key, started = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.error(f"Resolver candidate {key} failed: {e}")
+                    result = None
+                if stats:
+                    stats.record(key, loop.time() - started, result is not None)
+                if result is not None:
+                    return key, result
+                # Hedge immediately instead of waiting for the stagger
+                next_launch = loop.time()
+        return None, None
+    finally:
+        # Losers are cancelled; their pooled requests are closed and the connections reused
+        for task in pending:
+            task.cancel()
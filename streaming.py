@@ -0,0 +1,177 @@
+import time
+import uuid
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+class RingBuffer:
+    """
+    Fixed-size byte ring between one producer and one consumer.
+    write() waits while the ring is full, read() waits while it is empty, so a slow
+    upload throttles the download instead of growing memory or touching disk.
+    """
+    def __init__(self, capacity):
+        self._buffer = bytearray(capacity)
+        self._capacity = capacity
+        self._start = 0
+        self._length = 0
+        self._closed = False
+        self._error = None
+        self._cond = asyncio.Condition()
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._length < self._capacity or self._error)
+                if self._error:
+                    raise self._error
+                count = min(len(view), self._capacity - self._length)
+                end = (self._start + self._length) % self._capacity
+                first = min(count, self._capacity - end)
+                self._buffer[end:end + first] = view[:first]
+                self._buffer[:count - first] = view[first:count]
+                self._length += count
+                view = view[count:]
+                self._cond.notify_all()
+
+    async def read(self, size):
+        """Returns up to `size` bytes, or b'' once the producer closed and the ring is drained."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._length or self._closed or self._error)
+            if self._error:
+                raise self._error
+            if not self._length:
+                return b''
+            count = min(size, self._length)
+            first = min(count, self._capacity - self._start)
+            data = bytes(self._buffer[self._start:self._start + first]) + bytes(self._buffer[:count - first])
+            self._start = (self._start + count) % self._capacity
+            self._length -= count
+            self._cond.notify_all()
+            return data
+
+    async def close(self):
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    async def fail(self, error):
+        """Wake both sides with an error."""
+        async with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+def _field(boundary, name, value):
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+        f'{value}\r\n'
+    ).encode()
+
+def _file_header(boundary, name, filename, content_type):
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode()
+
+async def stream_video_upload(http, api_url, source_url, size, chat_id, caption, filename,
+                              content_type="video/mp4", thumbnail=None, reply_to_message_id=None, source_headers=None,
+                              buffer_size=8 * 1024 * 1024, chunk_size=256 * 1024,
+                              progress_callback=None, timeout=300, width=None, height=None, duration=None):
+    """
+    Pipes `source_url` straight into a Bot API sendVideo multipart upload, both over the
+    shared HttpPool `http`. `api_url` is the full method URL (".../bot<TOKEN>/sendVideo")
+    and `size` must be the exact content length of the source. `filename` and `content_type`
+    describe the file part. Returns the sent Message as a dict; Telegram may store a file it
+    cannot play as a "document" instead of a "video".
+    """
+    boundary = uuid.uuid4().hex
+    fields = {
+        "chat_id": chat_id,
+        "caption": caption,
+        "parse_mode": "HTML",
+        "supports_streaming": "true",
+        "allow_sending_without_reply": "true",
+    }
+    if reply_to_message_id:
+        fields["reply_to_message_id"] = reply_to_message_id
+    for name, value in (("width", width), ("height", height), ("duration", duration)):
+        if value:
+            fields[name] = int(value)
+    if thumbnail:
+        fields["thumbnail"] = "attach://thumb"
+
+    preamble = b''.join(_field(boundary, name, value) for name, value in fields.items())
+    if thumbnail:
+        preamble += _file_header(boundary, "thumb", "thumb.jpg", "image/jpeg") + thumbnail + b'\r\n'
+    preamble += _file_header(boundary, "video", filename, content_type)
+    epilogue = f'\r\n--{boundary}--\r\n'.encode()
+
+    ring = RingBuffer(buffer_size)
+    timeouts = httpx.Timeout(timeout, connect=30)
+
+    async def produce():
+        try:
+            async with http.stream("GET", source_url, headers=source_headers, timeout=timeouts,
+                                   follow_redirects=True) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_raw(chunk_size):
+                    await ring.write(chunk)
+            await ring.close()
+        except Exception as e:
+            await ring.fail(e)
+            raise
+
+    async def body():
+        yield preamble
+        sent = 0
+        last_update = 0
+        while True:
+            data = await ring.read(chunk_size)
+            if not data:
+                break
+            sent += len(data)
+            if sent > size:
+                raise ValueError("Source is larger than its announced size")
+            yield data
+
+            now = time.time()
+            if progress_callback and (now - last_update > 5 or sent == size):
+                last_update = now
+                await progress_callback(sent, size)
+        if sent != size:
+            raise ValueError(f"Source ended after {sent} of {size} bytes")
+        yield epilogue
+
+    producer = asyncio.create_task(produce())
+    try:
+        response = await http.request(
+            "POST",
+            api_url,
+            content=body(),
+            headers={
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(preamble) + size + len(epilogue)),
+            },
+            timeout=timeouts,
+        )
+    except Exception:
+        await ring.fail(ConnectionError("Upload aborted"))
+        raise
+    finally:
+        # Surface download errors, or stop the download if the upload gave up
+        if not producer.done():
+            producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+
+    result = response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"sendVideo failed: {result.get('description')}")
+    return result["result"]
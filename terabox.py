@@ -0,0 +1,87 @@
+import logging
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Browser-like headers the share pages expect (same as terabox-downloader sends)
+HEADERS = {
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "en-US,en;q=0.9,hi;q=0.8",
+    "DNT": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1",
+    "Upgrade-Insecure-Requests": "1",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36 Edg/135.0.0.0",
+    "sec-ch-ua": '"Microsoft Edge";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
+    "sec-ch-ua-mobile": "?0",
+    "sec-ch-ua-platform": '"Windows"',
+}
+
+LIST_URL = "https://www.terabox.app/share/list"
+
+def _find_between(s, start, end):
+    start_index = s.find(start)
+    if start_index == -1:
+        return ""
+    start_index += len(start)
+    end_index = s.find(end, start_index)
+    if end_index == -1:
+        return ""
+    return s[start_index:end_index]
+
+async def get_file_info(http, link, cookie):
+    """
+    Async port of TeraboxDL.get_file_info on the shared HttpPool `http`.
+    Returns {file_name, download_link, thumbnail, size_bytes} or {"error": ...}.
+    """
+    if not link:
+        return {"error": "Link cannot be empty."}
+    headers = dict(HEADERS, Cookie=cookie)
+
+    try:
+        # Share link redirects to a page URL carrying the surl parameter
+        first = await http.get(link, headers=headers, follow_redirects=True)
+        if not first.is_success:
+            return {"error": f"Failed to fetch the initial link. Status code: {first.status_code}"}
+
+        query_params = parse_qs(urlparse(str(first.url)).query)
+        if "surl" not in query_params:
+            return {"error": "Invalid link. Please check the link."}
+
+        page = await http.get(first.url, headers=headers, follow_redirects=True)
+        js_token = _find_between(page.text, 'fn%28%22', '%22%29')
+        logid = _find_between(page.text, 'dp-logid=', '&')
+        bdstoken = _find_between(page.text, 'bdstoken":"', '"')
+        if not js_token or not logid or not bdstoken:
+            return {"error": "Failed to extract required tokens."}
+
+        params = {
+            "app_id": "250528",
+            "web": "1",
+            "channel": "dubox",
+            "clienttype": "0",
+            "jsToken": js_token,
+            "dp-logid": logid,
+            "page": "1",
+            "num": "20",
+            "by": "name",
+            "order": "asc",
+            "site_referer": str(first.url),
+            "shorturl": query_params["surl"][0],
+            "root": "1,",
+        }
+        listing = (await http.get(LIST_URL, headers=headers, params=params)).json()
+        if not listing or not listing.get("list") or listing.get("errno"):
+            return {"error": listing.get("errmsg", "Failed to retrieve file list.") if listing else "Empty response."}
+
+        file_info = listing["list"][0]
+        return {
+            "file_name": file_info.get("server_filename", ""),
+            "download_link": file_info.get("dlink", ""),
+            "thumbnail": file_info.get("thumbs", {}).get("url3", ""),
+            "size_bytes": int(file_info.get("size", 0)),
+        }
+    except Exception as e:
+        return {"error": f"An error occurred while retrieving file information: {e!r}"}
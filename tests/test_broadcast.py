@@ -0,0 +1,99 @@
+import asyncio
+
+import mongomock
+from telegram.error import Forbidden
+
+from broadcast import Broadcaster
+from db import Database
+
+
+class FakeBot:
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Forbidden("bot was blocked by the user")
+        self.sent.append(chat_id)
+
+
+def make_db(user_count):
+    db = Database(client=mongomock.MongoClient())
+    db.db.users.insert_many([{"user_id": user_id} for user_id in range(1, user_count + 1)])
+    return db
+
+
+def run_broadcast(db, bot, broadcast=None):
+    reports = []
+
+    async def on_progress(broadcast, finished):
+        reports.append((broadcast["last_user_id"], finished))
+
+    async def main():
+        broadcaster = Broadcaster(db, rate=1000, batch_size=4)
+        broadcaster.start(bot, on_progress)
+        if broadcast:
+            broadcaster._launch(broadcast)
+        else:
+            await broadcaster.create("hello", admin_chat_id=0, status_message_id=0)
+        await asyncio.gather(*broadcaster._tasks.values())
+
+    asyncio.run(main())
+    return reports
+
+
+def test_iter_user_ids_resumes_after_a_user():
+    db = make_db(10)
+
+    async def collect(after_user_id):
+        return [user_id async for user_id in db.iter_user_ids(after_user_id, batch_size=3)]
+
+    assert asyncio.run(collect(None)) == list(range(1, 11))
+    assert asyncio.run(collect(7)) == [8, 9, 10]
+
+
+def test_broadcast_checkpoints_every_batch():
+    db = make_db(10)
+    bot = FakeBot(blocked={3})
+
+    reports = run_broadcast(db, bot)
+
+    assert bot.sent == [user_id for user_id in range(1, 11) if user_id != 3]
+    assert reports == [(4, False), (8, False), (10, False), (10, True)]
+    (stored,) = db.db.broadcasts.find()
+    assert (stored["status"], stored["sent"], stored["blocked"], stored["last_user_id"]) == ("done", 9, 1, 10)
+    assert db.db.users.find_one({"user_id": 3})["active"] is False
+
+
+def test_broadcast_resumes_from_its_checkpoint():
+    db = make_db(10)
+    bot = FakeBot()
+    broadcast = {
+        "broadcast_id": "b1", "text": "hello", "status": "running", "admin_chat_id": 0,
+        "status_message_id": 0, "last_user_id": 8, "total": 10, "sent": 8, "blocked": 0, "failed": 0,
+    }
+    db.db.broadcasts.insert_one(dict(broadcast))
+
+    run_broadcast(db, bot, broadcast)
+
+    assert bot.sent == [9, 10]
+    assert broadcast["sent"] == 10
+
+
+def test_broadcast_that_cannot_read_users_is_marked_failed(monkeypatch):
+    db = make_db(10)
+
+    async def get_user_ids_after(after_user_id, limit, active_only=True):
+        return None
+
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr(db, "get_user_ids_after", get_user_ids_after)
+    monkeypatch.setattr("db.asyncio.sleep", sleep)
+    reports = run_broadcast(db, FakeBot())
+
+    assert reports == [(None, True)]
+    (stored,) = db.db.broadcasts.find()
+    assert stored["status"] == "failed"
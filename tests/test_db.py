@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+
+import mongomock
+
+from db import Database
+
+
+def make_db():
+    return Database(client=mongomock.MongoClient())
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_new_users_are_written_in_one_batch():
+    db = make_db()
+
+    assert run(db.add_user(1, "Ann", "ann"))
+    assert run(db.add_user(2, "Bob", None))
+    # Repeat users are answered from memory
+    assert not run(db.add_user(1, "Ann", "ann"))
+    assert db.db.users.count_documents({}) == 0
+
+    assert run(db.flush_users()) == 2
+    assert sorted(user["user_id"] for user in db.db.users.find()) == [1, 2]
+    assert run(db.flush_users()) == 0
+
+
+def test_flush_keeps_joined_at_of_existing_users():
+    db = make_db()
+    db.db.users.insert_one({"user_id": 1, "first_name": "Ann", "joined_at": 100})
+
+    db.pending_users[1] = {"user_id": 1, "first_name": "Ann", "joined_at": 200}
+    run(db.flush_users())
+
+    assert db.db.users.find_one({"user_id": 1})["joined_at"] == 100
+
+
+def test_returning_user_is_reactivated():
+    db = make_db()
+    db.db.users.insert_one({"user_id": 1, "active": False})
+
+    assert not run(db.add_user(1, "Ann", "ann"))
+    assert db.db.users.find_one({"user_id": 1})["active"] is True
+    assert run(db.count_users(active_only=True)) == 1
+
+
+def test_activity_is_recorded_once_a_day():
+    db = make_db()
+    run(db.add_user(1, "Ann", "ann"))
+    run(db.add_user(1, "Ann", "ann"))
+
+    assert run(db.flush_activity()) == 1
+    (record,) = db.db.activity.find()
+    assert record["user_id"] == 1
+    assert record["expire_at"] - record["day"] == datetime.timedelta(days=db.activity_retention_days)
+
+
+def test_video_cache():
+    db = make_db()
+
+    assert run(db.get_video("1abc")) is None
+    assert run(db.add_video("1abc", ["f1", "f2"], "Clip"))
+    assert run(db.get_video("1abc")) == (["f1", "f2"], "Clip")
+    assert db.video_cache_info()["hits"] == 1
+
+    assert run(db.delete_video("1abc"))
+    assert run(db.get_video("1abc")) is None
+
+
+def test_resolved_links_keep_the_host_after_invalidation():
+    db = make_db()
+
+    run(db.set_resolved("1abc", {"url": "https://d/1"}, "www.terabox.com"))
+    assert run(db.get_resolved("1abc")) == ({"url": "https://d/1"}, "www.terabox.com")
+
+    run(db.invalidate_resolved("1abc"))
+    db.resolve_cache.clear()
+    assert run(db.get_resolved("1abc")) == (None, "www.terabox.com")
+
+
+def test_jobs_survive_a_restart():
+    db = make_db()
+    for job_id, status in (("a", "queued"), ("b", "running"), ("c", "queued")):
+        assert run(db.add_job({"job_id": job_id, "status": status, "created_at": ord(job_id), "waiters": []}))
+    run(db.add_job_waiter("a", {"chat_id": 5}))
+    run(db.finish_job("c", "done"))
+
+    jobs = run(db.get_unfinished_jobs())
+    assert [job["job_id"] for job in jobs] == ["a", "b"]
+    assert jobs[0]["waiters"] == [{"chat_id": 5}]
+
+    run(db.requeue_jobs())
+    assert db.db.jobs.count_documents({"status": "queued"}) == 2
+
+
+def test_calls_without_a_database_do_not_raise(monkeypatch):
+    monkeypatch.delenv("MONGO_URL", raising=False)
+    db = Database()
+
+    assert not run(db.add_job({"job_id": "a"}))
+    assert run(db.get_video("1abc")) is None
+    assert run(db.get_user_ids_after(None, 10)) is None
+    assert not run(db.add_user(1, "Ann", "ann"))
@@ -0,0 +1,85 @@
+import asyncio
+
+import bot
+
+
+class FakeBot:
+    def __init__(self):
+        self.videos = []
+        self.albums = []
+
+    async def send_video(self, chat_id, video, **kwargs):
+        self.videos.append(video)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        if not 2 <= len(media) <= 10:
+            raise ValueError("Media group must include 2-10 items")
+        self.albums.append([item.media for item in media])
+
+
+def test_send_video_parts_balances_albums():
+    fake = FakeBot()
+    file_ids = [f"part{index}" for index in range(11)]
+
+    asyncio.run(bot.send_video_parts(fake, 1, file_ids, "caption"))
+
+    assert [len(album) for album in fake.albums] == [6, 5]
+    assert [file_id for album in fake.albums for file_id in album] == file_ids
+    assert not fake.videos
+
+
+def test_send_video_parts_album_sizes():
+    for count in range(2, 62):
+        fake = FakeBot()
+        asyncio.run(bot.send_video_parts(fake, 1, [str(index) for index in range(count)], "caption"))
+        assert sum(len(album) for album in fake.albums) == count
+
+
+class CopyBot:
+    def __init__(self):
+        self.copies = []
+        self.deleted = []
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.copies.append((chat_id, from_chat_id, message_id))
+
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append((chat_id, message_id))
+
+
+def stream_job(title):
+    return {
+        "job_id": "j1", "file_id": "1abc", "video_title": title,
+        "video_info": {"title": title, "url": "https://d/1", "size": 100},
+        "user_id": 1, "user_mention": "Ann", "chat_id": 10, "message_id": 11, "status_message_id": 12,
+        "waiters": [{"user_id": 2, "user_mention": "Bob", "chat_id": 20, "message_id": 21, "status_message_id": 22}],
+    }
+
+
+def test_stream_stage_copies_a_document_result(monkeypatch):
+    uploads = []
+
+    async def stream_video_upload(http, api_url, source_url, size, chat_id, caption, filename, content_type, **kwargs):
+        uploads.append((filename, content_type))
+        return {"message_id": 99, "document": {"file_id": "doc1"}}
+
+    async def job_cookie(job):
+        return None
+
+    monkeypatch.setattr(bot, "stream_video_upload", stream_video_upload)
+    monkeypatch.setattr(bot, "job_cookie", job_cookie)
+    monkeypatch.setattr(bot, "CLOUD_CHANNEL_ID", None)
+    fake = CopyBot()
+
+    assert asyncio.run(bot.stream_stage(fake, stream_job('My "clip".mkv'))) is None
+
+    assert uploads == [("My _clip_.mkv", "video/x-matroska")]
+    # The requester got the upload itself; the waiter gets a copy instead of a second download
+    assert fake.copies == [(20, 10, 99)]
+    assert fake.deleted == [(10, 12), (20, 22)]
+
+
+def test_source_extension():
+    assert bot.source_extension({"title": "Clip.MOV"}) == "mov"
+    assert bot.source_extension({"title": "Clip"}) == "mp4"
+    assert bot.source_extension({"title": "Clip.part 2"}) == "mp4"
@@ -0,0 +1,119 @@
+import os
+import re
+import asyncio
+
+import httpx
+import pytest
+
+import downloader
+from downloader import SegmentedDownloader, SegmentJournal
+from http_pool import HttpPool
+
+DATA = bytes(range(256)) * 64  # 16 KiB
+
+
+class Body(httpx.AsyncByteStream):
+    """Response body sent in small pieces; may break off after `fail_after` bytes."""
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for offset in range(0, len(self.data), 512):
+            if self.fail_after is not None and offset >= self.fail_after:
+                raise httpx.ReadError("connection reset")
+            yield self.data[offset:offset + 512]
+
+
+class RangeServer:
+    """File server for httpx.MockTransport. `short` and `empty` answer that many ranges badly."""
+    def __init__(self, data=DATA, etag='"v1"', fail_after=None, short=0, empty=0):
+        self.data = data
+        self.etag = etag
+        self.fail_after = fail_after
+        self.short = short
+        self.empty = empty
+        self.served = 0
+
+    def __call__(self, request):
+        start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", request.headers["Range"]).groups())
+        end = min(end, len(self.data) - 1)
+        body = self.data[start:end + 1]
+        headers = {"ETag": self.etag, "Content-Range": f"bytes {start}-{end}/{len(self.data)}"}
+        fail_after = None
+        if len(body) > 1:
+            if self.empty:
+                self.empty -= 1
+                body = b""
+            elif self.short:
+                self.short -= 1
+                body = body[:len(body) // 2]
+            fail_after = self.fail_after
+        self.served += len(body) if fail_after is None else min(len(body), fail_after)
+        return httpx.Response(206, headers=headers, stream=Body(body, fail_after))
+
+
+def download(tmp_path, server, retries=2):
+    async def main():
+        http = HttpPool()
+        http._client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+        native = SegmentedDownloader(http, segments=4, retries=retries, chunk_size=1024, min_segment_size=1024)
+        try:
+            return await native.download("https://d.terabox.com/file", str(tmp_path / "video.mp4"))
+        finally:
+            await http.close()
+    return asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    async def sleep(seconds):
+        pass
+    monkeypatch.setattr(downloader.asyncio, "sleep", sleep)
+
+
+def interrupt(tmp_path):
+    """A download whose ranges all break off after 2 KiB; leaves the partial file and its journal."""
+    with pytest.raises(httpx.ReadError):
+        download(tmp_path, RangeServer(fail_after=2048), retries=0)
+    journal = SegmentJournal(str(tmp_path / "video.mp4"))
+    assert journal.load(len(DATA), '"v1"')
+    assert 0 < journal.completed() < len(DATA)
+    return journal
+
+
+def test_interrupted_download_resumes(tmp_path):
+    journal = interrupt(tmp_path)
+    server = RangeServer()
+
+    assert download(tmp_path, server) == len(DATA)
+    assert (tmp_path / "video.mp4").read_bytes() == DATA
+    # Only the missing ranges were fetched again (plus the one-byte probe)
+    assert server.served == len(DATA) - journal.completed() + 1
+    assert not os.path.exists(journal.path)
+
+
+@pytest.mark.parametrize("server", [RangeServer(etag='"v2"'), RangeServer(data=DATA + b"more")])
+def test_changed_source_discards_the_journal(tmp_path, server):
+    interrupt(tmp_path)
+
+    assert download(tmp_path, server) == len(server.data)
+    assert (tmp_path / "video.mp4").read_bytes() == server.data
+    assert server.served == len(server.data) + 1
+
+
+def test_short_ranges_are_continued(tmp_path):
+    server = RangeServer(short=3)
+
+    assert download(tmp_path, server) == len(DATA)
+    assert (tmp_path / "video.mp4").read_bytes() == DATA
+
+
+def test_empty_ranges_are_retried(tmp_path):
+    assert download(tmp_path, RangeServer(empty=2)) == len(DATA)
+    assert (tmp_path / "video.mp4").read_bytes() == DATA
+
+
+def test_empty_ranges_give_up_after_the_retries(tmp_path):
+    with pytest.raises(httpx.RemoteProtocolError):
+        download(tmp_path, RangeServer(empty=1000), retries=2)
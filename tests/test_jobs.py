@@ -0,0 +1,114 @@
+import asyncio
+
+from jobs import JobQueue
+
+
+class SlowDB:
+    """Stores jobs in memory; inserts take a moment, like a round trip to MongoDB."""
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.jobs = {}
+
+    async def add_job(self, job):
+        await asyncio.sleep(0.01)
+        if self.fail:
+            return False
+        self.jobs[job["job_id"]] = dict(job, waiters=list(job["waiters"]))
+        return True
+
+    async def add_job_waiter(self, job_id, waiter):
+        if job_id in self.jobs:
+            self.jobs[job_id]["waiters"].append(waiter)
+
+    async def update_job(self, job_id, fields):
+        if job_id in self.jobs:
+            self.jobs[job_id].update(fields)
+
+    async def finish_job(self, job_id, status, error=None):
+        await self.update_job(job_id, {"status": status, "error": error})
+
+
+async def request(queue, user_id, file_id):
+    """What request_video does: join the active job for the file, or queue a new one."""
+    active_job = queue.find_active(file_id)
+    if active_job and await queue.add_waiter(active_job, {"user_id": user_id}):
+        return "joined"
+    await queue.enqueue({"user_id": user_id, "file_id": file_id})
+    return "queued"
+
+
+def test_concurrent_requests_share_one_job():
+    async def main():
+        db = SlowDB()
+        queue = JobQueue(db)
+        results = await asyncio.gather(*(request(queue, user_id, "f") for user_id in (1, 2, 3)))
+        return db, queue, results
+
+    db, queue, results = asyncio.run(main())
+    assert sorted(results) == ["joined", "joined", "queued"]
+    assert queue.stats()["queued"] == 1
+    (stored,) = db.jobs.values()
+    # Waiters that joined during the insert are stored as well
+    assert [waiter["user_id"] for waiter in stored["waiters"]] == [2, 3]
+
+
+def test_job_is_queued_without_the_database():
+    async def main():
+        queue = JobQueue(SlowDB(fail=True))
+        position = await queue.enqueue({"user_id": 1, "file_id": "f"})
+        return queue, position
+
+    queue, position = asyncio.run(main())
+    assert position == 1
+    assert queue.find_active("f") is not None
+
+
+def queue_with_waiter(status):
+    async def main():
+        db = SlowDB()
+        queue = JobQueue(db)
+        await request(queue, 1, "f")
+        await request(queue, 2, "f")
+        job = queue.find_active("f")
+        job["status"] = status
+        return db, queue, job, await queue.cancel(job["job_id"], 1)
+    return asyncio.run(main())
+
+
+def test_cancel_hands_a_queued_job_to_the_next_waiter():
+    db, queue, job, result = queue_with_waiter("queued")
+    assert result == "handed_over"
+    assert job["user_id"] == 2 and job["waiters"] == []
+    assert queue.position(job["job_id"]) == 1
+    assert db.jobs[job["job_id"]]["user_id"] == 2
+    # The requester that left can no longer cancel it
+    assert asyncio.run(queue.cancel(job["job_id"], 1)) is None
+
+
+def test_cancel_keeps_a_running_job_for_its_waiters():
+    db, queue, job, result = queue_with_waiter("running")
+    assert result == "handed_over"
+    assert not job.get("cancelled")
+    assert queue.find_active("f") is job
+
+
+def test_cancel_without_waiters():
+    async def main():
+        queue = JobQueue(SlowDB())
+        await queue.enqueue({"user_id": 1, "file_id": "queued"})
+        await queue.enqueue({"user_id": 1, "file_id": "running"})
+        queued, running = queue.find_active("queued"), queue.find_active("running")
+        running["status"] = "running"
+        results = [
+            await queue.cancel(queued["job_id"], 2),
+            await queue.cancel(queued["job_id"], 1),
+            await queue.cancel(running["job_id"], 1),
+            await queue.add_waiter(running, {"user_id": 2}),
+        ]
+        return queue, running, results
+
+    queue, running, results = asyncio.run(main())
+    # Only the requester may cancel; nobody can join a job that is being stopped
+    assert results == [None, "removed", "stopping", False]
+    assert queue.find_active("queued") is None
+    assert running["cancelled"]
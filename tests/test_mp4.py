@@ -0,0 +1,145 @@
+import os
+import errno
+import struct
+
+import pytest
+
+import mp4
+
+CHUNKS = [b"chunk-one" * 50, b"chunk-two" * 70, b"chunk-three" * 30]
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def moov_box(offsets, table):
+    fmt = ">I" if table == b"stco" else ">Q"
+    entries = b"".join(struct.pack(fmt, offset) for offset in offsets)
+    chunk_offsets = box(table, struct.pack(">II", 0, len(offsets)) + entries)
+    stbl = box(b"stbl", box(b"stsd", b"\0" * 8) + chunk_offsets)
+    return box(b"moov", box(b"mvhd", b"\0" * 100) + box(b"trak", box(b"mdia", box(b"minf", stbl))))
+
+
+def write_mp4(path, table=b"stco", free=0, lead=b"", trailer=b""):
+    """ftyp [lead] [free] mdat moov [trailer], with the chunk offsets pointing into mdat."""
+    head = box(b"ftyp", b"isom\0\0\0\0isom") + lead
+    if free:
+        head += box(b"free", b"\0" * (free - 8))
+    offsets, position = [], len(head) + 8
+    for chunk in CHUNKS:
+        offsets.append(position)
+        position += len(chunk)
+    moov = moov_box(offsets, table)
+    path.write_bytes(head + box(b"mdat", b"".join(CHUNKS)) + moov + trailer)
+    return len(moov)
+
+
+def chunk_offsets(path):
+    """The stco/co64 entries of the moov in the file."""
+    _, offset, size, _ = next(entry for entry in mp4.inspect(path) if entry[0] == b"moov")
+    with open(path, "rb") as f:
+        f.seek(offset)
+        moov = f.read(size)
+    for table, fmt in ((b"stco", "I"), (b"co64", "Q")):
+        at = moov.find(table)
+        if at != -1:
+            count = struct.unpack_from(">I", moov, at + 8)[0]
+            return list(struct.unpack_from(f">{count}{fmt}", moov, at + 12))
+    raise AssertionError("no chunk offset table")
+
+
+def assert_relocated(path):
+    assert mp4.is_faststart(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    for offset, chunk in zip(chunk_offsets(path), CHUNKS):
+        assert data[offset:offset + len(chunk)] == chunk
+    return [box_type for box_type, _, _, _ in mp4.inspect(path)]
+
+
+def emulate_insert_range(fd, offset, length):
+    """What fallocate(FALLOC_FL_INSERT_RANGE) does, for filesystems that cannot. Leaves the fd offset alone."""
+    block_size = os.fstatvfs(fd).f_bsize
+    if offset % block_size or length % block_size:
+        raise OSError(errno.EINVAL, "unaligned insert")
+    rest = os.pread(fd, os.fstat(fd).st_size - offset, offset)
+    os.pwrite(fd, b"\0" * length + rest, offset)
+
+
+def test_moov_moves_into_a_free_box(tmp_path):
+    path = tmp_path / "video.mp4"
+    write_mp4(path, free=4096)
+
+    assert mp4.relocate_moov(str(path))
+    assert assert_relocated(str(path)) == [b"ftyp", b"moov", b"free", b"mdat"]
+
+
+def test_moov_fills_a_free_box_exactly(tmp_path):
+    path = tmp_path / "video.mp4"
+    moov_size = write_mp4(path)
+    write_mp4(path, free=moov_size)
+    size = path.stat().st_size
+
+    assert mp4.relocate_moov(str(path))
+    assert assert_relocated(str(path)) == [b"ftyp", b"moov", b"mdat"]
+    # The trailing moov is cut off
+    assert path.stat().st_size == size - moov_size
+
+
+@pytest.mark.parametrize("table", [b"stco", b"co64"])
+def test_insert_shifts_chunk_offsets(tmp_path, monkeypatch, table):
+    monkeypatch.setattr(mp4, "_insert_range", emulate_insert_range)
+    path = tmp_path / "video.mp4"
+    write_mp4(path, table=table)
+
+    assert mp4.relocate_moov(str(path))
+    assert assert_relocated(str(path)) == [b"ftyp", b"moov", b"free", b"mdat"]
+
+
+def test_insert_keeps_the_boxes_before_mdat(tmp_path, monkeypatch):
+    monkeypatch.setattr(mp4, "_insert_range", emulate_insert_range)
+    path = tmp_path / "video.mp4"
+    # mdat starts past the first block, so the hole opens inside this box
+    lead = box(b"uuid", bytes(range(256)) * 24)
+    write_mp4(path, lead=lead)
+
+    assert mp4.relocate_moov(str(path))
+    assert assert_relocated(str(path)) == [b"ftyp", b"uuid", b"moov", b"free", b"mdat"]
+    assert lead in path.read_bytes()
+
+
+def test_moov_followed_by_other_boxes_becomes_free(tmp_path, monkeypatch):
+    monkeypatch.setattr(mp4, "_insert_range", emulate_insert_range)
+    path = tmp_path / "video.mp4"
+    trailer = box(b"uuid", b"x" * 40)
+    write_mp4(path, trailer=trailer)
+
+    assert mp4.relocate_moov(str(path))
+    assert assert_relocated(str(path)) == [b"ftyp", b"moov", b"free", b"mdat", b"free", b"uuid"]
+    assert path.read_bytes().endswith(trailer)
+
+
+def test_unsupported_insert_leaves_the_file_alone(tmp_path, monkeypatch):
+    def unsupported(fd, offset, length):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+    monkeypatch.setattr(mp4, "_insert_range", unsupported)
+    path = tmp_path / "video.mp4"
+    write_mp4(path)
+    original = path.read_bytes()
+
+    assert not mp4.relocate_moov(str(path))
+    assert path.read_bytes() == original
+    assert not mp4.is_faststart(str(path))
+
+
+def test_insert_on_this_filesystem(tmp_path):
+    path = tmp_path / "video.mp4"
+    write_mp4(path)
+    original = path.read_bytes()
+
+    if not mp4.relocate_moov(str(path)):
+        assert path.read_bytes() == original
+        pytest.skip("filesystem does not support FALLOC_FL_INSERT_RANGE")
+    assert_relocated(str(path))
@@ -0,0 +1,88 @@
+import asyncio
+
+from progress import ProgressDispatcher
+
+
+class FakeBot:
+    def __init__(self, gate=None):
+        self.edits = []
+        self.gate = gate
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        if self.gate:
+            await self.gate.wait()
+        self.edits.append((chat_id, message_id, text))
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_discard_forgets_the_message_and_its_chat():
+    async def main():
+        dispatcher = ProgressDispatcher()
+        dispatcher.start(FakeBot())
+        dispatcher.update(1, 10, "50%")
+        dispatcher.update(1, 11, "20%")
+        await settle()
+
+        dispatcher.discard(1, 10)
+        assert 1 in dispatcher.chat_next
+        dispatcher.discard(1, 11)
+        await dispatcher.stop()
+        return dispatcher
+
+    dispatcher = asyncio.run(main())
+    assert not dispatcher.sent and not dispatcher.message_next and not dispatcher.chat_next
+
+
+def test_discard_during_an_edit_is_not_undone():
+    async def main():
+        gate = asyncio.Event()
+        fake = FakeBot(gate)
+        dispatcher = ProgressDispatcher()
+        dispatcher.start(fake)
+        dispatcher.update(1, 10, "50%")
+        await settle()
+        assert (1, 10) in dispatcher.in_flight
+
+        dispatcher.discard(1, 10)
+        gate.set()
+        await settle()
+        await dispatcher.stop()
+        return dispatcher, fake
+
+    dispatcher, fake = asyncio.run(main())
+    assert fake.edits == [(1, 10, "50%")]
+    assert not dispatcher.sent and not dispatcher.message_next
+
+
+def test_idle_messages_are_pruned(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("progress.time.monotonic", lambda: clock[0])
+
+    async def main():
+        fake = FakeBot()
+        dispatcher = ProgressDispatcher(message_interval=5, idle_timeout=60)
+        dispatcher.start(fake)
+        dispatcher.update(1, 10, "done")
+        await settle()
+        assert dispatcher.sent and dispatcher.chat_next
+
+        clock[0] += 30
+        dispatcher.update(2, 20, "10%")
+        await settle()
+        assert (1, 10) in dispatcher.sent
+        assert 1 not in dispatcher.chat_next
+
+        clock[0] += 60
+        dispatcher.update(2, 20, "90%")
+        await settle()
+        await dispatcher.stop()
+        return dispatcher, fake
+
+    dispatcher, fake = asyncio.run(main())
+    assert list(dispatcher.sent) == [(2, 20)]
+    assert list(dispatcher.message_next) == [(2, 20)]
+    assert fake.edits[-1] == (2, 20, "90%")
@@ -0,0 +1,73 @@
+import asyncio
+
+import bot
+import terabox
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def make_job():
+    return {
+        "job_id": "job1",
+        "user_id": 1,
+        "chat_id": 1,
+        "message_id": 10,
+        "status_message_id": 11,
+        "file_id": "1abc",
+        "terabox_url": "https://terabox.com/s/1abc",
+        "waiters": [],
+    }
+
+
+def resolve_fake_file(monkeypatch, size_bytes):
+    async def get_file_info(http, url, cookie):
+        return {
+            "file_name": "clip.mp4",
+            "download_link": "https://d.terabox.com/file/clip.mp4",
+            "thumbnail": "",
+            "size_bytes": size_bytes,
+        }
+
+    async def report(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(terabox, "get_file_info", get_file_info)
+    monkeypatch.setattr(bot.cookie_pool, "report", report)
+    return asyncio.run(bot.get_video_info("https://terabox.com/s/1abc", {"cookie": "ndus", "cookie_id": "c1"}))
+
+
+def run_resolve_stage(monkeypatch, video_info):
+    async def get_video_info_multi(*args, **kwargs):
+        return video_info
+
+    async def job_cookie(job):
+        return None
+
+    monkeypatch.setattr(bot, "get_video_info_multi", get_video_info_multi)
+    monkeypatch.setattr(bot, "job_cookie", job_cookie)
+    monkeypatch.setattr(bot, "STREAM_UPLOAD", True)
+    return asyncio.run(bot.resolve_stage(FakeBot(), make_job()))
+
+
+def test_resolved_size_routes_to_stream(monkeypatch):
+    video_info = resolve_fake_file(monkeypatch, 10 * 1024 * 1024)
+
+    assert video_info["size"] == 10 * 1024 * 1024
+    assert run_resolve_stage(monkeypatch, video_info) == "stream"
+
+
+def test_unknown_size_is_probed(monkeypatch):
+    video_info = resolve_fake_file(monkeypatch, 0)
+
+    async def probe(url, headers=None):
+        return 5 * 1024 * 1024, True, url, None
+
+    monkeypatch.setattr(bot.native_downloader, "probe", probe)
+    assert run_resolve_stage(monkeypatch, video_info) == "stream"
+    assert video_info["size"] == 5 * 1024 * 1024
@@ -0,0 +1,47 @@
+import os
+import asyncio
+
+import transcode
+
+# Stands in for ffmpeg: writes its output file, notes its pid, then takes "forever"
+FAKE_FFMPEG = """#!/bin/sh
+for last; do :; done
+[ "$last" = /dev/null ] || echo partial > "$last"
+echo $$ > "$PIDFILE"
+exec sleep 30
+"""
+
+
+def install_fake_ffmpeg(tmp_path, monkeypatch):
+    script = tmp_path / "ffmpeg"
+    script.write_text(FAKE_FFMPEG)
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("PIDFILE", str(tmp_path / "pid"))
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_cancelled_compression_kills_ffmpeg(tmp_path, monkeypatch):
+    install_fake_ffmpeg(tmp_path, monkeypatch)
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"\0" * 1024)
+
+    async def main():
+        task = asyncio.ensure_future(transcode.transcode_to_target_size(str(source), 10 * 1024 * 1024, duration=60))
+        while not (tmp_path / "pid").exists():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.wait({task})
+        return task
+
+    task = asyncio.run(main())
+    assert task.cancelled()
+    assert not is_running(int((tmp_path / "pid").read_text()))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["ffmpeg", "pid", "video.mp4"]
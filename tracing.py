@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import uuid
+import cProfile
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Spans are written here, one JSON object per line, once configure() gave it a file
+span_logger = logging.getLogger("trace")
+span_logger.propagate = False
+_enabled = False
+
+# {"trace_id", "job_id", "user_id", "file_id", "span_id"} of the running job, or None.
+# asyncio tasks and asyncio.to_thread inherit it; run_in_executor needs in_context().
+_current = contextvars.ContextVar("trace_context", default=None)
+
+def configure(path):
+    """Write spans to `path` (JSON lines). Without a path spans are only timed, not written."""
+    global _enabled
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    span_logger.addHandler(handler)
+    span_logger.setLevel(logging.INFO)
+    _enabled = True
+    logger.info(f"Writing job trace spans to {path}")
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def current():
+    """The job context of the running code, or an empty dict."""
+    return _current.get() or {}
+
+@contextmanager
+def job_context(trace_id, job_id=None, user_id=None, file_id=None):
+    """Make every span opened inside (and in tasks started inside) belong to this job."""
+    token = _current.set({
+        "trace_id": trace_id, "job_id": job_id, "user_id": user_id, "file_id": file_id, "span_id": None,
+    })
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Times the block as a span of the current job. Yields a dict the block may add
+    attributes to; "status" is "ok", "error" (with the message) or "cancelled" unless
+    the block sets it itself.
+    """
+    context = _current.get() or {}
+    span_id = uuid.uuid4().hex[:16]
+    token = _current.set({**context, "span_id": span_id})
+    record = dict(attrs)
+    started = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record.setdefault("status", "error")
+        record.setdefault("error", str(e) or type(e).__name__)
+        raise
+    except BaseException:
+        record.setdefault("status", "cancelled")
+        raise
+    finally:
+        _current.reset(token)
+        if _enabled:
+            ended = time.time()
+            _emit({
+                "name": name,
+                "trace_id": context.get("trace_id"),
+                "span_id": span_id,
+                "parent_id": context.get("span_id"),
+                "job_id": context.get("job_id"),
+                "user_id": context.get("user_id"),
+                "file_id": context.get("file_id"),
+                "start": round(started, 6),
+                "end": round(ended, 6),
+                "duration": round(ended - started, 6),
+                "status": record.pop("status", "ok"),
+                **record,
+            })
+
+def _emit(record):
+    try:
+        span_logger.info(json.dumps(record, default=str))
+    except Exception as e:
+        logger.error(f"Failed to write trace span {record.get('name')}: {e}")
+
+def in_context(func, *args, **kwargs):
+    """Bind `func` to a copy of the current context, for loop.run_in_executor."""
+    return functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+
+class JobProfiler:
+    """
+    Opt-in cProfile of every `every`-th job, dumped to `directory/{job_id}.prof`
+    (open with pstats or snakeviz). The profiler sees the event loop thread, so
+    coroutines of jobs running at the same time show up as well; work in worker
+    threads and the ffmpeg processes does not. One job is profiled at a time.
+    """
+    def __init__(self, directory="profiles", every=0):
+        self.directory = directory
+        self.every = every
+        self.jobs = 0
+        self.active = False
+
+    @contextmanager
+    def profile(self, job_id):
+        """Yields the dump path if this job is profiled, else None."""
+        self.jobs += 1
+        if not self.every or self.jobs % self.every or self.active:
+            yield None
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{job_id}.prof")
+        profiler = cProfile.Profile()
+        self.active = True
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            self.active = False
+            try:
+                profiler.dump_stats(path)
+                logger.info(f"Profile of job {job_id} written to {path}")
+            except Exception as e:
+                logger.error(f"Failed to write profile of job {job_id}: {e}")
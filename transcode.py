@@ -0,0 +1,203 @@
+import os
+import glob
+import json
+import asyncio
+import subprocess
+
+# Functions here only return values and raise, logging is left to the caller. The
+# blocking ones run in a worker thread; transcode_to_target_size is a coroutine whose
+# ffmpeg is killed when the task awaiting it is cancelled.
+
+AUDIO_BITRATE = 96000
+# Below this the picture is not worth sending; give up instead
+MIN_VIDEO_BITRATE = 150000
+# Muxing overhead and rate control slack
+SIZE_MARGIN = 0.96
+# Shorter parts than this mean the file cannot be split sensibly
+MIN_SEGMENT_TIME = 10
+# Telegram only accepts thumbnails up to 320px on either side
+THUMB_SIZE = 320
+
+def _number(value, kind=float):
+    try:
+        return kind(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def probe_media(path):
+    """
+    Duration (seconds), width and height of a video in one ffprobe pass.
+    Dimensions are as displayed, i.e. swapped for rotated phone videos. Unknown values are None.
+    """
+    media = {"duration": None, "width": None, "height": None}
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'format=duration:stream=width,height,duration:stream_tags=rotate:stream_side_data=rotation',
+         '-of', 'json', path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        return media
+    try:
+        data = json.loads(result.stdout)
+    except ValueError:
+        return media
+
+    stream = (data.get("streams") or [{}])[0]
+    media["duration"] = _number(data.get("format", {}).get("duration")) or _number(stream.get("duration"))
+    media["width"] = _number(stream.get("width"), int)
+    media["height"] = _number(stream.get("height"), int)
+
+    rotation = _number(stream.get("tags", {}).get("rotate"), int)
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            rotation = _number(side_data["rotation"], int)
+    if rotation and rotation % 180:
+        media["width"], media["height"] = media["height"], media["width"]
+    return media
+
+def probe_duration(path):
+    """Duration of a media file in seconds (ffprobe), or None."""
+    return probe_media(path)["duration"]
+
+def thumbnail_time(duration):
+    """Where to grab the thumbnail: past intros and fade-ins, but early in short clips."""
+    if not duration or duration < 2:
+        return 0
+    return min(max(duration * 0.1, 1), 60)
+
+def grab_thumbnail(input_path, output_path, duration=None):
+    """
+    Writes a JPEG thumbnail of one frame near thumbnail_time(duration). ffmpeg's
+    thumbnail filter picks the most representative of the next frames, which skips
+    black and transition frames. Returns True if the thumbnail was written.
+    """
+    cmd = [
+        'ffmpeg', '-y', '-ss', f"{thumbnail_time(duration):.3f}", '-i', input_path,
+        '-vf', f"thumbnail=30,scale='min({THUMB_SIZE},iw)':'min({THUMB_SIZE},ih)':force_original_aspect_ratio=decrease",
+        '-frames:v', '1', '-q:v', '4', output_path,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 0
+
+async def _ffmpeg(cmd):
+    """Run ffmpeg, killing it if the caller is cancelled. Raises RuntimeError with its stderr tail."""
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode(errors='replace')[-500:])
+
+async def _encode(input_path, output_path, video_bitrate, threads, preset, passlog, scale):
+    """Two-pass x264 encode at `video_bitrate`. Raises RuntimeError with ffmpeg's stderr tail."""
+    video = [
+        '-c:v', 'libx264', '-preset', preset,
+        '-b:v', str(video_bitrate), '-maxrate', str(int(video_bitrate * 1.5)), '-bufsize', str(video_bitrate * 2),
+        '-passlogfile', passlog,
+    ]
+    if threads:
+        video += ['-threads', str(threads)]
+    if scale:
+        video += ['-vf', "scale='min(1280,iw)':'min(720,ih)':force_original_aspect_ratio=decrease:force_divisible_by=2"]
+
+    passes = [
+        ['ffmpeg', '-y', '-i', input_path, *video, '-pass', '1', '-an', '-f', 'null', os.devnull],
+        ['ffmpeg', '-y', '-i', input_path, *video, '-pass', '2',
+         '-c:a', 'aac', '-b:a', str(AUDIO_BITRATE), '-movflags', '+faststart', output_path],
+    ]
+    for cmd in passes:
+        await _ffmpeg(cmd)
+
+async def transcode_to_target_size(input_path, target_bytes, duration=None, threads=0, preset='veryfast', attempts=3):
+    """
+    Re-encodes `input_path` to fit in `target_bytes`.
+    The video bitrate is derived from the duration, the output is checked after each
+    try and the bitrate lowered by the overshoot until it fits or `attempts` run out.
+    Returns (output_path, size, tries); raises ValueError if the target is unreachable.
+    Nothing is left behind when it fails or is cancelled.
+    """
+    if not duration or duration <= 0:
+        duration = await asyncio.to_thread(probe_duration, input_path)
+    if not duration:
+        raise ValueError("Unknown duration, cannot target a size")
+
+    output_path = os.path.splitext(input_path)[0] + ".compressed.mp4"
+    passlog = os.path.splitext(input_path)[0] + ".passlog"
+    video_bitrate = int(target_bytes * 8 * SIZE_MARGIN / duration) - AUDIO_BITRATE
+    try:
+        for attempt in range(1, attempts + 1):
+            if video_bitrate < MIN_VIDEO_BITRATE:
+                raise ValueError(f"Needs {video_bitrate // 1000} kbit/s, below the quality floor")
+            # Low bitrates look better at 720p than at full resolution
+            await _encode(input_path, output_path, video_bitrate, threads, preset, passlog,
+                          scale=video_bitrate < 2500000)
+
+            size = os.path.getsize(output_path)
+            if size <= target_bytes:
+                return output_path, size, attempt
+            video_bitrate = int(video_bitrate * target_bytes / size * SIZE_MARGIN)
+        raise ValueError(f"Still {size} bytes after {attempts} tries")
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        for suffix in ("-0.log", "-0.log.mbtree"):
+            if os.path.exists(passlog + suffix):
+                os.remove(passlog + suffix)
+
+def _part_paths(base):
+    return sorted(glob.glob(glob.escape(base) + ".part[0-9][0-9][0-9].mp4"))
+
+def _remove_parts(base):
+    for path in _part_paths(base):
+        os.remove(path)
+
+def _segment(input_path, base, segment_time):
+    """Stream-copy `input_path` into {base}.partNNN.mp4 files cut at the first keyframe after every `segment_time`."""
+    _remove_parts(base)
+    cmd = [
+        'ffmpeg', '-y', '-i', input_path, '-map', '0:v', '-map', '0:a?', '-c', 'copy',
+        '-f', 'segment', '-segment_time', f"{segment_time:.3f}", '-reset_timestamps', '1',
+        '-segment_format', 'mp4', '-segment_format_options', 'movflags=+faststart',
+        base + ".part%03d.mp4",
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode(errors='replace')[-500:])
+    return _part_paths(base)
+
+def split_to_size(input_path, max_bytes, duration=None, attempts=3):
+    """
+    Cuts `input_path` into parts of at most `max_bytes` without re-encoding.
+    The segment muxer can only cut on keyframes, so a part runs past its segment time
+    by up to one GOP (and bitrate varies); every part is checked and the split redone
+    with shorter segments, scaled by the overshoot, until all fit or `attempts` run out.
+    Returns the part paths in order; raises ValueError if the file cannot be split to size.
+    """
+    if not duration or duration <= 0:
+        duration = probe_duration(input_path)
+    if not duration:
+        raise ValueError("Unknown duration, cannot split by size")
+
+    base = os.path.splitext(input_path)[0]
+    segment_time = duration * max_bytes / os.path.getsize(input_path) * SIZE_MARGIN
+    try:
+        for _ in range(attempts):
+            if segment_time < MIN_SEGMENT_TIME:
+                raise ValueError(f"Parts would be shorter than {MIN_SEGMENT_TIME}s")
+            parts = _segment(input_path, base, segment_time)
+            if not parts:
+                raise ValueError("ffmpeg produced no parts")
+            largest = max(os.path.getsize(path) for path in parts)
+            if largest <= max_bytes:
+                return parts
+            segment_time *= max_bytes / largest * SIZE_MARGIN
+        raise ValueError(f"A part is still {largest} bytes after {attempts} tries")
+    except Exception:
+        _remove_parts(base)
+        raise